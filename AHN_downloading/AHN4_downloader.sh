@@ -1,5 +1,3 @@
 #!/bin/bash
 
-while read url; do
-	curl $url -O /project/lidarac/Data/AHN4
-done < urls.txt
+./AHN_downloader.py -l /project/lidarac/Data/AHN4 -o /project/lidarac/Data/AHN4 -i urls.txt -p 8 --segments 4 -t ahn4
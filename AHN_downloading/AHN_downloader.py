@@ -4,17 +4,45 @@
 """
 Downloader for (AHN) datasets. Used with eEcoLiDAR project
 
-
+Transfers are carried out by a pool of worker threads sharing persistent
+(keep-alive) HTTP(S) connections, so that a single process can keep many large
+.LAZ transfers in flight. Response bodies are streamed to disk in chunks.
+Every downloaded tile is hashed while it streams in and checked against its
+Content-Length and its LAS/LAZ header (see AHN_laz_validation.py) before it is
+moved into place; the result is recorded per tile in the download report.
 """
 
 
 
-import argparse, time, traceback, sys, os, shutil, multiprocessing, json
-import urllib.request
+import argparse, time, traceback, sys, os, shutil, threading, queue, json, heapq, random
+import contextlib
+import http.client
+import urllib.request, urllib.error, urllib.parse
 import datetime
+import hashlib
 import email.utils as eut
 import numpy as np
 
+import AHN_laz_validation
+import AHN_tile_catalogue
+
+
+DEFAULT_CHUNK_SIZE = 2**20  # bytes read from the socket and written to disk at once
+DEFAULT_TIMEOUT = 60  # seconds
+DEFAULT_CACHE_EXPIRY = 24  # hours a cached remote file description is trusted without asking the server
+DEFAULT_RETRIES = 5  # attempts to resume an interrupted transfer
+DEFAULT_SEGMENT_MIN_SIZE = 256  # MB; smaller files are never split in byte-range segments
+RETRY_STATUS = (408, 429, 500, 502, 503, 504)  # HTTP statuses worth retrying
+DEFAULT_PROGRESS_INTERVAL = 30  # seconds between progress summaries
+BACKOFF_BASE = 1.  # seconds; retry n waits a random time up to BACKOFF_BASE*2**n ...
+BACKOFF_MAX = 60.  # ... but never more than this, unless the server asks for it with Retry-After
+THROUGHPUT_GAIN = 0.05  # relative throughput gain needed to keep adding concurrent transfers
+LATENCY_FACTOR = 3.  # response latency this many times the best seen ...
+LATENCY_MIN_INCREASE = 0.5  # ... and at least this many seconds above it counts as congestion
+CONGESTION_COOLDOWN = 10.  # seconds; errors within this window after a decrease count once
+#journal states of a tile that need no work when a run is restarted with the same tag
+DONE_STATUS = ('downloaded', 'copied', 'uptodate')
+
 
 def argument_parser():
     parser = argparse.ArgumentParser(description="""This script checks compares a local repository of (AHN .LAZ) point cloud data fileas against
@@ -23,26 +51,487 @@ def argument_parser():
 
     parser.add_argument('-l','--localrepository',default='', help='path to local repository', type=str, required=True)
     parser.add_argument('-o','--outputdirectory',default='.',help='full path of desired output directory; download destination',type=str, required=True)
-    parser.add_argument('-u','--baseurl',default='',help='common base url of files to be downloaded',type=str, required=True)
+    parser.add_argument('-u','--baseurl',default='',help='common base url of files to be downloaded. Not needed if the input list holds complete urls',type=str)
     parser.add_argument('-s','--suffix',default=None,help='common suffix of files to be downloaded. Optional if included in other fashion, e.g. in filename',type=str)
-    parser.add_argument('-p','--proc',default=1,help='number of processes; default is 1',type=int)
-    parser.add_argument('-i','--inputlist',default=None,help='optional input list')
+    parser.add_argument('-p','--proc',default=1,help='maximum number of concurrent transfers (worker threads), independent of the number of CPUs. The number actually used adapts to throughput, latency and server errors; default is 1',type=int)
+    parser.add_argument('--min-proc',dest='minproc',default=1,help='number of concurrent transfers to start with and never go below; default is 1',type=int)
+    parser.add_argument('--fixed',action='store_true',help='do not adapt the number of concurrent transfers; always run --proc of them')
+    parser.add_argument('-k','--connections',default=None,help='maximum number of idle keep-alive connections kept open per host; default is the value of --proc',type=int)
+    parser.add_argument('--chunksize',default=DEFAULT_CHUNK_SIZE,help='size (in bytes) of the chunks streamed to disk; default is {}'.format(DEFAULT_CHUNK_SIZE),type=int)
+    parser.add_argument('--retries',default=DEFAULT_RETRIES,help='number of times an interrupted transfer is resumed; default is {}'.format(DEFAULT_RETRIES),type=int)
+    parser.add_argument('--segments',default=1,help='number of parallel byte-range segments large files are split into; default is 1 (no splitting)',type=int)
+    parser.add_argument('--segment-min-size',dest='segmentminsize',default=DEFAULT_SEGMENT_MIN_SIZE,help='minimum file size (in MB) for segmented downloads; default is {}'.format(DEFAULT_SEGMENT_MIN_SIZE),type=float)
+    parser.add_argument('--hash',default=AHN_laz_validation.DEFAULT_HASH,help='hash algorithm of the digests recorded in the download report; default is {}'.format(AHN_laz_validation.DEFAULT_HASH),
+                        type=str, choices=sorted(a for a in hashlib.algorithms_guaranteed if not a.startswith('shake')))
+    parser.add_argument('--shard',default=None,help='i/N: download only shard i (1..N) of a partition of the tile list in N shards of about equal size in bytes. The partition is written to shards-<tag>.json in the output directory',type=parse_shard)
+    parser.add_argument('--shards-from',dest='shardsfrom',default=None,help='shard manifest (as written by --shard) to take the partition from, so that all VMs use exactly the same one. Requires --shard',type=str)
+    parser.add_argument('--bbox',default=None,nargs=4,type=float,metavar=('MINX','MINY','MAXX','MAXY'),help='only tiles intersecting this bounding box (RD New)')
+    parser.add_argument('--polygon',default=None,help='only tiles intersecting the polygons in this GeoJSON file or shapefile (RD New)',type=str)
+    parser.add_argument('--catalogue',default=None,help='tile catalogue for --bbox/--polygon: catalogue json, sheet index (GeoJSON/shapefile) or download report. Default is {} in the local repository, built from the local tiles if needed'.format(AHN_tile_catalogue.CATALOGUE_FILENAME),type=str)
+    parser.add_argument('-i','--inputlist',default=None,help='optional input list of map tiles, or of complete urls (e.g. urls.txt)')
+    parser.add_argument('--cache',default=None,help='path of the on-disk cache of remote file metadata; default is .remoteMetadata.json in the output directory',type=str)
+    parser.add_argument('--cache-expiry',dest='cacheexpiry',default=DEFAULT_CACHE_EXPIRY,help='hours after which cached remote metadata is revalidated with the server; default is {}'.format(DEFAULT_CACHE_EXPIRY),type=float)
+    parser.add_argument('--refresh',action='store_true',help='revalidate all cached remote metadata with the server, regardless of its age')
+    parser.add_argument('--progress-interval',dest='progressinterval',default=DEFAULT_PROGRESS_INTERVAL,help='seconds between progress summaries (MB/s, ETA, transfers in flight); 0 disables them. Default is {}'.format(DEFAULT_PROGRESS_INTERVAL),type=float)
     parser.add_argument('-c','--copylocal',default='False',help='Flag [True,False]. if true up-to-date files from local repository will be copied to output directory')
     parser.add_argument('-t','--tag',default=str(np.random.randint(200000)),help='unique run identifier. If not set a string representation of a random integer in [0,199999) is used.')
     return parser
 
 
 
-def build_file_identifiers(inputItem,baseurl,suffix)
+class ConnectionPool(object):
+    """
+    Thread-safe pool of persistent HTTP(S) connections. Idle connections are
+    kept per host, so that consecutive requests to the same server re-use the
+    open TCP/TLS session instead of performing a new handshake.
+    """
+
+    def __init__(self, maxPerHost=1, timeout=DEFAULT_TIMEOUT):
+        self.maxPerHost = maxPerHost
+        self.timeout = timeout
+        self._idle = {}
+        self._lock = threading.Lock()
+
+    def _acquire(self, scheme, netloc):
+        with self._lock:
+            idle = self._idle.get((scheme, netloc), [])
+            if idle:
+                return idle.pop(), True
+        if scheme == 'https':
+            conn = http.client.HTTPSConnection(netloc, timeout=self.timeout)
+        elif scheme == 'http':
+            conn = http.client.HTTPConnection(netloc, timeout=self.timeout)
+        else:
+            raise urllib.error.URLError('unsupported url scheme: {}'.format(scheme))
+        return conn, False
+
+    def _release(self, scheme, netloc, conn):
+        with self._lock:
+            idle = self._idle.setdefault((scheme, netloc), [])
+            if len(idle) < self.maxPerHost:
+                idle.append(conn)
+                return
+        conn.close()
+
+    def _send(self, scheme, netloc, method, path, headers):
+        conn, reused = self._acquire(scheme, netloc)
+        try:
+            conn.request(method, path, headers=headers)
+            return conn, conn.getresponse()
+        except (http.client.RemoteDisconnected, http.client.CannotSendRequest, ConnectionResetError, BrokenPipeError) as e:
+            conn.close()
+            if not reused:
+                raise urllib.error.URLError(e)
+        except (http.client.HTTPException, OSError) as e:
+            conn.close()
+            raise urllib.error.URLError(e)
+        # the server dropped an idle keep-alive connection: retry once on a fresh one
+        conn, _ = self._acquire_new(scheme, netloc)
+        try:
+            conn.request(method, path, headers=headers)
+            return conn, conn.getresponse()
+        except (http.client.HTTPException, OSError) as e:
+            conn.close()
+            raise urllib.error.URLError(e)
+
+    def _acquire_new(self, scheme, netloc):
+        with self._lock:
+            idle = self._idle.pop((scheme, netloc), [])
+        for conn in idle:
+            conn.close()
+        return self._acquire(scheme, netloc)
+
+    def _finish(self, scheme, netloc, conn, response):
+        if response.length == 0 and not response.isclosed():
+            response.read()
+        if response.isclosed() and not response.will_close:
+            self._release(scheme, netloc, conn)
+        else:
+            # body not consumed (or server asked to close): the connection cannot be re-used
+            conn.close()
+
+    @contextlib.contextmanager
+    def open(self, url, method='GET', headers=None, maxRedirects=5):
+        """
+        Issue a request and yield the response. The connection returns to the
+        pool if the response body has been read completely, otherwise it is
+        closed. Error statuses raise urllib.error.HTTPError, connection
+        problems urllib.error.URLError.
+        """
+        headers = dict(headers or {})
+        for _ in range(maxRedirects + 1):
+            parts = urllib.parse.urlsplit(url)
+            path = parts.path or '/'
+            if parts.query:
+                path += '?' + parts.query
+            conn, response = self._send(parts.scheme, parts.netloc, method, path, headers)
+
+            location = response.getheader('Location')
+            if response.status in (301, 302, 303, 307, 308) and location:
+                response.read()
+                self._finish(parts.scheme, parts.netloc, conn, response)
+                url = urllib.parse.urljoin(url, location)
+                if response.status == 303 and method != 'HEAD':
+                    method = 'GET'
+                continue
+
+            if response.status >= 400:
+                response.read()
+                self._finish(parts.scheme, parts.netloc, conn, response)
+                raise urllib.error.HTTPError(url, response.status, response.reason, response.headers, None)
+
+            try:
+                yield response
+            finally:
+                self._finish(parts.scheme, parts.netloc, conn, response)
+            return
+
+        raise urllib.error.URLError('too many redirects for {}'.format(url))
+
+    def close(self):
+        with self._lock:
+            conns = [conn for idle in self._idle.values() for conn in idle]
+            self._idle = {}
+        for conn in conns:
+            conn.close()
+
+
+
+class ConcurrencyController(object):
+    """
+    Adaptive limit on the number of concurrent transfers, AIMD style.
+
+    The limit starts at minLimit and grows (doubling at first, later one at
+    a time) after every round of `limit` finished transfers that raised the
+    aggregate throughput. 429/503-like responses and broken connections halve
+    it; rising response latency lowers it by one. Retry-After pauses the
+    start of new transfers for as long as the server asks.
+    """
+
+    def __init__(self, maxLimit, minLimit=1, adaptive=True):
+        self.maxLimit = max(1, maxLimit)
+        self.minLimit = max(1, min(minLimit, self.maxLimit))
+        self.adaptive = adaptive
+        self.limit = self.minLimit if adaptive else self.maxLimit
+        self.inUse = 0
+        self.pausedUntil = 0.
+        self._slowStart = True
+        self._lastDecrease = 0.
+        self._previousRate = None
+        self._latency = None
+        self._minLatency = None
+        self._condition = threading.Condition()
+        self._new_round()
+
+    def _new_round(self):
+        self._roundStart = time.time()
+        self._roundBytes = 0
+        self._roundTransfers = 0
+
+    def _set_limit(self, limit, reason):
+        limit = max(self.minLimit, min(self.maxLimit, limit))
+        if limit != self.limit:
+            print('concurrent transfers {} -> {} ({})'.format(self.limit, limit, reason))
+            self.limit = limit
+            self._condition.notify_all()
+        self._new_round()
+
+    def acquire(self, weight=1):
+        with self._condition:
+            while True:
+                pause = self.pausedUntil - time.time()
+                if pause > 0:
+                    self._condition.wait(pause)
+                #a transfer heavier than the limit (many segments) may still run on its own
+                elif self.inUse == 0 or self.inUse + weight <= self.limit:
+                    break
+                else:
+                    self._condition.wait()
+            self.inUse += weight
+
+    def release(self, weight=1):
+        with self._condition:
+            self.inUse -= weight
+            self._condition.notify_all()
+
+    @contextlib.contextmanager
+    def slot(self, weight=1):
+        self.acquire(weight)
+        try:
+            yield
+        finally:
+            self.release(weight)
+
+    def record_latency(self, latency):
+        with self._condition:
+            self._minLatency = latency if self._minLatency is None else min(self._minLatency, latency)
+            self._latency = latency if self._latency is None else 0.8*self._latency + 0.2*latency
+
+    def record_transfer(self, nBytes):
+        with self._condition:
+            self._roundBytes += nBytes
+            self._roundTransfers += 1
+            if not self.adaptive or self._roundTransfers < self.limit:
+                return
+            rate = self._roundBytes/max(time.time() - self._roundStart, 1e-3)
+            previousRate, self._previousRate = self._previousRate, rate
+            if self._latency is not None and self._latency > max(LATENCY_FACTOR*self._minLatency, self._minLatency + LATENCY_MIN_INCREASE):
+                self._slowStart = False
+                self._set_limit(self.limit - 1, 'latency {:.2f} s'.format(self._latency))
+            elif previousRate is None or rate > (1. + THROUGHPUT_GAIN)*previousRate:
+                self._set_limit(self.limit*2 if self._slowStart else self.limit + 1, '{:.2f} MB/s'.format(rate/2**20))
+            else:
+                #more transfers did not pay off: the link is saturated, hold
+                self._slowStart = False
+                self._new_round()
+
+    def record_congestion(self, retryAfter=None):
+        with self._condition:
+            now = time.time()
+            if retryAfter is not None:
+                self.pausedUntil = max(self.pausedUntil, now + retryAfter)
+            if self.adaptive and now - self._lastDecrease > CONGESTION_COOLDOWN:
+                self._slowStart = False
+                self._lastDecrease = now
+                self._previousRate = None
+                self._set_limit(self.limit//2, 'server congestion')
+
+
+
+def parse_retry_after(headers):
+    """ Seconds to wait according to a Retry-After header (delta-seconds or HTTP date), or None. """
+    value = headers.get('Retry-After') if headers is not None else None
+    if value is None:
+        return None
+    try:
+        return max(0., float(value))
+    except ValueError:
+        date = parse_http_date(value)
+        if date == []:
+            return None
+        return max(0., (date - datetime.datetime.now(datetime.timezone.utc)).total_seconds())
+
+
+def retry_delay(attempt, retryAfter=None):
+    """ Retry-After if the server gave one, otherwise exponential backoff with full jitter. """
+    if retryAfter is not None:
+        return retryAfter + random.uniform(0., BACKOFF_BASE)
+    return random.uniform(0., min(BACKOFF_MAX, BACKOFF_BASE*2**attempt))
+
+
+def wait_before_retry(attempt, error, controller=None):
+    retryAfter = None
+    if isinstance(error, urllib.error.HTTPError):
+        retryAfter = parse_retry_after(error.headers)
+    if controller is not None:
+        controller.record_congestion(retryAfter)
+    time.sleep(retry_delay(attempt, retryAfter))
+
+
+
+class RangeRequestError(http.client.HTTPException):
+    """ The server did not honour a byte-range request (file changed or ranges unsupported). """
+
+
+
+class RemoteMetadataCache(object):
+    """
+    Manifest of remote file metadata (existence, size, Last-Modified, ETag)
+    keyed by URL and persisted as JSON. Entries checked less than `expiry`
+    seconds ago are trusted without contacting the server; older entries are
+    revalidated with a conditional request.
+    """
+
+    def __init__(self, path, expiry=DEFAULT_CACHE_EXPIRY*3600, refresh=False, autosave=100):
+        self.path = path
+        self.expiry = expiry
+        self.refresh = refresh
+        #with refresh, only entries checked before this run are revalidated
+        self.opened = time.time()
+        self.autosave = autosave
+        self._entries = {}
+        self._unsaved = 0
+        self._lock = threading.Lock()
+        if path is not None and os.path.isfile(path):
+            try:
+                with open(path, 'r') as cacheFile:
+                    self._entries = json.load(cacheFile)
+            except (IOError, ValueError):
+                print('remote metadata cache {} could not be read, starting empty'.format(path))
+
+    def get(self, url):
+        with self._lock:
+            entry = self._entries.get(url)
+            return dict(entry) if entry is not None else None
+
+    def is_fresh(self, entry):
+        checked = entry.get('checked', 0.)
+        if self.refresh and checked < self.opened:
+            return False
+        return (time.time() - checked) < self.expiry
+
+    def update(self, url, **fields):
+        with self._lock:
+            entry = self._entries.setdefault(url, {})
+            entry.update(fields)
+            entry['checked'] = time.time()
+            self._unsaved += 1
+            save = self.autosave and self._unsaved >= self.autosave
+        if save:
+            self.save()
+
+    def save(self):
+        if self.path is None:
+            return
+        with self._lock:
+            content = json.dumps(self._entries, indent=1, sort_keys=True)
+            self._unsaved = 0
+            tmpPath = '{}.{}.tmp'.format(self.path, threading.get_ident())
+            with open(tmpPath, 'w') as cacheFile:
+                cacheFile.write(content)
+            os.replace(tmpPath, self.path)
+
+
+
+class DownloadJournal(object):
+    """
+    Append-only JSONL record of finished tiles. A line is written (and
+    flushed to disk) as soon as a tile finishes, so a crashed run can be
+    restarted with the same tag and skip everything already done.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.records = {}
+        if os.path.isfile(path):
+            with open(path, 'r') as journalFile:
+                for line in journalFile:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        #last line of a crashed run may be incomplete
+                        continue
+                    self.records[record['tile']] = record
+        self._journalFile = open(path, 'a')
+
+    def done(self, mapTile):
+        record = self.records.get(mapTile)
+        return record is not None and record['status'] in DONE_STATUS
+
+    def append(self, record):
+        self.records[record['tile']] = record
+        self._journalFile.write(json.dumps(record) + '\n')
+        self._journalFile.flush()
+        os.fsync(self._journalFile.fileno())
+
+    def close(self):
+        self._journalFile.close()
+
+
+
+class TransferMonitor(object):
+    """
+    Live transfer statistics shared by all worker threads: bytes streamed,
+    transfers in flight and tiles finished. A background thread prints a
+    summary line every `interval` seconds.
+    """
+
+    def __init__(self, nTiles, interval=DEFAULT_PROGRESS_INTERVAL):
+        self.nTiles = nTiles
+        self.interval = interval
+        self.nBytes = 0
+        self.inFlight = 0
+        self.finished = 0
+        self.t0 = time.time()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def add_bytes(self, nBytes):
+        with self._lock:
+            self.nBytes += nBytes
+
+    def tile_started(self):
+        with self._lock:
+            self.inFlight += 1
+
+    def tile_finished(self):
+        with self._lock:
+            self.inFlight -= 1
+            self.finished += 1
+
+    def summary(self):
+        with self._lock:
+            nBytes, inFlight, finished = self.nBytes, self.inFlight, self.finished
+        elapsed = time.time() - self.t0
+        rate = nBytes/2**20/elapsed if elapsed > 0 else 0.
+        if finished > 0:
+            eta = '{:.0f} s'.format(elapsed*(self.nTiles - finished)/finished)
+        else:
+            eta = 'unknown'
+        return 'progress: {} of {} tiles, {:.1f} MB in {:.0f} s ({:.2f} MB/s), {} in flight, ETA {}'.format(
+            finished, self.nTiles, nBytes/2**20, elapsed, rate, inFlight, eta)
+
+    def _report(self):
+        while not self._stop.wait(self.interval):
+            print(self.summary())
+
+    def start(self):
+        if self.interval and self.interval > 0:
+            self._thread = threading.Thread(target=self._report, daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+
+
+def parse_http_date(value):
+    """ Convert an HTTP date header to a timezone-aware datetime ([] if missing or malformed). """
+    try:
+        return eut.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return []
+
+
+
+def stream_response(response, outputFile, chunkSize=DEFAULT_CHUNK_SIZE, digest=None, monitor=None):
+    """ Copy the body of an HTTP response to an open file, one chunk at a time, hashing it on the way. """
+    nBytes = 0
+    while True:
+        chunk = response.read(chunkSize)
+        if not chunk:
+            break
+        outputFile.write(chunk)
+        if digest is not None:
+            digest.update(chunk)
+        if monitor is not None:
+            monitor.add_bytes(len(chunk))
+        nBytes += len(chunk)
+    return nBytes
+
+
+
+def build_file_identifiers(inputItem,baseurl,suffix):
     filename = build_filename(inputItem,suffix)
-    url = build_url(baseurl,filename)
+    if is_url(inputItem):
+        url = inputItem
+    else:
+        url = build_url(baseurl,filename)
     return filename, url
 
+def is_url(inputItem):
+    return '://' in inputItem
+
 def build_filename(top10nlMapTile, suffix):
-    if suffix != None:
+    if is_url(top10nlMapTile):
+        filename=os.path.basename(urllib.parse.urlsplit(top10nlMapTile).path)
+    elif suffix != None:
         filename=top10nlMapTile.lower()+suffix
     else:
-        top10nlMapTile.lower()
+        filename=top10nlMapTile
     return filename
 
 
@@ -64,7 +553,7 @@ def check_local(top10nlMapTile,localFilesPath, suffix):
 
     if os.path.isfile(localMapTileFilePath):
         mapTileFileExistsLocal=True
-        localDate = datetime.datetime.fromtimestamp(os.stat(localMapTileFilePath).st_mtime)
+        localDate = datetime.datetime.fromtimestamp(os.stat(localMapTileFilePath).st_mtime, datetime.timezone.utc)
         localSize = os.stat(localMapTileFilePath).st_size
 
     else:
@@ -73,27 +562,82 @@ def check_local(top10nlMapTile,localFilesPath, suffix):
     return mapTileFileExistsLocal, localSize, localDate
 
 
-def check_remote(top10nlMapTile, baseurl, suffix):
+def check_remote(top10nlMapTile, baseurl, suffix, pool, cache=None):
 
-    mapTileFileName = build_filename(top10nlMapTile, suffix)
-    mapTileFileUrl = build_url(baseurl, mapTileFileName)
+    mapTileFileName, mapTileFileUrl = build_file_identifiers(top10nlMapTile, baseurl, suffix)
 
     mapTileFileExistsRemote=False
     remoteSize=[]
     remoteDate=[]
 
+    entry = cache.get(mapTileFileUrl) if cache is not None else None
+    if entry is not None and cache.is_fresh(entry):
+        size = entry.get('size')
+        return entry['exists'], size if size is not None else [], parse_http_date(entry.get('lastModified'))
+
+    #conditional request: the server answers 304 if the cached description is still valid
+    headers = {}
+    if entry is not None and entry['exists']:
+        if entry.get('etag'):
+            headers['If-None-Match'] = entry['etag']
+        if entry.get('lastModified'):
+            headers['If-Modified-Since'] = entry['lastModified']
+
     try:
-        req = urllib.request.urlopen(mapTileFileUrl)
+        try:
+            response = remote_head(pool, mapTileFileUrl, headers)
+        except urllib.error.HTTPError as e:
+            if e.code not in (405, 501):
+                raise
+            #HEAD not supported: fall back to a GET whose body is never read
+            response = remote_head(pool, mapTileFileUrl, headers, method='GET')
+
+        if response['status'] == 304:
+            entry.pop('checked', None)
+        else:
+            entry = {'exists': True,
+                     'size': response['size'],
+                     'lastModified': response['lastModified'],
+                     'etag': response['etag'],
+                     'acceptRanges': response['acceptRanges']}
         mapTileFileExistsRemote=True
-        remoteDate = datetime.datetime(*eut.parsedate(req.headers['Last-Modified'])[:6])
-
+        remoteSize = entry['size'] if entry['size'] is not None else []
+        remoteDate = parse_http_date(entry['lastModified'])
+        if cache is not None:
+            cache.update(mapTileFileUrl, **entry)
 
+    except urllib.error.HTTPError as e:
+        print(e)
+        if e.code in (404, 410) and cache is not None:
+            cache.update(mapTileFileUrl, exists=False, size=None, lastModified=None, etag=None, acceptRanges=False)
     except urllib.error.URLError as e:
         print(e)
 
     return mapTileFileExistsRemote, remoteSize, remoteDate
 
 
+def remote_head(pool, url, headers=None, method='HEAD', retries=DEFAULT_RETRIES):
+    """ Retrieve status, size, Last-Modified and ETag of a remote file without downloading it. """
+    for attempt in range(retries + 1):
+        try:
+            return remote_head_once(pool, url, headers, method)
+        except urllib.error.HTTPError as e:
+            #a throttled check must not make a tile look missing
+            if e.code not in RETRY_STATUS or attempt == retries:
+                raise
+            wait_before_retry(attempt, e)
+
+
+def remote_head_once(pool, url, headers=None, method='HEAD'):
+    with pool.open(url, method=method, headers=headers) as response:
+        contentLength = response.getheader('Content-Length')
+        return {'status': response.status,
+                'size': int(contentLength) if contentLength is not None else None,
+                'lastModified': response.getheader('Last-Modified'),
+                'etag': response.getheader('ETag'),
+                'acceptRanges': (response.getheader('Accept-Ranges') or '').lower() == 'bytes'}
+
+
 
 
 def copy_execute(top10nlMapTile, suffix,localFilesPath,outputDirectory):
@@ -115,11 +659,11 @@ def copy_execute(top10nlMapTile, suffix,localFilesPath,outputDirectory):
 
 
 
-def download_decider(top10nlMapTile, localFilesPath, baseurl, suffix):
+def download_decider(top10nlMapTile, localFilesPath, baseurl, suffix, pool, cache=None):
 
     mapTileFileExistsLocal, localSize, localDate = check_local(top10nlMapTile,localFilesPath, suffix)
 
-    mapTileFileExistsRemote, remoteSize, remoteDate = check_remote(top10nlMapTile, baseurl, suffix)
+    mapTileFileExistsRemote, remoteSize, remoteDate = check_remote(top10nlMapTile, baseurl, suffix, pool, cache)
 
     download=False
 
@@ -127,7 +671,9 @@ def download_decider(top10nlMapTile, localFilesPath, baseurl, suffix):
         if mapTileFileExistsLocal == False:
             download = True
         else:
-            if ((remoteDate > localDate) or (remoteSize != localSize)):
+            if remoteDate != [] and remoteDate > localDate:
+                download = True
+            elif remoteSize != [] and remoteSize != localSize:
                 download = True
     else:
         if mapTileFileExistsLocal == True:
@@ -138,39 +684,259 @@ def download_decider(top10nlMapTile, localFilesPath, baseurl, suffix):
 
 
 
-def download_execute(top10nlMapTile, baseurrl, suffix, outputDir):
+def download_execute(top10nlMapTile, baseurl, suffix, outputDir, pool, cache=None, chunkSize=DEFAULT_CHUNK_SIZE,
+                     retries=DEFAULT_RETRIES, segments=1, segmentMinSize=DEFAULT_SEGMENT_MIN_SIZE,
+                     hashAlgorithm=AHN_laz_validation.DEFAULT_HASH, monitor=None, controller=None):
 
-    mapTileFileName = build_filename(top10nlMapTile,suffix)
-    mapTileFileUrl = build_url(baseurl, mapTileFileName)
+    mapTileFileName, mapTileFileUrl = build_file_identifiers(top10nlMapTile, baseurl, suffix)
 
+    #data goes to a .part file that is moved in place only once complete
     outputFilePath = os.path.join(outputDir,mapTileFileName)
+    partFilePath = outputFilePath + '.part'
+    segmentsFilePath = partFilePath + '.segments'
     downloadSuccess = False
-
+    verification = None
+
+    remote = cache.get(mapTileFileUrl) if cache is not None else None
+    remote = remote or {}
+    #If-Range validator: a resumed transfer must continue the same version of the file
+    validator = remote.get('etag') or remote.get('lastModified')
+
+    useSegments = (segments > 1
+                   and remote.get('acceptRanges')
+                   and remote.get('size') is not None
+                   and remote['size'] >= segmentMinSize*2**20
+                   #an interrupted single-stream transfer is resumed as such
+                   and not (os.path.isfile(partFilePath) and not os.path.isfile(segmentsFilePath)))
+
+    #a segmented transfer counts as one transfer per segment
+    weight = segments if useSegments else 1
+    slot = controller.slot(weight) if controller is not None else contextlib.nullcontext()
     try:
-        urllib.request.urlretrieve(mapTileFileUrl,outputFilePath)
-        downloadSuccess = True
-    except urllib.error.URLError:
-        print('failure while downloading')
-
-    return downloadSuccess
-
-
-
-def maptile_downloader(top10nlMapTile,localFilesPath,outputDir,baseurl, suffix, copylocal):
-
-    executeDownload, localExists = download_decider(top10nlMapTile,localFilesPath, baseurl, suffix)
+        with slot:
+            #a tile failing verification is fetched once more straight away
+            for attempt in range(2):
+                transfer = None
+                if useSegments:
+                    try:
+                        download_segmented(mapTileFileUrl, partFilePath, remote['size'], validator, pool, segments, chunkSize, retries, monitor, controller)
+                        #segments arrive out of order, the hash is computed from disk afterwards
+                        transfer = {'lastModified': parse_http_date(remote.get('lastModified')), 'size': remote['size'], 'digest': None}
+                    except RangeRequestError as e:
+                        print('segmented download of {} not possible ({}), downloading as a single stream'.format(mapTileFileUrl, e))
+                        remove_partial(partFilePath)
+                        useSegments = False
+                if transfer is None:
+                    transfer = download_resumable(mapTileFileUrl, partFilePath, validator, pool, chunkSize, retries, hashAlgorithm, monitor, controller)
+
+                verification = AHN_laz_validation.verify_tile(partFilePath, mapTileFileName, transfer['size'], transfer['digest'], hashAlgorithm)
+                if verification['valid']:
+                    break
+                print('verification of {} failed: {}'.format(mapTileFileUrl, verification['error']))
+                remove_partial(partFilePath)
+
+        if verification['valid']:
+            os.replace(partFilePath, outputFilePath)
+            if transfer['lastModified'] != []:
+                #mirror the remote modification time, so later freshness checks compare like with like
+                os.utime(outputFilePath, (time.time(), transfer['lastModified'].timestamp()))
+            downloadSuccess = True
+            if controller is not None:
+                controller.record_transfer(verification['size'])
+    except (http.client.HTTPException, OSError) as e:
+        print('failure while downloading {}: {}'.format(mapTileFileUrl, e))
+
+    return downloadSuccess, verification
+
+
+def remove_partial(partFilePath):
+    for path in (partFilePath + '.segments', partFilePath):
+        if os.path.isfile(path):
+            os.remove(path)
+
+
+def parse_content_range(value):
+    """ Return first byte and total size from a 'bytes first-last/total' header (total is None if unknown). """
+    try:
+        unit, byteRange = value.split(' ', 1)
+        span, total = byteRange.split('/')
+        first = int(span.split('-')[0])
+        return first, (int(total) if total != '*' else None)
+    except (AttributeError, ValueError):
+        raise RangeRequestError('malformed Content-Range: {}'.format(value))
+
+
+def download_resumable(url, partFilePath, validator, pool, chunkSize=DEFAULT_CHUNK_SIZE, retries=DEFAULT_RETRIES,
+                       hashAlgorithm=AHN_laz_validation.DEFAULT_HASH, monitor=None, controller=None):
+    """
+    Stream url to partFilePath. After an interruption the transfer continues
+    from the end of the .part file with a Range request (If-Range protects
+    against appending bytes of a newer version of the file).
+    Returns remote modification date, expected size and digest of the file.
+    """
+    digest, hashedBytes = None, None
+    attempt = 0
+    while True:
+        offset = os.path.getsize(partFilePath) if os.path.isfile(partFilePath) else 0
+        headers = {}
+        if offset > 0:
+            headers['Range'] = 'bytes={}-'.format(offset)
+            if validator:
+                headers['If-Range'] = validator
+        try:
+            t0 = time.time()
+            with pool.open(url, headers=headers) as response:
+                if controller is not None:
+                    controller.record_latency(time.time() - t0)
+                if response.status == 206:
+                    first, total = parse_content_range(response.getheader('Content-Range'))
+                    if first != offset:
+                        raise RangeRequestError('requested byte {}, got {}'.format(offset, first))
+                    mode = 'ab'
+                    if hashedBytes != offset:
+                        #bytes from an earlier run are hashed before new ones are appended
+                        digest = hashlib.new(hashAlgorithm)
+                        with open(partFilePath, 'rb') as partFile:
+                            for chunk in iter(lambda: partFile.read(chunkSize), b''):
+                                digest.update(chunk)
+                else:
+                    #full content: either a fresh start or the server ignored the range
+                    offset = 0
+                    total = response.length
+                    mode = 'wb'
+                    digest = hashlib.new(hashAlgorithm)
+                hashedBytes = None
+                with open(partFilePath, mode) as partFile:
+                    nBytes = stream_response(response, partFile, chunkSize, digest, monitor)
+                hashedBytes = offset + nBytes
+                lastModified = response.getheader('Last-Modified')
+            if total is not None and offset + nBytes < total:
+                raise http.client.IncompleteRead(b'', total - offset - nBytes)
+            return {'lastModified': parse_http_date(lastModified), 'size': total, 'digest': digest.hexdigest()}
+
+        except urllib.error.HTTPError as e:
+            if e.code == 416 and offset > 0:
+                #.part does not match the remote file any more: start over from byte 0, without using up an attempt
+                os.remove(partFilePath)
+                continue
+            if e.code not in RETRY_STATUS or attempt == retries:
+                raise
+            wait_before_retry(attempt, e, controller)
+        except RangeRequestError:
+            os.remove(partFilePath)
+            if attempt == retries:
+                raise
+        except (http.client.HTTPException, OSError) as e:
+            if attempt == retries:
+                raise
+            print('transfer of {} interrupted ({}), resuming'.format(url, e))
+            wait_before_retry(attempt, e, controller)
+        attempt += 1
+
+
+def download_segmented(url, partFilePath, size, validator, pool, nSegments, chunkSize=DEFAULT_CHUNK_SIZE, retries=DEFAULT_RETRIES, monitor=None, controller=None):
+    """
+    Download url as nSegments byte ranges fetched in parallel into a
+    pre-allocated .part file. Progress per segment is kept in a
+    .part.segments file, so that an interrupted download resumes every
+    segment where it stopped.
+    """
+    segmentsFilePath = partFilePath + '.segments'
+    segments = None
+    if os.path.isfile(segmentsFilePath) and os.path.isfile(partFilePath):
+        with open(segmentsFilePath, 'r') as segmentsFile:
+            state = json.load(segmentsFile)
+        if state['size'] == size and state['validator'] == validator:
+            segments = state['segments']
+    if segments is None:
+        segmentSize = -(-size // nSegments)
+        #[first byte, last byte, bytes done]
+        segments = [[first, min(first + segmentSize, size) - 1, 0] for first in range(0, size, segmentSize)]
+        with open(partFilePath, 'wb') as partFile:
+            partFile.truncate(size)
+
+    errors = []
+    def fetch(segment):
+        try:
+            download_segment(url, partFilePath, segment, validator, pool, chunkSize, retries, monitor, controller)
+        except (http.client.HTTPException, OSError) as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=fetch, args=(segment,)) for segment in segments if segment[0] + segment[2] <= segment[1]]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    if errors:
+        with open(segmentsFilePath, 'w') as segmentsFile:
+            json.dump({'size': size, 'validator': validator, 'segments': segments}, segmentsFile)
+        raise errors[0]
+    if os.path.isfile(segmentsFilePath):
+        os.remove(segmentsFilePath)
+
+
+def download_segment(url, partFilePath, segment, validator, pool, chunkSize=DEFAULT_CHUNK_SIZE, retries=DEFAULT_RETRIES, monitor=None, controller=None):
+    first, last = segment[0], segment[1]
+    with open(partFilePath, 'r+b') as partFile:
+        for attempt in range(retries + 1):
+            position = first + segment[2]
+            headers = {'Range': 'bytes={}-{}'.format(position, last)}
+            if validator:
+                headers['If-Range'] = validator
+            try:
+                t0 = time.time()
+                with pool.open(url, headers=headers) as response:
+                    if controller is not None:
+                        controller.record_latency(time.time() - t0)
+                    if response.status != 206:
+                        raise RangeRequestError('no partial content for {} (status {})'.format(url, response.status))
+                    partFile.seek(position)
+                    while position <= last:
+                        chunk = response.read(min(chunkSize, last + 1 - position))
+                        if not chunk:
+                            break
+                        partFile.write(chunk)
+                        if monitor is not None:
+                            monitor.add_bytes(len(chunk))
+                        position += len(chunk)
+                        segment[2] += len(chunk)
+                if position <= last:
+                    raise http.client.IncompleteRead(b'', last + 1 - position)
+                return
+            except RangeRequestError:
+                raise
+            except urllib.error.HTTPError as e:
+                if e.code not in RETRY_STATUS or attempt == retries:
+                    raise
+                wait_before_retry(attempt, e, controller)
+            except (http.client.HTTPException, OSError) as e:
+                if attempt == retries:
+                    raise
+                print('segment {}-{} of {} interrupted ({}), resuming'.format(first, last, url, e))
+                wait_before_retry(attempt, e, controller)
+
+
+
+def maptile_downloader(top10nlMapTile,localFilesPath,outputDir,baseurl, suffix, copylocal, pool, cache=None, **transferOptions):
+
+    executeDownload, localExists = download_decider(top10nlMapTile,localFilesPath, baseurl, suffix, pool, cache)
 
     downloadSuccess = False
     executeCopy = False
     copySuccess = False
+    verification = None
+    status = 'missing'
 
     if executeDownload == True:
 
-        downloadSuccess = download_execute(top10nlMapTile,baseurl, suffix, outputDir)
+        downloadSuccess, verification = download_execute(top10nlMapTile,baseurl, suffix, outputDir, pool, cache, **transferOptions)
+        status = 'downloaded' if downloadSuccess else 'failed'
 
     else:
         if localExists == True:
             print('mapTile {} exists and is up-to-date'.format(top10nlMapTile))
+            status = 'uptodate'
             if copylocal == False:
                 print('skipping download')
             else:
@@ -181,12 +947,11 @@ def maptile_downloader(top10nlMapTile,localFilesPath,outputDir,baseurl, suffix,
                     copySuccess = True
                 else:
                     copySuccess = copy_execute(top10nlMapTile,suffix, localFilesPath,outputDir)
+                status = 'copied' if copySuccess else 'failed'
         else:
             print('neither local nor remote tile {} found'.format(top10nlMapTile))
 
-
-    time.sleep(1)
-    return executeDownload, downloadSuccess, executeCopy, copySuccess
+    return executeDownload, downloadSuccess, executeCopy, copySuccess, verification, status
 
 
 def read_input(infile):
@@ -195,46 +960,84 @@ def read_input(infile):
     try:
         with open(infile,'r') as inf:
             lines = inf.readlines()
-            tileList = [line.rstrip() for line in lines]
+            tileList = [line.rstrip() for line in lines if line.strip()]
 
-    except IOerror:
+    except IOError:
         print('input file {} could not be opened.'.format(infile))
 
     return tileList
 
 
-def run(localFilesPath,outputDir, baseurl, suffix, numberProcs tag, inputList=[],copylocal=False):
+def run(localFilesPath,outputDir, baseurl, suffix, numberProcs, tag, inputList=[],copylocal=False, maxConnectionsPerHost=None,
+        cachePath=None, cacheExpiry=DEFAULT_CACHE_EXPIRY, refresh=False, shard=None, shardsManifest=None,
+        progressInterval=DEFAULT_PROGRESS_INTERVAL, minProcs=1, adaptive=True, **transferOptions):
     #check input
     if not os.path.isdir(localFilesPath):
         raise Exception('Error: local file path is not a valid directory!')
     elif os.path.isfile(outputDir):
         raise Exception('Error: file with same name as output directory exists! Please delete it.')
+    os.makedirs(outputDir, exist_ok=True)
+
+    #keep-alive connections are shared by all worker threads
+    pool = ConnectionPool(maxPerHost=maxConnectionsPerHost or numberProcs)
+
+    #remote metadata survives between runs, so unchanged tiles need no (or only a conditional) request
+    if cachePath is None:
+        cachePath = os.path.join(outputDir, '.remoteMetadata.json')
+    cache = RemoteMetadataCache(cachePath, expiry=cacheExpiry*3600, refresh=refresh)
+
+    #division of labour across VMs: keep only this machine's share of the tiles
+    if shard is not None:
+        inputList = select_shard(shard, inputList, baseurl, suffix, pool, cache, numberProcs, outputDir, tag, shardsManifest)
+
+    #tiles finished by an earlier (crashed or interrupted) run with the same tag are skipped
+    journal = DownloadJournal(os.path.join(outputDir, 'downloadJournal-{}.jsonl'.format(tag)))
+    doneTiles = [mapTile for mapTile in inputList if journal.done(mapTile) and journal_file_present(journal.records[mapTile], localFilesPath, outputDir, suffix)]
+    if len(doneTiles) > 0:
+        print('{} tiles already done according to the journal of run {}, skipping them'.format(len(doneTiles), tag))
+        doneTiles = set(doneTiles)
+        previousResults = [[mapTile] + journal.records[mapTile]['result'] for mapTile in inputList if mapTile in doneTiles]
+        inputList = [mapTile for mapTile in inputList if mapTile not in doneTiles]
+    else:
+        previousResults = []
 
-    #Create queues for distributed multiprocessing
-    tasksQueue = multiprocessing.Queue()
-    resultsQueue = multiprocessing.Queue()
+    monitor = TransferMonitor(len(inputList), progressInterval)
+    transferOptions['monitor'] = monitor
+    #numberProcs workers are started, the controller decides how many of them transfer at the same time
+    transferOptions['controller'] = ConcurrencyController(numberProcs, minProcs, adaptive)
+
+    #Create queues for the worker threads
+    tasksQueue = queue.Queue()
+    resultsQueue = queue.Queue()
 
     #add tiles to task queues
     lengthInputList=len(inputList)
     for i in range(lengthInputList):
         tasksQueue.put(inputList[i])
-    for i in range(numberProcs): #add as many None jobs as processes toensure terminantion (queue id FIFO)
+    for i in range(numberProcs): #add as many None jobs as workers toensure terminantion (queue id FIFO)
         tasksQueue.put(None)
 
-    processes = []
-    #start number of user processes corresponding to declared numberProcs
+    workers = []
+    #start number of worker threads corresponding to declared numberProcs
     for i in range(numberProcs):
-        processes.append(multiprocessing.Process(target=runTileDownloadProc,args=(i,tasksQueue,resultsQueue,localFilesPath,outputDir, baseurl, suffix,copylocal)))
-        processes[-1].start()
+        workers.append(threading.Thread(target=runTileDownloadProc,args=(i,tasksQueue,resultsQueue,localFilesPath,outputDir, baseurl, suffix,copylocal,pool,cache),kwargs=transferOptions,daemon=True))
+        workers[-1].start()
 
-    downloadList =[]
+    monitor.start()
+    downloadList = list(previousResults)
     for i in range(lengthInputList):
-        results = resultsQueue.get()
+        results, status, duration = resultsQueue.get()
         downloadList.append(results)
+        journal.append(journal_record(results, status, duration))
         print('Completed {0} of {1} {2} %'.format(i+1, lengthInputList,100.*(float(i+1)/lengthInputList)))
 
     for i in range(numberProcs):
-        processes[i].join()
+        workers[i].join()
+    monitor.stop()
+    print(monitor.summary())
+    journal.close()
+    pool.close()
+    cache.save()
 
     downloadDict = {downloadListElement[0]:downloadListElement[1:] for downloadListElement in downloadList}
 
@@ -254,7 +1057,26 @@ def run(localFilesPath,outputDir, baseurl, suffix, numberProcs tag, inputList=[]
 
 
 
-def runTileDownloadProc(processIndex,tasksQueue,resultsQueue,localFilesPath,outputDir, baseurl, suffix,copylocal):
+def journal_record(results, status, duration):
+    verification = results[6]
+    nBytes = verification['size'] if (results[2] and verification is not None) else 0
+    return {'tile': results[0],
+            'status': status,
+            'bytes': nBytes,
+            'duration': round(duration, 3),
+            'MBps': round(nBytes/2**20/duration, 3) if duration > 0 else None,
+            'finished': datetime.datetime.now().isoformat(),
+            'result': results[1:]}
+
+
+def journal_file_present(record, localFilesPath, outputDir, suffix):
+    """ A journal entry only counts as done if the file it refers to is still there. """
+    directory = localFilesPath if record['status'] == 'uptodate' else outputDir
+    return os.path.isfile(os.path.join(directory, build_filename(record['tile'], suffix)))
+
+
+def runTileDownloadProc(processIndex,tasksQueue,resultsQueue,localFilesPath,outputDir, baseurl, suffix,copylocal,pool,cache=None,**transferOptions):
+    monitor = transferOptions.get('monitor')
     kill_received = False
     while not kill_received:
         mapTile=None
@@ -269,16 +1091,113 @@ def runTileDownloadProc(processIndex,tasksQueue,resultsQueue,localFilesPath,outp
             #terminate on None job
             kill_received=True
         else:
-            wasDownloaded, downloadSucceded, wasCopied, copySucceded = maptile_downloader(mapTile,localFilesPath,outputDir, baseurl, suffix,copylocal)
-            resultsQueue.put([mapTile, processIndex, wasDownloaded, downloadSucceded , wasCopied, copySucceded])
-
+            t0 = time.time()
+            if monitor is not None:
+                monitor.tile_started()
+            try:
+                wasDownloaded, downloadSucceded, wasCopied, copySucceded, verification, status = maptile_downloader(mapTile,localFilesPath,outputDir, baseurl, suffix,copylocal,pool,cache,**transferOptions)
+            except Exception:
+                #always report back, otherwise run() waits forever for this tile
+                print('unexpected failure for tile {}'.format(mapTile))
+                print(traceback.format_exc())
+                wasDownloaded, downloadSucceded, wasCopied, copySucceded, verification, status = False, False, False, False, None, 'failed'
+            if monitor is not None:
+                monitor.tile_finished()
+            #verification (size, digest, point count, bounds) is appended, so older report readers keep working
+            resultsQueue.put(([mapTile, processIndex, wasDownloaded, downloadSucceded , wasCopied, copySucceded, verification], status, time.time() - t0))
+
+
+
+def parse_shard(value):
+    try:
+        index, nShards = [int(part) for part in value.split('/')]
+    except ValueError:
+        raise argparse.ArgumentTypeError('shard must be given as i/N, e.g. 2/8')
+    if not 1 <= index <= nShards:
+        raise argparse.ArgumentTypeError('shard index must be in 1..{}'.format(nShards))
+    return index, nShards
+
+
+def fetch_remote_sizes(mapList, baseurl, suffix, pool, cache, numberThreads):
+    """ Content-Length of every tile (0 if unknown), through the metadata cache so downloads need no second request. """
+    sizes = {}
+    tasksQueue = queue.Queue()
+    for mapTile in mapList:
+        tasksQueue.put(mapTile)
+
+    def runSizeProc():
+        while True:
+            try:
+                mapTile = tasksQueue.get_nowait()
+            except queue.Empty:
+                return
+            try:
+                exists, size, date = check_remote(mapTile, baseurl, suffix, pool, cache)
+            except Exception:
+                exists, size = False, []
+            sizes[mapTile] = size if (exists and isinstance(size, int)) else 0
+
+    threads = [threading.Thread(target=runSizeProc, daemon=True) for i in range(numberThreads)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return sizes
+
+
+def partition_input_list(nShards, mapList, sizes):
+    """
+    Longest-processing-time packing: tiles are handed out largest first,
+    each to the shard with the fewest bytes so far. Ties are broken by tile
+    name and shard number, so equal inputs give the same partition on every
+    machine. Within a shard tiles keep their input order.
+    """
+    order = {mapTile: i for i, mapTile in enumerate(mapList)}
+    shards = [[] for i in range(nShards)]
+    loads = [(0, i) for i in range(nShards)]
+    for mapTile in sorted(mapList, key=lambda mapTile: (-sizes.get(mapTile, 0), mapTile)):
+        load, i = heapq.heappop(loads)
+        shards[i].append(mapTile)
+        heapq.heappush(loads, (load + sizes.get(mapTile, 0), i))
+    return [sorted(shard, key=order.get) for shard in shards]
+
+
+def write_shards_manifest(path, shards, sizes):
+    manifest = {'nShards': len(shards),
+                'bytes': [sum(sizes.get(mapTile, 0) for mapTile in shard) for shard in shards],
+                'shards': shards}
+    with open(path, 'w') as manifestFile:
+        manifestFile.write(json.dumps(manifest, indent=4))
+
+
+def read_shards_manifest(path):
+    with open(path, 'r') as manifestFile:
+        manifest = json.load(manifestFile)
+    return manifest['shards']
+
+
+def select_shard(shard, inputList, baseurl, suffix, pool, cache, numberProcs, outputDir, tag, shardsManifest=None):
+    index, nShards = shard
+    if shardsManifest is not None:
+        shards = read_shards_manifest(shardsManifest)
+        if len(shards) != nShards:
+            raise Exception('Error: shard manifest {} holds {} shards, not {}'.format(shardsManifest, len(shards), nShards))
+    else:
+        print('retrieving remote file sizes to partition {} tiles in {} shards'.format(len(inputList), nShards))
+        sizes = fetch_remote_sizes(inputList, baseurl, suffix, pool, cache, numberProcs)
+        shards = partition_input_list(nShards, inputList, sizes)
+        shardsManifest = os.path.join(outputDir, 'shards-{}.json'.format(tag))
+        write_shards_manifest(shardsManifest, shards, sizes)
+        print('shard sizes (MB): {}'.format(' '.join('{:.0f}'.format(sum(sizes[mapTile] for mapTile in s)/2**20) for s in shards)))
+    print('shard {} of {} from {}: {} tiles'.format(index, nShards, shardsManifest, len(shards[index-1])))
+    return shards[index-1]
 
 
 def split_input_list(nSplit,mapList):
 
     subMapLists =[]
     lengthMapList = len(mapList)
-    lengthSubMapList = np.int(np.floor(lengthMapList/nSplit))
+    lengthSubMapList = int(np.floor(lengthMapList/nSplit))
     lengthFinSubMapList = lengthMapList - ((nSplit-1)*lengthSubMapList)
 
     for i in range(nSplit):
@@ -299,17 +1218,26 @@ def download_list_top10nl():
     return top10nlMapTiles
 
 
+
 def main():
     args = argument_parser().parse_args()
     print('local repository: ', args.localrepository)
     print('output directory/download destination : ',args.outputdirectory)
     print('base url : ',args.baseurl)
-    print('file suffix : ' args.suffix)
-    print('running {} processes'.format(args.proc))
+    print('file suffix : ', args.suffix)
+    if args.fixed:
+        print('running {} concurrent transfers'.format(args.proc))
+    else:
+        print('running {} to {} concurrent transfers, adapting to the server'.format(min(args.minproc, args.proc), args.proc))
     print('copying from local repository: {}'.format(args.copylocal))
     print('run tag is {}'.format(args.tag))
+    if args.refresh:
+        print('revalidating all cached remote metadata')
     if args.inputlist != None:
         print('{} specified as input list'.format(args.inputlist))
+    if args.shardsfrom != None and args.shard == None:
+        print('--shards-from requires --shard. aborting')
+        return
 
 
     
@@ -319,6 +1247,11 @@ def main():
         allMapTiles = download_list_top10nl()
 
 
+    if args.bbox != None or args.polygon != None:
+        catalogue = AHN_tile_catalogue.open_catalogue(args.catalogue, [args.localrepository, args.outputdirectory])
+        allMapTiles = catalogue.select(allMapTiles, bbox=args.bbox, polygon=args.polygon)
+        print('{} tiles intersect the region of interest'.format(len(allMapTiles)))
+
     if len(allMapTiles) == 0:
         print('no tiles specified. aborting')
     else:
@@ -326,6 +1259,7 @@ def main():
         try:
             t0 = time.time()
             print('starting ...')
+            copylocal_val = False
             if args.copylocal == 'False':
                 copylocal_val = False
             elif args.copylocal == 'True':
@@ -333,7 +1267,12 @@ def main():
             else :
                 print('no value for copylocal set')
 
-            run(args.localrepository, args.outputdirectory, args.baseurl, args.suffix, args.proc, args.tag, inputList=allMapTiles,copylocal=copylocal_val)
+            run(args.localrepository, args.outputdirectory, args.baseurl, args.suffix, args.proc, args.tag, inputList=allMapTiles,copylocal=copylocal_val,
+                maxConnectionsPerHost=args.connections, cachePath=args.cache, cacheExpiry=args.cacheexpiry, refresh=args.refresh,
+                shard=args.shard, shardsManifest=args.shardsfrom, progressInterval=args.progressinterval,
+                minProcs=args.minproc, adaptive=not args.fixed,
+                chunkSize=args.chunksize, retries=args.retries, segments=args.segments, segmentMinSize=args.segmentminsize,
+                hashAlgorithm=args.hash)
             print('finished in {} seconds'.format(time.time() - t0))
 
         except:
@@ -0,0 +1,400 @@
+#!/usr/bin/env python3
+
+
+"""
+Benchmark suite for AHN_downloader.py. Used with eEcoLiDAR project
+
+A local HTTP server stands in for the AHN servers (PDOK / fundaments). It
+serves synthetic .LAZ and .laz.zip tiles whose headers pass the download
+verification, supports HEAD, conditional and Range requests and can add
+latency, cap the bandwidth shared by all connections and inject failures
+(503 with Retry-After, connections dropped mid-body).
+
+The downloader is run as a separate process through a number of scenarios
+(cold mirror, warm no-op sync, flaky network, huge-file tail) and tiles/s,
+MB/s, peak memory and the requests the server saw are reported per scenario,
+optionally compared against a stored baseline:
+
+    ./AHN_downloader_benchmark.py --baseline benchmark_baseline.json
+    ./AHN_downloader_benchmark.py --save-baseline benchmark_baseline.json
+
+The comparison is only made with a baseline recorded with the same settings
+(tile set, server and downloader options); otherwise the script exits with
+status 2, while status 1 reports regressions.
+"""
+
+
+
+import argparse, time, sys, os, shutil, threading, json, random, struct, zipfile, tempfile, subprocess
+import email.utils as eut
+import http.server
+
+
+DOWNLOADER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'AHN_downloader.py')
+SERVER_CHUNK_SIZE = 2**16
+RESULT_MARKER = 'BENCHMARK_MAXRSS'
+
+#server settings and downloader arguments per scenario; 'fresh' starts from an empty output directory
+SCENARIOS = [
+    {'name': 'cold_mirror', 'fresh': True, 'tiles': 'regular', 'server': {}, 'args': []},
+    {'name': 'warm_noop_sync', 'fresh': False, 'tiles': 'regular', 'server': {}, 'args': []},
+    {'name': 'flaky_network', 'fresh': True, 'tiles': 'regular', 'server': {'dropRate': 0.1, 'errorRate': 0.05}, 'args': ['--retries', '8']},
+    {'name': 'huge_file_tail', 'fresh': True, 'tiles': 'tail', 'server': {}, 'args': ['--segments', '4', '--segment-min-size', '64']},
+]
+#a lower value than the baseline is a regression for these, a higher one for peak memory
+HIGHER_IS_BETTER = ('tilesPerSecond', 'MBPerSecond')
+LOWER_IS_BETTER = ('peakMemoryMB',)
+
+
+
+def argument_parser():
+    parser = argparse.ArgumentParser(description="""Benchmarks AHN_downloader.py against a local stand-in for the AHN servers
+    serving synthetic tiles, for a number of scenarios, and compares the results with a stored baseline.""")
+
+    parser.add_argument('-n','--tiles',default=40,help='number of synthetic tiles; default is 40',type=int)
+    parser.add_argument('--median-size',dest='mediansize',default=8.,help='median tile size in MB; default is 8',type=float)
+    parser.add_argument('--sigma',default=0.8,help='sigma of the log-normal tile size distribution; default is 0.8',type=float)
+    parser.add_argument('--huge-factor',dest='hugefactor',default=25.,help='size of the huge tile of the huge_file_tail scenario, relative to the median; default is 25',type=float)
+    parser.add_argument('--zip-fraction',dest='zipfraction',default=0.25,help='fraction of tiles served as .laz.zip; default is 0.25',type=float)
+    parser.add_argument('--latency',default=20.,help='latency (ms) added to every response; default is 20',type=float)
+    parser.add_argument('--bandwidth',default=200.,help='bandwidth (MB/s) shared by all connections, 0 for no cap; default is 200',type=float)
+    parser.add_argument('-p','--proc',default=8,help='--proc passed to the downloader; default is 8',type=int)
+    parser.add_argument('-s','--scenarios',default=None,nargs='+',help='scenarios to run; default is all of: {}'.format(' '.join(s['name'] for s in SCENARIOS)))
+    parser.add_argument('--seed',default=42,help='random seed of tile sizes and failures; default is 42',type=int)
+    parser.add_argument('--baseline',default=None,help='baseline results (json) to compare with, recorded with the same settings',type=str)
+    parser.add_argument('--tolerance',default=0.2,help='relative deviation from the baseline reported as regression; default is 0.2',type=float)
+    parser.add_argument('--save-baseline',dest='savebaseline',default=None,help='write the results as new baseline to this file',type=str)
+    parser.add_argument('-o','--output',default=None,help='write the results (json) to this file',type=str)
+    return parser
+
+
+
+def write_synthetic_laz(outputFile, size, rng):
+    """
+    Write a synthetic LAZ file of about `size` bytes: a LAS 1.2 header, a
+    LASzip VLR, random 'compressed' points and a chunk table at the end,
+    consistent enough to pass AHN_laz_validation. Written in blocks, so the
+    benchmark process stays small (its memory is inherited by the downloader).
+    """
+    chunkSize = 50000
+    pointCount = max(1, size//10)
+    nChunks = -(-pointCount//chunkSize)
+    offsetToPoints = 227 + 54 + 34
+    chunkTableSize = 8 + 8*nChunks
+    size = max(size, offsetToPoints + 8 + chunkTableSize)
+    chunkTableOffset = size - chunkTableSize
+
+    header = bytearray(227)
+    header[0:4] = b'LASF'
+    struct.pack_into('<BB', header, 24, 1, 2)
+    struct.pack_into('<HLLBHL', header, 94, 227, offsetToPoints, 1, 1 | 0x80, 28, pointCount)
+    struct.pack_into('<3d', header, 131, 0.001, 0.001, 0.001)
+    struct.pack_into('<6d', header, 179, 5000., 0., 6250., 0., 50., -5.)
+    vlr = struct.pack('<H16sHH32s', 0, b'laszip encoded', 22204, 34, b'')
+    laszip = struct.pack('<HHBBHLLqqH', 2, 0, 3, 4, 0, 0, chunkSize, -1, -1, 0)
+    outputFile.write(bytes(header) + vlr + laszip + struct.pack('<q', chunkTableOffset))
+
+    #random bytes do not compress in transit, like real LAZ; one block repeated is random enough
+    block = rng.randbytes(2**20)
+    remaining = chunkTableOffset - (offsetToPoints + 8)
+    while remaining > 0:
+        outputFile.write(block[:remaining])
+        remaining -= len(block)
+    outputFile.write(struct.pack('<LL', 0, nChunks) + bytes(chunkTableSize - 8))
+
+
+def generate_tiles(directory, nTiles, medianSize, sigma, zipFraction, hugeFactor, rng):
+    """ Write synthetic tiles to directory; returns {'regular': [names], 'tail': [names]}. """
+    os.makedirs(directory, exist_ok=True)
+    names = []
+    for i in range(nTiles):
+        size = int(rng.lognormvariate(0., sigma)*medianSize*2**20)
+        #AHN sheet style names, e.g. C_25GN1.LAZ
+        name = 'C_{:02d}{}{}{}'.format(i//8 + 1, 'ABCDEFGH'[i % 8], 'NZ'[i % 2], 1 + i//2 % 2)
+        if rng.random() < zipFraction:
+            with zipfile.ZipFile(os.path.join(directory, name + '.laz.zip'), 'w', zipfile.ZIP_STORED) as archive:
+                with archive.open(name + '.laz', 'w', force_zip64=True) as member:
+                    write_synthetic_laz(member, size, rng)
+            names.append(name + '.laz.zip')
+        else:
+            with open(os.path.join(directory, name + '.LAZ'), 'wb') as tileFile:
+                write_synthetic_laz(tileFile, size, rng)
+            names.append(name + '.LAZ')
+    hugeName = 'C_99HZ2.LAZ'
+    with open(os.path.join(directory, hugeName), 'wb') as tileFile:
+        write_synthetic_laz(tileFile, int(hugeFactor*medianSize*2**20), rng)
+    return {'regular': names, 'tail': names + [hugeName]}
+
+
+
+class TokenBucket(object):
+    """ Bandwidth cap shared by all connections: every chunk is scheduled after the previous one. """
+
+    def __init__(self, rate):
+        self.rate = rate
+        self._next = 0.
+        self._lock = threading.Lock()
+
+    def consume(self, nBytes):
+        if not self.rate:
+            return
+        with self._lock:
+            now = time.time()
+            self._next = max(self._next, now) + nBytes/self.rate
+            wait = self._next - now
+        if wait > 0:
+            time.sleep(wait)
+
+
+
+class StandInServer(http.server.ThreadingHTTPServer):
+    """ Local stand-in for the AHN servers, settings can be changed between scenarios. """
+
+    daemon_threads = True
+
+    def __init__(self, directory, latency=0., bandwidth=0., seed=0):
+        http.server.ThreadingHTTPServer.__init__(self, ('127.0.0.1', 0), StandInHandler)
+        self.directory = directory
+        self.latency = latency
+        self.bucket = TokenBucket(bandwidth)
+        self.rng = random.Random(seed)
+        self.dropRate = 0.
+        self.errorRate = 0.
+        self.counts = {}
+        self._lock = threading.Lock()
+
+    def count(self, key):
+        with self._lock:
+            self.counts[key] = self.counts.get(key, 0) + 1
+
+    def chance(self, rate):
+        with self._lock:
+            return self.rng.random() < rate
+
+    def configure(self, dropRate=0., errorRate=0.):
+        self.dropRate = dropRate
+        self.errorRate = errorRate
+        self.counts = {}
+
+
+
+class StandInHandler(http.server.BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_empty(self, status, headers=None):
+        self.send_response(status)
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def respond(self, sendBody):
+        self.server.count(self.command)
+        time.sleep(self.server.latency)
+        path = os.path.join(self.server.directory, os.path.basename(self.path))
+        if not os.path.isfile(path):
+            self.send_empty(404)
+            return
+        if self.server.chance(self.server.errorRate):
+            self.server.count('503')
+            self.send_empty(503, {'Retry-After': '1'})
+            return
+
+        stat = os.stat(path)
+        etag = '"{:x}-{:x}"'.format(int(stat.st_mtime), stat.st_size)
+        lastModified = eut.formatdate(stat.st_mtime, usegmt=True)
+        if self.headers.get('If-None-Match') == etag:
+            self.send_empty(304, {'ETag': etag, 'Last-Modified': lastModified})
+            return
+
+        first, last, status = 0, stat.st_size - 1, 200
+        byteRange = self.headers.get('Range')
+        ifRange = self.headers.get('If-Range')
+        if byteRange is not None and (ifRange is None or ifRange in (etag, lastModified)):
+            start, end = byteRange.split('=')[1].split('-')
+            first = int(start)
+            last = min(int(end), stat.st_size - 1) if end else stat.st_size - 1
+            if first >= stat.st_size:
+                self.send_empty(416, {'Content-Range': 'bytes */{}'.format(stat.st_size)})
+                return
+            status = 206
+
+        self.send_response(status)
+        self.send_header('Content-Length', str(last + 1 - first))
+        self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('ETag', etag)
+        self.send_header('Last-Modified', lastModified)
+        if status == 206:
+            self.send_header('Content-Range', 'bytes {}-{}/{}'.format(first, last, stat.st_size))
+        self.end_headers()
+        if not sendBody:
+            return
+
+        #a dropped connection stops somewhere in the body
+        dropAt = None
+        if self.server.chance(self.server.dropRate):
+            self.server.count('dropped')
+            dropAt = first + (last + 1 - first)//3
+        with open(path, 'rb') as tileFile:
+            tileFile.seek(first)
+            position = first
+            while position <= last:
+                chunk = tileFile.read(min(SERVER_CHUNK_SIZE, last + 1 - position))
+                if dropAt is not None and position + len(chunk) > dropAt:
+                    self.close_connection = True
+                    return
+                self.server.bucket.consume(len(chunk))
+                self.wfile.write(chunk)
+                position += len(chunk)
+
+    def do_HEAD(self):
+        self.respond(False)
+
+    def do_GET(self):
+        self.respond(True)
+
+
+
+def run_downloader(urlListPath, outputDir, tag, proc, extraArgs):
+    """ Run AHN_downloader.py in its own process; returns wall time and peak memory (MB). """
+    wrapper = ('import sys, runpy, resource\n'
+               'sys.path.insert(0, {directory!r})\n'
+               'sys.argv = {argv!r}\n'
+               'try:\n'
+               '    runpy.run_path({downloader!r}, run_name="__main__")\n'
+               'finally:\n'
+               '    print({marker!r}, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)\n')
+    argv = [DOWNLOADER, '-l', outputDir, '-o', outputDir, '-i', urlListPath, '-p', str(proc),
+            '-t', tag, '--progress-interval', '0'] + extraArgs
+    code = wrapper.format(directory=os.path.dirname(DOWNLOADER), argv=argv, downloader=DOWNLOADER, marker=RESULT_MARKER)
+
+    t0 = time.time()
+    completed = subprocess.run([sys.executable, '-c', code], stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True)
+    duration = time.time() - t0
+
+    peakMemory = None
+    for line in completed.stdout.splitlines():
+        if line.startswith(RESULT_MARKER):
+            #ru_maxrss is in kB on Linux
+            peakMemory = int(line.split()[1])/1024.
+    if 'Execution failed.' in completed.stdout:
+        print(completed.stdout)
+    return duration, peakMemory
+
+
+def read_report(outputDir, tag):
+    with open(os.path.join(outputDir, 'downloadList-{}-latest.js'.format(tag)), 'r') as reportFile:
+        return json.load(reportFile)
+
+
+def run_scenario(scenario, server, baseurl, tileSets, workDir, proc):
+    print('running scenario {} ...'.format(scenario['name']))
+    outputDir = os.path.join(workDir, 'mirror')
+    if scenario['fresh'] and os.path.isdir(outputDir):
+        shutil.rmtree(outputDir)
+    os.makedirs(outputDir, exist_ok=True)
+
+    names = tileSets[scenario['tiles']]
+    urlListPath = os.path.join(workDir, 'urls-{}.txt'.format(scenario['name']))
+    with open(urlListPath, 'w') as urlList:
+        urlList.write(''.join('{}/{}\n'.format(baseurl, name) for name in names))
+
+    server.configure(**scenario['server'])
+    duration, peakMemory = run_downloader(urlListPath, outputDir, scenario['name'], proc, scenario['args'])
+    report = read_report(outputDir, scenario['name'])
+
+    nBytes = sum(entry[5]['size'] for entry in report.values() if entry[1] and len(entry) > 5 and entry[5])
+    failed = sum(1 for entry in report.values() if entry[1] and not entry[2])
+    return {'tiles': len(names),
+            'downloaded': sum(1 for entry in report.values() if entry[1] and entry[2]),
+            'failed': failed,
+            'MB': round(nBytes/2**20, 1),
+            'seconds': round(duration, 2),
+            'tilesPerSecond': round(len(names)/duration, 2),
+            'MBPerSecond': round(nBytes/2**20/duration, 2),
+            'peakMemoryMB': round(peakMemory, 1) if peakMemory is not None else None,
+            'requests': dict(server.counts)}
+
+
+def compare_with_baseline(results, baseline, tolerance):
+    """ Print the relative change of every metric; returns the regressions found. """
+    regressions = []
+    for name, result in results.items():
+        if name not in baseline['results']:
+            continue
+        for metric in HIGHER_IS_BETTER + LOWER_IS_BETTER:
+            old, new = baseline['results'][name].get(metric), result.get(metric)
+            if not old or new is None:
+                continue
+            change = (new - old)/old
+            worse = -change if metric in HIGHER_IS_BETTER else change
+            flag = ''
+            if worse > tolerance:
+                flag = '  REGRESSION'
+                regressions.append((name, metric, old, new))
+            print('{:16s} {:15s} {:10.2f} -> {:10.2f} ({:+.0%}){}'.format(name, metric, old, new, change, flag))
+    return regressions
+
+
+def main():
+    args = argument_parser().parse_args()
+    scenarios = [s for s in SCENARIOS if args.scenarios is None or s['name'] in args.scenarios]
+    if args.scenarios is not None and 'warm_noop_sync' in args.scenarios and 'cold_mirror' not in args.scenarios:
+        print('warm_noop_sync syncs the mirror of cold_mirror, adding it')
+        scenarios.insert(0, SCENARIOS[0])
+
+    workDir = tempfile.mkdtemp(prefix='ahn_benchmark_')
+    try:
+        rng = random.Random(args.seed)
+        print('generating {} synthetic tiles ...'.format(args.tiles))
+        tileSets = generate_tiles(os.path.join(workDir, 'server'), args.tiles, args.mediansize, args.sigma, args.zipfraction, args.hugefactor, rng)
+
+        server = StandInServer(os.path.join(workDir, 'server'), latency=args.latency/1000., bandwidth=args.bandwidth*2**20, seed=args.seed)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        baseurl = 'http://127.0.0.1:{}'.format(server.server_address[1])
+
+        results = {}
+        for scenario in scenarios:
+            results[scenario['name']] = run_scenario(scenario, server, baseurl, tileSets, workDir, args.proc)
+        server.shutdown()
+    finally:
+        shutil.rmtree(workDir, ignore_errors=True)
+
+    print('\n{:16s} {:>6s} {:>7s} {:>9s} {:>8s} {:>8s} {:>8s}  requests'.format('scenario', 'tiles', 'failed', 'MB', 'tiles/s', 'MB/s', 'peak MB'))
+    for name, result in results.items():
+        print('{:16s} {:6d} {:7d} {:9.1f} {:8.2f} {:8.2f} {:8.1f}  {}'.format(name, result['tiles'], result['failed'], result['MB'],
+              result['tilesPerSecond'], result['MBPerSecond'], result['peakMemoryMB'] or 0., result['requests']))
+
+    settings = {key: value for key, value in vars(args).items() if key not in ('baseline', 'savebaseline', 'output', 'scenarios', 'tolerance')}
+    document = {'settings': settings, 'results': results}
+    if args.output is not None:
+        with open(args.output, 'w') as outputFile:
+            outputFile.write(json.dumps(document, indent=4))
+    if args.savebaseline is not None:
+        with open(args.savebaseline, 'w') as baselineFile:
+            baselineFile.write(json.dumps(document, indent=4))
+        print('baseline written to {}'.format(args.savebaseline))
+
+    if args.baseline is not None:
+        with open(args.baseline, 'r') as baselineFile:
+            baseline = json.load(baselineFile)
+        if baseline['settings'] != settings:
+            #results of other tile sets, server or downloader settings cannot be compared
+            differences = ['{}: {} (baseline {})'.format(key, settings.get(key), baseline['settings'].get(key))
+                           for key in sorted(set(settings) | set(baseline['settings']))
+                           if settings.get(key) != baseline['settings'].get(key)]
+            print('not compared with baseline {}, it was recorded with different settings: {}'.format(args.baseline, ', '.join(differences)), file=sys.stderr)
+            #exit status 2 as for invalid arguments, 1 is kept for regressions
+            sys.exit(2)
+        print('\ncomparison with baseline {}'.format(args.baseline))
+        regressions = compare_with_baseline(results, baseline, args.tolerance)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
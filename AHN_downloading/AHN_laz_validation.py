@@ -0,0 +1,232 @@
+#!/usr/bin/env python3
+
+
+"""
+Integrity checks for downloaded (AHN) point cloud tiles. Used with eEcoLiDAR project
+
+Only headers are read: the LAS public header block, the variable length
+records and, for LAZ, the chunk table offset and chunk count. Nothing is
+decompressed, so a tile of several GB is checked in milliseconds. Truncated
+LAZ files are caught because LASzip writes the chunk table after the point
+data, at the very end of the file.
+
+Can also be run stand alone on files already on disk:
+    ./AHN_laz_validation.py /project/lidarac/Data/AHN4/*.LAZ
+"""
+
+
+
+import sys, os, struct, zipfile, hashlib, json
+
+
+DEFAULT_HASH = 'sha256'
+HASH_CHUNK_SIZE = 2**20
+
+LAS_SIGNATURE = b'LASF'
+LAS_HEADER_MIN_SIZE = 227
+LAS_VLR_HEADER_SIZE = 54
+LASZIP_USER_ID = b'laszip encoded'
+LASZIP_RECORD_ID = 22204
+LASZIP_VARIABLE_CHUNK_SIZE = 0xFFFFFFFF
+#bytes needed to parse header and VLRs of any AHN tile; the rest of the file is never read for this
+HEADER_READ_SIZE = 2**16
+
+
+
+class LasValidationError(ValueError):
+    """ A LAS/LAZ file is truncated or its header is inconsistent. """
+
+
+
+def parse_las_header(data):
+    """
+    Parse the LAS public header block from the first bytes of a file.
+    Returns a dict with version, point format, record length, point count,
+    bounds and the offset to the point data.
+    """
+    if len(data) < LAS_HEADER_MIN_SIZE:
+        raise LasValidationError('file too short for a LAS header ({} bytes)'.format(len(data)))
+    if data[0:4] != LAS_SIGNATURE:
+        raise LasValidationError('no LASF signature')
+
+    versionMajor, versionMinor = struct.unpack_from('<BB', data, 24)
+    if versionMajor != 1 or versionMinor > 4:
+        raise LasValidationError('unsupported LAS version {}.{}'.format(versionMajor, versionMinor))
+    headerSize, offsetToPoints, nVlrs, pointFormat, recordLength, legacyPointCount = struct.unpack_from('<HLLBHL', data, 94)
+    scale = struct.unpack_from('<3d', data, 131)
+    offset = struct.unpack_from('<3d', data, 155)
+    maxX, minX, maxY, minY, maxZ, minZ = struct.unpack_from('<6d', data, 179)
+
+    pointCount = legacyPointCount
+    if versionMinor >= 4:
+        if len(data) < 255:
+            raise LasValidationError('file too short for a LAS 1.4 header')
+        pointCount = struct.unpack_from('<Q', data, 247)[0] or legacyPointCount
+
+    if headerSize < LAS_HEADER_MIN_SIZE or offsetToPoints < headerSize:
+        raise LasValidationError('inconsistent header size {} / offset to point data {}'.format(headerSize, offsetToPoints))
+    if pointCount > 0 and not (minX <= maxX and minY <= maxY and minZ <= maxZ):
+        raise LasValidationError('inconsistent bounds')
+
+    return {'version': '{}.{}'.format(versionMajor, versionMinor),
+            'headerSize': headerSize,
+            'offsetToPoints': offsetToPoints,
+            'nVlrs': nVlrs,
+            #bits 6 and 7 of the point format flag LAZ compression
+            'compressed': bool(pointFormat & 0xC0),
+            'pointFormat': pointFormat & 0x3F,
+            'recordLength': recordLength,
+            'pointCount': pointCount,
+            'scale': list(scale),
+            'offset': list(offset),
+            'bounds': [minX, minY, minZ, maxX, maxY, maxZ]}
+
+
+def parse_laszip_vlr(data, header):
+    """ Return the chunk size of the LASzip VLR, or None if the file has no LASzip VLR. """
+    position = header['headerSize']
+    for i in range(header['nVlrs']):
+        if position + LAS_VLR_HEADER_SIZE > len(data):
+            raise LasValidationError('VLRs exceed header data')
+        userId, recordId, recordLength = struct.unpack_from('<2x16sHH', data, position)
+        position += LAS_VLR_HEADER_SIZE
+        if userId.rstrip(b'\0') == LASZIP_USER_ID and recordId == LASZIP_RECORD_ID:
+            if position + 34 > len(data):
+                raise LasValidationError('LASzip VLR exceeds header data')
+            compressor, = struct.unpack_from('<H', data, position)
+            chunkSize, = struct.unpack_from('<L', data, position + 12)
+            return {'compressor': compressor, 'chunkSize': chunkSize}
+        position += recordLength
+    if position > header['offsetToPoints']:
+        raise LasValidationError('VLRs overlap point data')
+    return None
+
+
+def validate_las(path):
+    """
+    Validate a LAS/LAZ file on disk. Raises LasValidationError if it is
+    truncated or inconsistent, otherwise returns the parsed header.
+    """
+    fileSize = os.path.getsize(path)
+    with open(path, 'rb') as lasFile:
+        data = lasFile.read(HEADER_READ_SIZE)
+        header = parse_las_header(data)
+        if fileSize < header['offsetToPoints']:
+            raise LasValidationError('file ends before point data')
+        if len(data) < header['offsetToPoints']:
+            data += lasFile.read(header['offsetToPoints'] - len(data))
+
+        if not header['compressed']:
+            expectedSize = header['offsetToPoints'] + header['pointCount']*header['recordLength']
+            if fileSize < expectedSize:
+                raise LasValidationError('file size {} smaller than the {} bytes of {} points'.format(fileSize, expectedSize, header['pointCount']))
+            return header
+
+        laszip = parse_laszip_vlr(data, header)
+        if laszip is None:
+            raise LasValidationError('compressed point format without LASzip VLR')
+        header['chunkSize'] = laszip['chunkSize']
+        if laszip['compressor'] == 1:
+            #pointwise compression has no chunk table
+            return header
+
+        lasFile.seek(header['offsetToPoints'])
+        chunkTableOffset, = struct.unpack('<q', lasFile.read(8))
+        if chunkTableOffset == -1:
+            #writer could not seek back: the offset is stored in the last 8 bytes
+            lasFile.seek(fileSize - 8)
+            chunkTableOffset, = struct.unpack('<q', lasFile.read(8))
+        if not header['offsetToPoints'] + 8 <= chunkTableOffset <= fileSize - 8:
+            raise LasValidationError('chunk table offset {} outside file of {} bytes (truncated?)'.format(chunkTableOffset, fileSize))
+        lasFile.seek(chunkTableOffset)
+        chunkTableVersion, nChunks = struct.unpack('<LL', lasFile.read(8))
+        if chunkTableVersion != 0:
+            raise LasValidationError('unknown chunk table version {}'.format(chunkTableVersion))
+        if header['chunkSize'] != LASZIP_VARIABLE_CHUNK_SIZE and header['chunkSize'] > 0:
+            expectedChunks = -(-header['pointCount'] // header['chunkSize'])
+            if nChunks != expectedChunks:
+                raise LasValidationError('{} chunks in chunk table, {} expected for {} points'.format(nChunks, expectedChunks, header['pointCount']))
+        header['nChunks'] = nChunks
+
+    return header
+
+
+def validate_zip(path):
+    """
+    Validate a zip archive (e.g. AHN1/2 .laz.zip) through its central directory,
+    which is written at the end of the archive. Headers of LAS/LAZ members are
+    checked from their first bytes; the returned dict describes the first one.
+    """
+    try:
+        with zipfile.ZipFile(path) as archive:
+            header = {'members': archive.namelist()}
+            for info in archive.infolist():
+                if os.path.splitext(info.filename)[1].lower() in ('.las', '.laz'):
+                    with archive.open(info) as member:
+                        memberHeader = parse_las_header(member.read(HEADER_READ_SIZE))
+                    if info.file_size < memberHeader['offsetToPoints']:
+                        raise LasValidationError('member {} ends before point data'.format(info.filename))
+                    memberHeader.update(header)
+                    return memberHeader
+    except (zipfile.BadZipFile, EOFError) as e:
+        raise LasValidationError('broken zip archive: {}'.format(e))
+    return header
+
+
+def file_digest(path, algorithm=DEFAULT_HASH, chunkSize=HASH_CHUNK_SIZE):
+    digest = hashlib.new(algorithm)
+    with open(path, 'rb') as inputFile:
+        while True:
+            chunk = inputFile.read(chunkSize)
+            if not chunk:
+                break
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def verify_tile(path, filename=None, expectedSize=None, digest=None, algorithm=DEFAULT_HASH):
+    """
+    Verify a downloaded tile. filename decides the file type (path may be a
+    .part file); digest is the hex digest computed while streaming, it is
+    computed from disk if not given. Returns the verification record stored
+    in the download report.
+    """
+    filename = filename or os.path.basename(path)
+    size = os.path.getsize(path)
+    verification = {'valid': True, 'error': None, 'size': size,
+                    'hash': algorithm, 'digest': digest or file_digest(path, algorithm)}
+
+    try:
+        if expectedSize is not None and size != expectedSize:
+            raise LasValidationError('size {} does not match Content-Length {}'.format(size, expectedSize))
+        extension = os.path.splitext(filename)[1].lower()
+        header = None
+        if extension in ('.las', '.laz'):
+            header = validate_las(path)
+        elif extension == '.zip':
+            header = validate_zip(path)
+        if header is not None and 'pointCount' in header:
+            verification.update({'version': header['version'],
+                                 'pointFormat': header['pointFormat'],
+                                 'pointCount': header['pointCount'],
+                                 'bounds': header['bounds']})
+    except (LasValidationError, struct.error, OSError) as e:
+        verification['valid'] = False
+        verification['error'] = str(e)
+
+    return verification
+
+
+def main():
+    results = {}
+    for path in sys.argv[1:]:
+        results[path] = verify_tile(path)
+        if not results[path]['valid']:
+            print('{}: {}'.format(path, results[path]['error']), file=sys.stderr)
+    print(json.dumps(results, indent=4))
+    if not all(result['valid'] for result in results.values()):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,417 @@
+#!/usr/bin/env python3
+
+
+"""
+Spatial catalogue of AHN tiles (TOP10NL map sheets). Used with eEcoLiDAR project
+
+Maps sheet codes such as 25DZ2, C_02EZ1.LAZ or g25dz2 to their bounding box
+in RD New (EPSG:28992) and selects the tiles intersecting a bounding box or a
+polygon (GeoJSON, or shapefile if osgeo is available), so downloads and
+processing can be restricted to e.g. one province or one Natura2000 site.
+
+Sheets are 5000 m x 6250 m cells of a lattice aligned to the RD origin. The
+catalogue is built from what is known for certain instead of a hard-coded
+sheet layout: an official sheet index (GeoJSON/shapefile), the bounds in the
+LAS headers of tiles on disk, or the bounds recorded in download reports.
+Within a 1:25000 sheet (e.g. 25D) the four tiles follow from any one of them:
+N is the northern and Z the southern half, 1 the western and 2 the eastern part.
+
+From a notebook:
+    sys.path.append('../AHN_downloading')
+    from AHN_tile_catalogue import open_catalogue
+    catalogue = open_catalogue('/project/lidarac/Data/AHN4/tileCatalogue.json')
+    laz_files = catalogue.select(laz_files, bbox=(150000., 450000., 170000., 470000.))
+"""
+
+
+
+import argparse, sys, os, re, json, glob, math
+
+import AHN_laz_validation
+
+try:
+    from osgeo import ogr
+except ImportError:
+    ogr = None
+
+
+SHEET_WIDTH = 5000.
+SHEET_HEIGHT = 6250.
+CATALOGUE_FILENAME = 'tileCatalogue.json'
+CRS = 'EPSG:28992'
+#sheet code within a file name or url: optional product prefix (C_, g, i), sheet number, letter, half, part
+SHEET_CODE = re.compile(r'(?<![0-9A-Za-z])(?:[A-Za-z]_?)?(\d{1,2})([A-Ha-h])([NZnz])([12])(?![0-9A-Za-z])')
+
+
+
+def parse_sheet_code(item):
+    """ Normalised sheet code (e.g. 02EZ1) of a code, file name, path or url; None if there is none. """
+    match = SHEET_CODE.search(os.path.basename(item.rstrip('/')))
+    if match is None:
+        return None
+    sheet, letter, half, part = match.groups()
+    return '{:02d}{}{}{}'.format(int(sheet), letter.upper(), half.upper(), part)
+
+
+def snap_to_sheet(bounds):
+    """ Sheet box (minx, miny, maxx, maxy) of the lattice cell holding the centre of bounds. """
+    centreX = 0.5*(bounds[0] + bounds[2])
+    centreY = 0.5*(bounds[1] + bounds[3])
+    ix = math.floor(centreX/SHEET_WIDTH)
+    iy = math.floor(centreY/SHEET_HEIGHT)
+    return (ix*SHEET_WIDTH, iy*SHEET_HEIGHT, (ix + 1)*SHEET_WIDTH, (iy + 1)*SHEET_HEIGHT)
+
+
+def boxes_intersect(a, b):
+    #touching edges do not count: a bbox on a sheet border selects one sheet, not two
+    return a[0] < b[2] and b[0] < a[2] and a[1] < b[3] and b[1] < a[3]
+
+
+
+def geometry_to_polygons(geometry):
+    """ Polygons (lists of rings of (x, y)) of a GeoJSON Polygon or MultiPolygon geometry. """
+    if geometry['type'] == 'Polygon':
+        return [[[tuple(point[:2]) for point in ring] for ring in geometry['coordinates']]]
+    elif geometry['type'] == 'MultiPolygon':
+        return [[[tuple(point[:2]) for point in ring] for ring in polygon] for polygon in geometry['coordinates']]
+    raise ValueError('unsupported geometry type {}'.format(geometry['type']))
+
+
+def read_features(path):
+    """ (properties, geometry) of every feature in a GeoJSON file, or a shapefile if osgeo is available. """
+    if path.lower().endswith('.shp'):
+        if ogr is None:
+            raise ImportError('reading shapefiles requires osgeo (GDAL); convert {} to GeoJSON or install GDAL'.format(path))
+        dataSource = ogr.Open(path)
+        layer = dataSource.GetLayer()
+        spatialReference = layer.GetSpatialRef()
+        if spatialReference is not None and spatialReference.GetAuthorityCode(None) not in (None, '28992'):
+            raise ValueError('{} is not in RD New ({})'.format(path, CRS))
+        features = []
+        for feature in layer:
+            geometry = feature.GetGeometryRef()
+            features.append((feature.items(), json.loads(geometry.ExportToJson()) if geometry is not None else None))
+        return features
+
+    with open(path, 'r') as inputFile:
+        document = json.load(inputFile)
+    crs = document.get('crs', {}).get('properties', {}).get('name', '28992')
+    if '28992' not in crs:
+        raise ValueError('{} is not in RD New ({}) but in {}'.format(path, CRS, crs))
+    if document['type'] == 'FeatureCollection':
+        return [(feature.get('properties') or {}, feature['geometry']) for feature in document['features']]
+    elif document['type'] == 'Feature':
+        return [(document.get('properties') or {}, document['geometry'])]
+    return [({}, document)]
+
+
+def read_polygon(path):
+    """ All polygons of a GeoJSON file or shapefile (RD New) as one multi-polygon. """
+    polygons = []
+    for properties, geometry in read_features(path):
+        if geometry is not None:
+            polygons.extend(geometry_to_polygons(geometry))
+    if not polygons:
+        raise ValueError('no polygons in {}'.format(path))
+    return polygons
+
+
+def polygons_bounds(polygons):
+    xs = [x for polygon in polygons for x, y in polygon[0]]
+    ys = [y for polygon in polygons for x, y in polygon[0]]
+    return (min(xs), min(ys), max(xs), max(ys))
+
+
+def point_in_polygon(x, y, polygon):
+    """ Even-odd rule over all rings, so points in holes are outside. """
+    inside = False
+    for ring in polygon:
+        for (x1, y1), (x2, y2) in zip(ring, ring[1:] + ring[:1]):
+            if (y1 > y) != (y2 > y) and x < x1 + (y - y1)*(x2 - x1)/(y2 - y1):
+                inside = not inside
+    return inside
+
+
+def segments_intersect(p1, p2, q1, q2):
+    def orientation(a, b, c):
+        value = (b[0] - a[0])*(c[1] - a[1]) - (b[1] - a[1])*(c[0] - a[0])
+        return (value > 0) - (value < 0)
+    return (orientation(p1, p2, q1) != orientation(p1, p2, q2)
+            and orientation(q1, q2, p1) != orientation(q1, q2, p2))
+
+
+def polygon_intersects_box(polygons, box):
+    """ True if any of the polygons overlaps the interior of box. """
+    corners = [(box[0], box[1]), (box[2], box[1]), (box[2], box[3]), (box[0], box[3])]
+    edges = list(zip(corners, corners[1:] + corners[:1]))
+    for polygon in polygons:
+        ring = polygon[0]
+        xs = [x for x, y in ring]
+        ys = [y for x, y in ring]
+        if not boxes_intersect((min(xs), min(ys), max(xs), max(ys)), box):
+            continue
+        #box inside the polygon (and not in a hole) or polygon inside the box
+        if point_in_polygon(0.5*(box[0] + box[2]), 0.5*(box[1] + box[3]), polygon):
+            return True
+        if any(box[0] < x < box[2] and box[1] < y < box[3] for x, y in ring):
+            return True
+        for ring in polygon:
+            for segment in zip(ring, ring[1:] + ring[:1]):
+                if any(segments_intersect(segment[0], segment[1], edge[0], edge[1]) for edge in edges):
+                    return True
+    return False
+
+
+
+class TileCatalogue(object):
+    """
+    Sheet code -> RD New bounding box, with a grid index on the sheet lattice
+    so that bbox and polygon queries only look at nearby sheets.
+    """
+
+    def __init__(self, boxes=None):
+        self.boxes = {}
+        self._index = {}
+        for code, box in (boxes or {}).items():
+            self.add(code, box)
+
+    def __len__(self):
+        return len(self.boxes)
+
+    def __contains__(self, code):
+        return parse_sheet_code(code) in self.boxes
+
+    def _cells(self, box):
+        for ix in range(math.floor(box[0]/SHEET_WIDTH), math.ceil(box[2]/SHEET_WIDTH)):
+            for iy in range(math.floor(box[1]/SHEET_HEIGHT), math.ceil(box[3]/SHEET_HEIGHT)):
+                yield ix, iy
+
+    def add(self, item, box):
+        code = parse_sheet_code(item)
+        if code is None:
+            raise ValueError('not a sheet code: {}'.format(item))
+        box = tuple(float(value) for value in box)
+        if code in self.boxes:
+            if self.boxes[code] == box:
+                return
+            for cell in self._cells(self.boxes[code]):
+                self._index[cell].discard(code)
+        self.boxes[code] = box
+        for cell in self._cells(box):
+            self._index.setdefault(cell, set()).add(code)
+
+    def get(self, code):
+        return self.boxes.get(parse_sheet_code(code))
+
+    def update(self, other):
+        for code, box in other.boxes.items():
+            self.add(code, box)
+
+    def complete(self):
+        """ Add the missing tiles of every 1:25000 sheet of which one tile is known. """
+        for code, box in list(self.boxes.items()):
+            westX = box[0] - (SHEET_WIDTH if code[4] == '2' else 0.)
+            southY = box[1] - (SHEET_HEIGHT if code[3] == 'N' else 0.)
+            for half, y in (('N', southY + SHEET_HEIGHT), ('Z', southY)):
+                for part, x in (('1', westX), ('2', westX + SHEET_WIDTH)):
+                    sibling = code[:3] + half + part
+                    if sibling not in self.boxes:
+                        self.add(sibling, (x, y, x + SHEET_WIDTH, y + SHEET_HEIGHT))
+        return self
+
+    def query_bbox(self, bbox):
+        """ Sheet codes whose box intersects bbox (minx, miny, maxx, maxy). """
+        candidates = set()
+        for cell in self._cells(bbox):
+            candidates.update(self._index.get(cell, ()))
+        return sorted(code for code in candidates if boxes_intersect(self.boxes[code], bbox))
+
+    def query_polygon(self, polygons):
+        """ Sheet codes whose box intersects any of the polygons. """
+        return [code for code in self.query_bbox(polygons_bounds(polygons))
+                if polygon_intersects_box(polygons, self.boxes[code])]
+
+    def select(self, items, bbox=None, polygon=None):
+        """
+        Items (codes, file names or urls) of the sheets intersecting bbox and/or
+        polygon, in input order. Items the catalogue does not know are dropped
+        with a warning. polygon is a path or a list of polygons.
+        """
+        if bbox is None and polygon is None:
+            return list(items)
+        if isinstance(polygon, str):
+            polygon = read_polygon(polygon)
+        codes = set(self.query_bbox(bbox)) if bbox is not None else None
+        if polygon is not None:
+            polygonCodes = set(self.query_polygon(polygon))
+            codes = polygonCodes if codes is None else codes & polygonCodes
+
+        selected, unknown = [], []
+        for item in items:
+            code = parse_sheet_code(item)
+            if code is None or code not in self.boxes:
+                unknown.append(item)
+            elif code in codes:
+                selected.append(item)
+        if unknown:
+            print('{} tiles not in the tile catalogue, left out of the selection (e.g. {})'.format(len(unknown), unknown[0]))
+        return selected
+
+    def save(self, path):
+        document = {'crs': CRS, 'tiles': {code: list(box) for code, box in sorted(self.boxes.items())}}
+        with open(path + '.tmp', 'w') as outputFile:
+            outputFile.write(json.dumps(document, indent=1))
+        os.replace(path + '.tmp', path)
+
+    @classmethod
+    def load(cls, path):
+        with open(path, 'r') as inputFile:
+            document = json.load(inputFile)
+        return cls(document['tiles'])
+
+    @classmethod
+    def from_sheet_index(cls, path, codeField=None):
+        """ Catalogue from an official sheet index (GeoJSON or shapefile with one polygon per sheet). """
+        catalogue = cls()
+        for properties, geometry in read_features(path):
+            if geometry is None:
+                continue
+            if codeField is not None:
+                code = parse_sheet_code(str(properties[codeField]))
+            else:
+                codes = [parse_sheet_code(str(value)) for value in properties.values() if value is not None]
+                code = next((code for code in codes if code is not None), None)
+            if code is not None:
+                catalogue.add(code, polygons_bounds(geometry_to_polygons(geometry)))
+        return catalogue
+
+    @classmethod
+    def from_las_files(cls, paths):
+        """ Catalogue from the header bounds of LAS/LAZ (or .laz.zip) tiles, snapped to the sheet lattice. """
+        catalogue = cls()
+        for path in paths:
+            code = parse_sheet_code(path)
+            if code is None:
+                continue
+            try:
+                if path.lower().endswith('.zip'):
+                    header = AHN_laz_validation.validate_zip(path)
+                else:
+                    with open(path, 'rb') as lasFile:
+                        header = AHN_laz_validation.parse_las_header(lasFile.read(AHN_laz_validation.HEADER_READ_SIZE))
+            except (AHN_laz_validation.LasValidationError, OSError) as e:
+                print('no bounds for {}: {}'.format(path, e))
+                continue
+            if header.get('pointCount'):
+                minX, minY, minZ, maxX, maxY, maxZ = header['bounds']
+                catalogue.add(code, snap_to_sheet((minX, minY, maxX, maxY)))
+        return catalogue
+
+    @classmethod
+    def from_download_report(cls, path):
+        """ Catalogue from the bounds recorded in a download report (downloadList-<tag>-latest.js). """
+        with open(path, 'r') as inputFile:
+            report = json.load(inputFile)
+        catalogue = cls()
+        for item, entry in report.items():
+            verification = entry[5] if len(entry) > 5 else None
+            code = parse_sheet_code(item)
+            if code is not None and verification and verification.get('pointCount'):
+                minX, minY, minZ, maxX, maxY, maxZ = verification['bounds']
+                catalogue.add(code, snap_to_sheet((minX, minY, maxX, maxY)))
+        return catalogue
+
+
+
+def open_catalogue(path=None, tileDirectories=()):
+    """
+    Catalogue from path (catalogue json, sheet index GeoJSON/shapefile or
+    download report .js). Without path, tileCatalogue.json in the first tile
+    directory is used; if it does not exist yet it is built from the LAS
+    headers and download reports found in the tile directories, and saved.
+    """
+    if path is not None:
+        if path.lower().endswith('.js'):
+            return TileCatalogue.from_download_report(path).complete()
+        if path.lower().endswith('.shp'):
+            return TileCatalogue.from_sheet_index(path)
+        with open(path, 'r') as inputFile:
+            document = json.load(inputFile)
+        if 'tiles' in document:
+            return TileCatalogue(document['tiles'])
+        return TileCatalogue.from_sheet_index(path)
+
+    if not tileDirectories:
+        raise ValueError('either a catalogue path or tile directories are needed')
+    path = os.path.join(tileDirectories[0], CATALOGUE_FILENAME)
+    if os.path.isfile(path):
+        return TileCatalogue.load(path)
+
+    print('building tile catalogue {} from tile headers and download reports'.format(path))
+    catalogue = TileCatalogue()
+    for directory in tileDirectories:
+        for report in sorted(glob.glob(os.path.join(directory, 'downloadList-*-latest.js'))):
+            catalogue.update(TileCatalogue.from_download_report(report))
+        tiles = [os.path.join(directory, name) for name in sorted(os.listdir(directory))
+                 if name.lower().endswith(('.las', '.laz', '.laz.zip'))]
+        catalogue.update(TileCatalogue.from_las_files(tiles))
+    catalogue.complete()
+    if len(catalogue) > 0:
+        catalogue.save(path)
+    return catalogue
+
+
+def grid_tiles(grid, bbox=None, polygon=None):
+    """
+    Labels (tile_<x>_<y>) of the tiles of a laserfarm retiling grid dict that
+    intersect bbox and/or polygon, so that later stages can target the same
+    region as the download.
+    """
+    tileWidth = (grid['max_x'] - grid['min_x'])/grid['n_tiles_side']
+    tileHeight = (grid['max_y'] - grid['min_y'])/grid['n_tiles_side']
+    if isinstance(polygon, str):
+        polygon = read_polygon(polygon)
+    region = bbox if bbox is not None else polygons_bounds(polygon)
+    labels = []
+    firstX = max(0, math.floor((region[0] - grid['min_x'])/tileWidth))
+    lastX = min(grid['n_tiles_side'], math.ceil((region[2] - grid['min_x'])/tileWidth))
+    firstY = max(0, math.floor((region[1] - grid['min_y'])/tileHeight))
+    lastY = min(grid['n_tiles_side'], math.ceil((region[3] - grid['min_y'])/tileHeight))
+    for tileX in range(firstX, lastX):
+        for tileY in range(firstY, lastY):
+            box = (grid['min_x'] + tileX*tileWidth, grid['min_y'] + tileY*tileHeight,
+                   grid['min_x'] + (tileX + 1)*tileWidth, grid['min_y'] + (tileY + 1)*tileHeight)
+            if bbox is not None and not boxes_intersect(box, bbox):
+                continue
+            if polygon is not None and not polygon_intersects_box(polygon, box):
+                continue
+            labels.append('tile_{}_{}'.format(tileX, tileY))
+    return labels
+
+
+
+def argument_parser():
+    parser = argparse.ArgumentParser(description="""Builds the AHN tile catalogue (sheet code -> RD New bounding box) and lists
+    the tiles intersecting a bounding box or polygon.""")
+
+    parser.add_argument('-c','--catalogue',default=None,help='catalogue json, sheet index (GeoJSON/shapefile) or download report to read',type=str)
+    parser.add_argument('-d','--directories',default=[],nargs='+',help='tile directories to build the catalogue from if no catalogue is given',type=str)
+    parser.add_argument('--bbox',default=None,nargs=4,type=float,metavar=('MINX','MINY','MAXX','MAXY'),help='bounding box in RD New')
+    parser.add_argument('--polygon',default=None,help='GeoJSON or shapefile (RD New) with the region of interest',type=str)
+    parser.add_argument('--save',default=None,help='write the catalogue to this json file',type=str)
+    return parser
+
+
+def main():
+    args = argument_parser().parse_args()
+    catalogue = open_catalogue(args.catalogue, args.directories)
+    print('{} tiles in catalogue'.format(len(catalogue)), file=sys.stderr)
+    if args.save is not None:
+        catalogue.save(args.save)
+    if args.bbox is not None or args.polygon is not None:
+        for code in catalogue.select(sorted(catalogue.boxes), args.bbox, args.polygon):
+            print(code)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,320 @@
+"""
+Vectorized extraction of the features of the points in square target cells.
+
+With 'volume_type': 'cell' and a volume size equal to the target mesh size,
+every feature of the feature extraction notebooks is an aggregation over the
+points that share a cell. Instead of running the laserchicken extractors
+target by target, CellFeatures takes the points sorted by cell (as given by
+AHN_feature_sets.CellAssignment) and evaluates the features as segmented
+reductions with numpy: counts and moments with bincount over the cell index,
+percentiles, median and max from the values sorted within their cells, the
+plane fit of sigma_z and the covariance of the eigenvalues from per-cell sums.
+
+Features are selected by their laserchicken extractor, so names of custom
+extractors (e.g. band ratios registered by the notebooks) work as well.
+Features of other extractors are computed by laserchicken from the same cells.
+Values are those of laserchicken (verified to ~1e-12), except for the
+eigenvalue features of cells with less than 3 points, which are NaN instead
+of undefined.
+"""
+
+import logging
+
+import numpy as np
+from laserchicken import compute_features
+from laserchicken.feature_extractor.band_ratio_feature_extractor import BandRatioFeatureExtractor
+from laserchicken.feature_extractor.density_absolute_mean_feature_extractor import DensityAbsoluteMeanFeatureExtractor
+from laserchicken.feature_extractor.density_feature_extractor import PointDensityFeatureExtractor
+from laserchicken.feature_extractor.eigenvals_feature_extractor import EigenValueVectorizeFeatureExtractor
+from laserchicken.feature_extractor.entropy_feature_extractor import EntropyFeatureExtractor
+from laserchicken.feature_extractor.feature_extraction import list_feature_names
+from laserchicken.feature_extractor.kurtosis_feature_extractor import KurtosisFeatureExtractor
+from laserchicken.feature_extractor.mean_std_coeff_feature_extractor import MeanStdCoeffFeatureExtractor
+from laserchicken.feature_extractor.median_feature_extractor import MedianFeatureExtractor
+from laserchicken.feature_extractor.percentile_feature_extractor import PercentileFeatureExtractor
+from laserchicken.feature_extractor.pulse_penetration_feature_extractor import GROUND_TAGS, PulsePenetrationFeatureExtractor
+from laserchicken.feature_extractor.range_feature_extractor import RangeFeatureExtractor
+from laserchicken.feature_extractor.sigma_z_feature_extractor import SigmaZFeatureExtractor
+from laserchicken.feature_extractor.skew_feature_extractor import SkewFeatureExtractor
+from laserchicken.feature_extractor.var_feature_extractor import VarianceFeatureExtractor
+from laserchicken.keys import point
+
+
+logger = logging.getLogger(__name__)
+
+# laserchicken extractor -> CellFeatures method returning the values of all the features it provides
+CELL_EXTRACTORS = {
+    PointDensityFeatureExtractor: 'point_density',
+    PulsePenetrationFeatureExtractor: 'pulse_penetration_ratio',
+    DensityAbsoluteMeanFeatureExtractor: 'density_absolute_mean',
+    RangeFeatureExtractor: 'range',
+    MedianFeatureExtractor: 'median',
+    PercentileFeatureExtractor: 'percentile',
+    VarianceFeatureExtractor: 'variance',
+    MeanStdCoeffFeatureExtractor: 'mean_std_coeff',
+    SkewFeatureExtractor: 'skew',
+    KurtosisFeatureExtractor: 'kurtosis',
+    EntropyFeatureExtractor: 'entropy',
+    BandRatioFeatureExtractor: 'band_ratio',
+    SigmaZFeatureExtractor: 'sigma_z',
+    EigenValueVectorizeFeatureExtractor: 'eigenvalues',
+}
+
+
+class CellFeatures(object):
+    """
+    Features of the points of each target cell. points are indices into
+    point_cloud and cells the target cell of each of them, sorted by cell;
+    a point can appear in more than one cell.
+    """
+
+    def __init__(self, point_cloud, points, cells, n_targets, volume):
+        self.point_cloud = point_cloud
+        self.points = points
+        self.cells = cells
+        self.n_targets = n_targets
+        self.volume = volume
+        self.counts = np.bincount(cells, minlength=n_targets)
+        self.starts = np.cumsum(self.counts) - self.counts
+        self._values = {}
+        self._sorted = {}
+        self._moments = {}
+
+    def values(self, key):
+        if key not in self._values:
+            self._values[key] = self.point_cloud[point][key]['data'][self.points].astype(np.float64)
+        return self._values[key]
+
+    def sum(self, weights=None, cells=None):
+        """ Sum of weights (or number of points) per cell. """
+        return np.bincount(self.cells if cells is None else cells, weights, minlength=self.n_targets)
+
+    def sorted_values(self, key):
+        """ Values sorted within the segment of each cell. """
+        if key not in self._sorted:
+            # sort by value, then (stable) by cell: faster than a lexsort
+            values = self.values(key)
+            order = np.argsort(values)
+            self._sorted[key] = values[order[np.argsort(self.cells[order], kind='stable')]]
+        return self._sorted[key]
+
+    def moments(self, key):
+        """ Mean and central moments 2, 3 and 4 (as numpy.var, scipy.stats) per cell. """
+        if key not in self._moments:
+            values = self.values(key)
+            with np.errstate(invalid='ignore', divide='ignore'):
+                mean = self.sum(values) / self.counts
+                deviation = values - mean[self.cells]
+                squared = deviation ** 2
+                self._moments[key] = (mean,
+                                      self.sum(squared) / self.counts,
+                                      self.sum(squared * deviation) / self.counts,
+                                      self.sum(squared * squared) / self.counts)
+        return self._moments[key]
+
+    def quantile(self, key, fraction):
+        """ Linear interpolation between the closest ranks (scipy.stats.scoreatpercentile). """
+        values = self.sorted_values(key)
+        position = fraction * (self.counts - 1)
+        below = np.floor(position).astype(np.int64)
+        filled = self.counts > 0
+        result = np.full(self.n_targets, np.nan)
+        lower = values[self.starts[filled] + below[filled]]
+        upper = values[self.starts[filled] + np.minimum(below[filled] + 1, self.counts[filled] - 1)]
+        result[filled] = lower + (upper - lower) * (position[filled] - below[filled])
+        return result
+
+    def extremes(self, key):
+        """ Min and max per cell, NaN in empty cells. """
+        values = self.sorted_values(key)
+        minimum = np.full(self.n_targets, np.nan)
+        maximum = np.full(self.n_targets, np.nan)
+        filled = self.counts > 0
+        minimum[filled] = values[self.starts[filled]]
+        maximum[filled] = values[self.starts[filled] + self.counts[filled] - 1]
+        return minimum, maximum
+
+    def is_ground(self):
+        if 'raw_classification' not in self.point_cloud[point]:
+            raise ValueError('Missing raw_classification attribute which is necessary for calculating '
+                             'pulse_penetration_ratio and density_absolute_mean features.')
+        return np.isin(self.point_cloud[point]['raw_classification']['data'][self.points], GROUND_TAGS)
+
+    def point_density(self, extractor):
+        return [self.counts / self.volume.calculate_area_or_volume()]
+
+    def pulse_penetration_ratio(self, extractor):
+        return [self.sum(self.is_ground().astype(np.float64)) / np.maximum(self.counts, 1)]
+
+    def density_absolute_mean(self, extractor):
+        non_ground = ~self.is_ground()
+        values = self.values(extractor.data_key)[non_ground]
+        cells = self.cells[non_ground]
+        n_non_ground = self.sum(cells=cells)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean = self.sum(values, cells) / n_non_ground
+            above = self.sum((values > mean[cells]).astype(np.float64), cells)
+            return [np.where(n_non_ground > 0, above / n_non_ground * 100., 0.)]
+
+    def range(self, extractor):
+        minimum, maximum = self.extremes(extractor.data_key)
+        return [maximum, minimum, maximum - minimum]
+
+    def median(self, extractor):
+        values = self.sorted_values(extractor.data_key)
+        filled = self.counts > 0
+        lower = self.starts[filled] + (self.counts[filled] - 1) // 2
+        upper = self.starts[filled] + self.counts[filled] // 2
+        result = np.full(self.n_targets, np.nan)
+        result[filled] = (values[lower] + values[upper]) / 2.
+        return [result]
+
+    def percentile(self, extractor):
+        return [self.quantile(extractor.data_key, extractor.percentile / 100.)]
+
+    def variance(self, extractor):
+        return [self.moments(extractor.data_key)[1]]
+
+    def mean_std_coeff(self, extractor):
+        mean, variance, _, _ = self.moments(extractor.data_key)
+        std = np.sqrt(variance)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return [mean, std, std / mean]
+
+    def _no_spread(self, key):
+        """ Cells where scipy.stats treats the variance as zero (skew and kurtosis are NaN). """
+        mean, variance, _, _ = self.moments(key)
+        return ~(variance > (np.finfo(np.float64).eps * mean) ** 2)
+
+    def skew(self, extractor):
+        _, variance, third, _ = self.moments(extractor.data_key)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return [np.where(self._no_spread(extractor.data_key), np.nan, third / variance ** 1.5)]
+
+    def kurtosis(self, extractor):
+        _, variance, _, fourth = self.moments(extractor.data_key)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return [np.where(self._no_spread(extractor.data_key), np.nan, fourth / variance ** 2 - 3.)]
+
+    def entropy(self, extractor):
+        """ Shannon entropy of the histogram of layer_thickness bins (numpy.histogram) in each cell. """
+        values = self.values(extractor.data_key)
+        minimum, maximum = self.extremes(extractor.data_key)
+        if extractor.min_val is not None:
+            minimum = np.full(self.n_targets, float(extractor.min_val))
+        if extractor.max_val is not None:
+            maximum = np.full(self.n_targets, float(extractor.max_val))
+        with np.errstate(invalid='ignore'):
+            binned = (self.counts > 0) & (maximum > minimum)
+        n_bins = np.zeros(self.n_targets, dtype=np.int64)
+        n_bins[binned] = np.ceil((maximum[binned] - minimum[binned]) / extractor.layer_thickness)
+
+        cell_min, cell_max, cell_bins = minimum[self.cells], maximum[self.cells], n_bins[self.cells]
+        with np.errstate(invalid='ignore'):
+            keep = binned[self.cells] & (values >= cell_min) & (values <= cell_max)
+        values, cells = values[keep], self.cells[keep]
+        cell_min, cell_max, cell_bins = cell_min[keep], cell_max[keep], cell_bins[keep]
+        # bin as numpy.histogram does, edges from numpy.linspace
+        step = (cell_max - cell_min) / cell_bins
+        bins = ((values - cell_min) / (cell_max - cell_min) * cell_bins).astype(np.int64)
+        bins[bins == cell_bins] -= 1
+        lower_edge = bins * step + cell_min
+        bins[values < lower_edge] -= 1
+        upper_edge = np.where(bins + 1 == cell_bins, cell_max, (bins + 1) * step + cell_min)
+        bins[(values >= upper_edge) & (bins != cell_bins - 1)] += 1
+
+        offsets = np.cumsum(n_bins) - n_bins
+        counts = np.bincount(offsets[cells] + bins, minlength=n_bins.sum())
+        bin_cells = np.repeat(np.arange(self.n_targets), n_bins)
+        probability = counts / np.bincount(cells, minlength=self.n_targets)[bin_cells].clip(1)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            terms = np.where(counts > 0, probability * np.log2(probability), 0.)
+        return [-np.bincount(bin_cells, terms, minlength=self.n_targets)]
+
+    def band_ratio(self, extractor):
+        values = self.values(extractor.data_key)
+        # limits are tested for truth, as by laserchicken
+        in_band = np.ones(len(values), dtype=bool)
+        if extractor.upper_limit:
+            in_band &= values < extractor.upper_limit
+        if extractor.lower_limit:
+            in_band &= values > extractor.lower_limit
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return [self.sum(in_band.astype(np.float64)) / self.counts]
+
+    def _centred_coordinates(self):
+        x, y, z = (self.values(key) for key in ('x', 'y', 'z'))
+        with np.errstate(invalid='ignore', divide='ignore'):
+            means = [self.sum(values) / self.counts for values in (x, y, z)]
+        return [values - mean[self.cells] for values, mean in zip((x, y, z), means)]
+
+    def sigma_z(self, extractor):
+        """ Standard deviation of the residuals of z after a least-squares plane fit per cell. """
+        dx, dy, dz = self._centred_coordinates()
+        normal_matrix = np.stack([np.stack([self.sum(dx * dx), self.sum(dx * dy)], axis=-1),
+                                  np.stack([self.sum(dx * dy), self.sum(dy * dy)], axis=-1)], axis=-2)
+        right_hand_side = np.stack([self.sum(dx * dz), self.sum(dy * dz)], axis=-1)
+        # minimum-norm solution as numpy.linalg.lstsq, for cells with collinear points or less than 3 points
+        slopes = np.einsum('nij,nj->ni', np.linalg.pinv(normal_matrix, rcond=1e-10, hermitian=True), right_hand_side)
+        residuals = dz - slopes[self.cells, 0] * dx - slopes[self.cells, 1] * dy
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return [np.sqrt(self.sum(residuals ** 2) / self.counts)]
+
+    def eigenvalues(self, extractor):
+        """ Eigenvalues and normal vector of the covariance of x, y and z, as EigenValueVectorizeFeatureExtractor. """
+        centred = self._centred_coordinates()
+        covariance = np.empty((self.n_targets, 3, 3))
+        with np.errstate(invalid='ignore', divide='ignore'):
+            for i in range(3):
+                for j in range(i, 3):
+                    covariance[:, i, j] = covariance[:, j, i] = self.sum(centred[i] * centred[j]) / (self.counts - 1)
+        valid = self.counts >= 3
+        eigenvalues = np.full((self.n_targets, 3), np.nan)
+        normals = np.full((self.n_targets, 3), np.nan)
+        if valid.any():
+            values, vectors = np.linalg.eigh(covariance[valid])
+            eigenvalues[valid] = values[:, ::-1]
+            normal = vectors[:, :, 0]
+            normal[normal[:, 2] < 0] *= -1
+            normals[valid] = normal
+        slope = np.tan(np.arccos(normals[:, 2]))
+        return [eigenvalues[:, 0], eigenvalues[:, 1], eigenvalues[:, 2],
+                normals[:, 0], normals[:, 1], normals[:, 2], slope]
+
+
+def compute_cell_features(point_cloud, points, cells, targets, feature_names, volume):
+    """
+    Compute features in the target cells and store them as attributes of
+    targets, as laserchicken.compute_features does with cell neighborhoods.
+
+    :param point_cloud: environment point cloud
+    :param points: indices of the points of point_cloud in the cells, sorted by cell
+    :param cells: index of the target (cell) of each of points
+    :param targets: target point cloud, one target per cell
+    :param feature_names: names of the features (laserchicken or registered extractors)
+    :param volume: the cell volume
+    """
+    n_targets = len(targets[point]['x']['data'])
+    extractors = list_feature_names()
+    unknown = [name for name in feature_names if name not in extractors]
+    if unknown:
+        raise ValueError('Unknown features selected: {}'.format(', '.join(unknown)))
+
+    other_features = [name for name in feature_names if type(extractors[name]) not in CELL_EXTRACTORS]
+    if other_features:
+        logger.info('Features {} are extracted by laserchicken'.format(other_features))
+        counts = np.bincount(cells, minlength=n_targets)
+        neighborhoods = [indices.tolist() for indices in np.split(points, np.cumsum(counts)[:-1])]
+        compute_features(point_cloud, neighborhoods, targets, other_features, volume, verbose=False)
+
+    cell_features = CellFeatures(point_cloud, points, cells, n_targets, volume)
+    done = set(other_features)
+    for name in feature_names:
+        if name in done:
+            continue
+        extractor = extractors[name]
+        values = getattr(cell_features, CELL_EXTRACTORS[type(extractor)])(extractor)
+        for provided, feature_values in zip(extractor.provides(), values):
+            if provided in feature_names:
+                targets[point][provided] = {'type': 'float64', 'data': np.asarray(feature_values, dtype=np.float64)}
+                done.add(provided)
@@ -0,0 +1,290 @@
+"""
+National mosaic of the features of the target cells, written tile by tile.
+
+The feature extraction exports a PLY file per tile and feature, which the
+GeoTIFF export parses back into a raster in a separate cluster job. With a
+staging mosaic instead, every extraction task writes the 10 m block of its
+tile into one staging raster per feature, and a Cloud-Optimized GeoTIFF is
+written from it per feature once all the tiles are done.
+
+The staging raster of a feature is a sparse file on a shared file system with
+a fixed slot per tile of the grid, aligned to the file system pages: a tile
+is written with a single positioned write to its own slot, so the tasks of
+any worker can write at the same time without locking, and a failed tile is
+simply written again. A tile is marked as written once the blocks of all the
+features are. Cells without targets, as tiles without points, are NaN.
+
+    feature_extraction_input['export_mosaic'] = {'staging_folder': path_mosaic.as_posix(),
+                                                 'attributes': features}
+    ... run the feature extraction ...
+    for feature in MosaicStaging(path_mosaic).features:
+        MosaicGeotiffWriter(band=feature, label=feature).config({
+            'setup_local_fs': {'input_folder': path_mosaic.as_posix(), 'output_folder': path_output.as_posix()},
+            'create_cog': {'output_handle': output_handle}}).run()
+"""
+
+import json
+import logging
+import os
+import pathlib
+
+import numpy as np
+from osgeo import gdal, osr
+
+from laserfarm.pipeline_remote_data import PipelineRemoteData
+from laserfarm.utils import check_dir_exists
+
+
+logger = logging.getLogger(__name__)
+
+METADATA_FILE = 'mosaic.json'
+WRITTEN_FOLDER = 'written'
+MOSAIC_VERSION = 1
+# tile slots are aligned to the pages of the file system, so concurrent writes never share a page
+SLOT_ALIGNMENT = 4096
+NODATA = np.nan
+COG_OPTIONS = ['COMPRESS=DEFLATE', 'PREDICTOR=YES', 'BLOCKSIZE=512', 'BIGTIFF=IF_SAFER',
+               'OVERVIEWS=IGNORE_EXISTING', 'OVERVIEW_RESAMPLING=AVERAGE', 'NUM_THREADS=ALL_CPUS']
+
+
+def grid_block(grid, resolution, tile_index, x, y, values):
+    """
+    Block of a tile of the grid (north up) with the values of the target cells
+    centred at x, y; cells without a target are NaN.
+
+    :param grid: retiling schema (min_x, max_x, min_y, max_y, n_tiles_side)
+    :param resolution: side of the target cells
+    :param tile_index: (x, y) index of the tile in the grid
+    :param x: x coordinates of the targets
+    :param y: y coordinates of the targets
+    :param values: values of the targets
+    """
+    tile_width = (grid['max_x'] - grid['min_x']) / grid['n_tiles_side']
+    cells_per_tile = int(round(tile_width / resolution))
+    tile_min_x = grid['min_x'] + tile_index[0] * tile_width
+    tile_max_y = grid['min_y'] + (tile_index[1] + 1) * tile_width
+    columns = np.rint((np.asarray(x) - tile_min_x) / resolution - 0.5).astype(np.int64)
+    rows = np.rint((tile_max_y - np.asarray(y)) / resolution - 0.5).astype(np.int64)
+    in_tile = (columns >= 0) & (columns < cells_per_tile) & (rows >= 0) & (rows < cells_per_tile)
+    if not np.all(in_tile):
+        raise ValueError('{} targets outside tile ({},{})'.format(np.count_nonzero(~in_tile), *tile_index))
+    block = np.full((cells_per_tile, cells_per_tile), NODATA, dtype=np.float32)
+    block[rows, columns] = values
+    return block
+
+
+class MosaicStaging(object):
+    """
+    Staging rasters of the features of a grid, with a block of
+    cells_per_tile x cells_per_tile float32 values per tile (north up).
+
+    :param path: staging folder, as created by MosaicStaging.create
+    """
+
+    def __init__(self, path):
+        self.path = pathlib.Path(path)
+        with open(self.path / METADATA_FILE, 'r') as f:
+            metadata = json.load(f)
+        self.grid = metadata['grid']
+        self.resolution = metadata['resolution']
+        self.features = metadata['features']
+        self.cells_per_tile = metadata['cells_per_tile']
+        self.tile_width = (self.grid['max_x'] - self.grid['min_x']) / self.grid['n_tiles_side']
+        self.block_bytes = self.cells_per_tile ** 2 * np.dtype(np.float32).itemsize
+        self.slot_bytes = -(-self.block_bytes // SLOT_ALIGNMENT) * SLOT_ALIGNMENT
+
+    @classmethod
+    def create(cls, path, grid, resolution, features):
+        """
+        Create the staging rasters, or open them if they exist with the same
+        grid, resolution and features. Concurrent calls are safe, so every
+        task can create the staging before writing to it.
+
+        :param path: staging folder, on a file system shared by the workers
+        :param grid: retiling schema (min_x, max_x, min_y, max_y, n_tiles_side)
+        :param resolution: side of the target cells
+        :param features: names of the features
+        """
+        path = pathlib.Path(path)
+        grid = {key: grid[key] for key in ('min_x', 'max_x', 'min_y', 'max_y', 'n_tiles_side')}
+        tile_width = (grid['max_x'] - grid['min_x']) / grid['n_tiles_side']
+        cells_per_tile = int(round(tile_width / resolution))
+        if not np.isclose(cells_per_tile * resolution, tile_width):
+            raise ValueError('Tile width {} is not a multiple of the resolution {}'.format(tile_width, resolution))
+        metadata = {'version': MOSAIC_VERSION, 'grid': grid, 'resolution': resolution,
+                    'features': list(features), 'cells_per_tile': cells_per_tile}
+
+        check_dir_exists(path / WRITTEN_FOLDER, should_exist=True, mkdir=True)
+        if (path / METADATA_FILE).exists():
+            with open(path / METADATA_FILE, 'r') as f:
+                existing = json.load(f)
+            if existing != metadata:
+                raise ValueError('Staging mosaic {} exists with another grid, resolution or features'.format(path))
+        else:
+            # identical content from concurrent tasks, replaced atomically
+            tmp_path = path / '{}.{}.tmp'.format(METADATA_FILE, os.getpid())
+            with open(tmp_path, 'w') as f:
+                json.dump(metadata, f, indent=1)
+            os.replace(tmp_path, path / METADATA_FILE)
+
+        staging = cls(path)
+        size = grid['n_tiles_side'] ** 2 * staging.slot_bytes
+        for feature in staging.features:
+            fd = os.open(staging._feature_path(feature), os.O_RDWR | os.O_CREAT, 0o664)
+            try:
+                # sparse: only the slots of the written tiles take space
+                if os.fstat(fd).st_size < size:
+                    os.ftruncate(fd, size)
+            finally:
+                os.close(fd)
+        return staging
+
+    def _feature_path(self, feature):
+        return self.path / '{}.raw'.format(feature)
+
+    def _marker_path(self, tile_index):
+        return self.path / WRITTEN_FOLDER / 'tile_{}_{}'.format(*tile_index)
+
+    def _offset(self, tile_index):
+        """ Offset of the slot of a tile, the tiles ordered north to south and west to east. """
+        tile_x, tile_y = tile_index
+        n_tiles_side = self.grid['n_tiles_side']
+        if not (0 <= tile_x < n_tiles_side and 0 <= tile_y < n_tiles_side):
+            raise ValueError('Tile ({},{}) is outside the grid'.format(tile_x, tile_y))
+        return ((n_tiles_side - 1 - tile_y) * n_tiles_side + tile_x) * self.slot_bytes
+
+    def tile_block(self, tile_index, x, y, values):
+        """
+        Block of a tile (north up) with the values of the target cells
+        centred at x, y; cells without a target are NaN.
+        """
+        return grid_block(self.grid, self.resolution, tile_index, x, y, values)
+
+    def write_tile(self, tile_index, x, y, values):
+        """
+        Write the target cells of a tile to the staging rasters and mark the
+        tile as written.
+
+        :param tile_index: (x, y) index of the tile in the grid
+        :param x: x coordinates of the targets (cell centres)
+        :param y: y coordinates of the targets
+        :param values: {feature: values of the targets} for all the features
+        """
+        missing = [feature for feature in self.features if feature not in values]
+        if missing:
+            raise ValueError('Missing features for the staging mosaic: {}'.format(missing))
+        offset = self._offset(tile_index)
+        for feature in self.features:
+            data = self.tile_block(tile_index, x, y, values[feature]).tobytes()
+            fd = os.open(self._feature_path(feature), os.O_WRONLY)
+            try:
+                written = 0
+                while written < len(data):
+                    written += os.pwrite(fd, data[written:], offset + written)
+            finally:
+                os.close(fd)
+        self._marker_path(tile_index).touch()
+        return self
+
+    def is_written(self, tile_index):
+        """ Whether a tile is written to the staging rasters. """
+        return self._marker_path(tile_index).exists()
+
+    def written_tiles(self):
+        """ Indices of the tiles written to the staging rasters. """
+        return sorted(tuple(int(el) for el in entry.name.split('_')[1:3])
+                      for entry in os.scandir(self.path / WRITTEN_FOLDER) if entry.name.startswith('tile_'))
+
+    def read_block(self, feature, tile_index):
+        """ Block of a tile (north up) as written to the staging raster of feature. """
+        with open(self._feature_path(feature), 'rb') as f:
+            data = os.pread(f.fileno(), self.block_bytes, self._offset(tile_index))
+        return np.frombuffer(data, dtype=np.float32).reshape(self.cells_per_tile, self.cells_per_tile)
+
+    def write_cog(self, feature, output_folder, output_handle, EPSG=28992, options=None):
+        """
+        Write the Cloud-Optimized GeoTIFF of a feature over the extent of the
+        written tiles, named as by GeotiffWriter with a single sub-region:
+        <output_handle>_TILE_000_BAND_<feature>.tif. The overviews are built
+        once, by the COG driver.
+
+        :param feature: name of the feature
+        :param output_folder: folder of the GeoTIFF
+        :param output_handle: handle of the output file
+        :param EPSG: (Optional) EPSG code of the spatial reference system. Default 28992.
+        :param options: (Optional) creation options of the COG driver, COG_OPTIONS if not given
+        :return: path of the GeoTIFF
+        """
+        tiles = self.written_tiles()
+        if not tiles:
+            raise IOError('No tile written to the staging mosaic {}'.format(self.path))
+        tile_x, tile_y = np.array(tiles).T
+        x_range = range(tile_x.min(), tile_x.max() + 1)
+        y_range = range(tile_y.max(), tile_y.min() - 1, -1)
+        written = set(tiles)
+        ncols = len(x_range) * self.cells_per_tile
+        nrows = len(y_range) * self.cells_per_tile
+        geotransform = (self.grid['min_x'] + x_range[0] * self.tile_width, self.resolution, 0,
+                        self.grid['min_y'] + (y_range[0] + 1) * self.tile_width, 0, -self.resolution)
+
+        check_dir_exists(output_folder, should_exist=True, mkdir=True)
+        outfile = pathlib.Path(output_folder) / '{}_TILE_000_BAND_{}.tif'.format(output_handle, feature)
+        # the COG driver only writes copies: assemble the rows of tiles into a tiled GeoTIFF first
+        tmpfile = outfile.with_name(outfile.stem + '.staging.tif')
+        logger.info('Assembling {} tiles of {} ({} x {} cells) ...'.format(len(tiles), feature, ncols, nrows))
+        raster = gdal.GetDriverByName('GTiff').Create(
+            tmpfile.as_posix(), ncols, nrows, 1, gdal.GDT_Float32,
+            ['TILED=YES', 'BLOCKXSIZE=512', 'BLOCKYSIZE=512', 'COMPRESS=LZW', 'BIGTIFF=IF_SAFER', 'SPARSE_OK=TRUE'])
+        raster.SetGeoTransform(geotransform)
+        srs = osr.SpatialReference()
+        srs.ImportFromEPSG(EPSG)
+        raster.SetProjection(srs.ExportToWkt())
+        raster.SetMetadata({'band': feature})
+        band = raster.GetRasterBand(1)
+        band.SetMetadata({'band_key': feature})
+        band.SetNoDataValue(NODATA)
+        for row, ty in enumerate(y_range):
+            row_tiles = [tx for tx in x_range if (tx, ty) in written]
+            if not row_tiles:
+                continue
+            data = np.full((self.cells_per_tile, ncols), NODATA, dtype=np.float32)
+            for tx in row_tiles:
+                column = (tx - x_range[0]) * self.cells_per_tile
+                data[:, column:column + self.cells_per_tile] = self.read_block(feature, (tx, ty))
+            band.WriteArray(data, 0, row * self.cells_per_tile)
+        raster.FlushCache()
+        raster = band = None
+
+        logger.info('Writing Cloud-Optimized GeoTIFF {} ...'.format(outfile))
+        cog = gdal.Translate(outfile.as_posix(), tmpfile.as_posix(), format='COG',
+                             creationOptions=options if options is not None else COG_OPTIONS)
+        if cog is None:
+            raise IOError('Failed to write {}'.format(outfile))
+        cog = None
+        gdal.GetDriverByName('GTiff').Delete(tmpfile.as_posix())
+        logger.info('... writing completed.')
+        return outfile
+
+
+class MosaicGeotiffWriter(PipelineRemoteData):
+    """ Write the Cloud-Optimized GeoTIFF of a feature from a staging mosaic (the input folder). """
+
+    def __init__(self, band=None, label=None):
+        self.pipeline = ('create_cog',)
+        if band is not None:
+            self.band = band
+        if label is not None:
+            self.label = label
+
+    def create_cog(self, output_handle, EPSG=28992, options=None):
+        """
+        Write the GeoTIFF of the feature to the output folder.
+
+        :param output_handle: Handle of output file. The output will be named
+        as <output_handle>_TILE_000_BAND_<band name>
+        :param EPSG: (Optional) EPSG code of the spatial reference system of
+        the input data. Default 28992.
+        :param options: (Optional) creation options of the COG driver
+        """
+        MosaicStaging(self.input_folder).write_cog(self.band, self.output_folder, output_handle, EPSG, options)
+        return self
@@ -0,0 +1,260 @@
+"""
+Cost model and memory-aware placement of the tasks of a macro-pipeline.
+
+Tiles differ by orders of magnitude in size: coastal tiles are nearly empty,
+urban AHN4 tiles hold hundreds of millions of points. With a fixed number of
+processes per node, a node either runs out of memory on two dense tiles or
+idles on sparse ones. CostAwareMacroPipeline estimates the memory and runtime
+of every task from the point count and extent in the LAS/LAZ headers of its
+input, and:
+
+- submits the tasks largest-first, so that the long tail of the run is made
+  of small tasks;
+- if the workers have a MEMORY resource (e.g. worker_options={'nthreads': 4,
+  'resources': {'MEMORY': 60e9}}, or dask-worker --resources MEMORY=60e9),
+  requests the estimated memory of every task from it, so a worker only runs
+  tasks together when their estimated memory fits;
+- appends the predicted and measured cost of every task to a cost log, from
+  which the model is calibrated for the next run (CostModel.from_logs).
+
+    cost_log = 'normalize_cost.jsonl'
+    macro = CostAwareMacroPipeline('normalize', CostModel.from_logs([cost_log]), cost_log=cost_log)
+    macro.tasks = [...]
+    macro.estimate_costs(tiles)  # input file or folder of each task
+    macro.setup_cluster(cluster=cluster)
+    macro.run()
+"""
+
+import datetime
+import json
+import logging
+import pathlib
+import threading
+import time
+
+import laspy
+import numpy as np
+import psutil
+from dask.distributed import as_completed, get_worker
+from scipy.optimize import nnls
+
+from laserfarm import MacroPipeline
+
+
+logger = logging.getLogger(__name__)
+
+MEMORY_RESOURCE = 'MEMORY'
+# initial coefficients per stage, until calibrated from a cost log: memory in bytes, runtime in seconds, each
+# as (constant, per point, per m2 of the extent).
+# The point cloud of laserchicken holds ~15 float64 attributes (~120 bytes per point), plus the KD-trees.
+DEFAULT_COEFFICIENTS = {
+    'retile': {'memory': (5e8, 80., 0.), 'runtime': (10., 1e-6, 0.)},
+    'normalize': {'memory': (5e8, 300., 0.), 'runtime': (10., 5e-6, 0.)},
+    'normalize_fused': {'memory': (5e8, 450., 0.), 'runtime': (10., 8e-6, 0.)},
+    # streaming normalization (AHN_grid_normalization): memory of the ground grid and the chunks only
+    'normalize_grid': {'memory': (1e9, 0., 0.), 'runtime': (10., 3e-6, 0.)},
+    'feature_extraction': {'memory': (5e8, 200., 0.), 'runtime': (10., 3e-6, 0.)},
+}
+# seconds between samples of the resident memory of a worker
+MEMORY_SAMPLING_INTERVAL = 0.5
+# least number of finished tasks of a stage to calibrate it
+MIN_CALIBRATION_SAMPLES = 10
+# the memory estimate covers this fraction of the calibration tasks
+MEMORY_QUANTILE = 0.95
+LAS_SUFFIXES = ('.las', '.laz')
+
+
+def header_cost_input(path):
+    """
+    Point count and extent area (m2) from the LAS/LAZ headers of a file, or
+    of all the files in a folder (e.g. a retiled tile). Only the headers are
+    read.
+
+    :param path: LAS/LAZ file or folder with LAS/LAZ files
+    :return: (number of points, area of the extent)
+    """
+    path = pathlib.Path(path)
+    files = [path] if path.is_file() else [f for f in path.iterdir() if f.suffix.lower() in LAS_SUFFIXES]
+    n_points = 0
+    mins, maxs = np.full(2, np.inf), np.full(2, -np.inf)
+    for file in files:
+        with laspy.open(file) as f:
+            n_points += f.header.point_count
+            if f.header.point_count:
+                mins = np.minimum(mins, f.header.mins[:2])
+                maxs = np.maximum(maxs, f.header.maxs[:2])
+    area = float(np.prod(maxs - mins)) if n_points else 0.
+    return n_points, area
+
+
+class CostModel(object):
+    """
+    Memory and runtime of a task as linear functions of the number of points
+    and the extent area of its input, with coefficients per stage.
+    """
+
+    def __init__(self, coefficients=None):
+        self.coefficients = {stage: dict(costs) for stage, costs in DEFAULT_COEFFICIENTS.items()}
+        for stage, costs in (coefficients or {}).items():
+            self.coefficients.setdefault(stage, {}).update(costs)
+
+    def estimate(self, stage, n_points, area=0.):
+        """ Estimated memory (bytes) and runtime (seconds) of a task of stage. """
+        x = np.array([1., n_points, area])
+        costs = self.coefficients[stage]
+        return float(np.dot(costs['memory'], x)), float(np.dot(costs['runtime'], x))
+
+    @classmethod
+    def from_logs(cls, paths, min_samples=MIN_CALIBRATION_SAMPLES):
+        """
+        Cost model calibrated on the finished tasks in cost logs (see
+        CostAwareMacroPipeline). Stages with fewer than min_samples tasks keep
+        their default coefficients; missing log files are skipped.
+
+        Runtime is fitted by non-negative least squares. Memory is fitted the
+        same way and scaled up so that the estimate covers MEMORY_QUANTILE of
+        the tasks, as an underestimate makes a worker run out of memory.
+        """
+        records = {}
+        for path in paths:
+            if not pathlib.Path(path).exists():
+                continue
+            with open(path, 'r') as f:
+                for line in f:
+                    record = json.loads(line)
+                    if record['outcome'] == 'finished' and record.get('runtime') is not None:
+                        records.setdefault(record['stage'], []).append(record)
+
+        coefficients = {}
+        for stage, stage_records in records.items():
+            if len(stage_records) < min_samples:
+                logger.info('{} tasks of {} in the cost logs: default cost model'.format(len(stage_records), stage))
+                continue
+            x = np.array([[1., r['n_points'], r['area']] for r in stage_records])
+            runtime, _ = nnls(x, np.array([r['runtime'] for r in stage_records]))
+            memory_actual = np.array([r['memory'] for r in stage_records], dtype=float)
+            memory, _ = nnls(x, memory_actual)
+            predicted = x @ memory
+            if np.all(predicted > 0):
+                memory *= max(np.quantile(memory_actual / predicted, MEMORY_QUANTILE), 1.)
+            coefficients[stage] = {'memory': tuple(memory.tolist()), 'runtime': tuple(runtime.tolist())}
+            logger.info('Cost model of {} calibrated on {} tasks'.format(stage, len(stage_records)))
+        return cls(coefficients)
+
+
+def _run_measured(run):
+    """
+    Run a task on a worker, measuring its runtime and the increase of the
+    resident memory of the worker process while it runs. With several tasks
+    in a process at the same time, the memory is an upper bound.
+    """
+    process = psutil.Process()
+    start_memory = process.memory_info().rss
+    peak_memory = [start_memory]
+    done = threading.Event()
+
+    def sample():
+        while not done.wait(MEMORY_SAMPLING_INTERVAL):
+            peak_memory[0] = max(peak_memory[0], process.memory_info().rss)
+
+    sampler = threading.Thread(target=sample, daemon=True)
+    sampler.start()
+    start = time.perf_counter()
+    try:
+        MacroPipeline._run_task(run)
+    finally:
+        done.set()
+        sampler.join()
+    peak_memory[0] = max(peak_memory[0], process.memory_info().rss)
+    return {'runtime': time.perf_counter() - start,
+            'memory': peak_memory[0] - start_memory,
+            'worker': get_worker().address}
+
+
+class CostAwareMacroPipeline(MacroPipeline):
+    """
+    MacroPipeline submitting its tasks largest-first, placing them by their
+    estimated memory if the workers have a MEMORY resource, and logging the
+    predicted and measured cost of every task.
+
+    :param stage: stage of the cost model (e.g. 'normalize', 'feature_extraction')
+    :param cost_model: CostModel, default coefficients if not given
+    :param cost_log: optional file to which a JSON line per task is appended
+    """
+
+    def __init__(self, stage, cost_model=None, cost_log=None):
+        super(CostAwareMacroPipeline, self).__init__()
+        self.stage = stage
+        self.cost_model = cost_model if cost_model is not None else CostModel()
+        self.cost_log = cost_log
+        self.cost_inputs = None
+
+    def set_costs(self, cost_inputs):
+        """
+        :param cost_inputs: (number of points, extent area) of the input of
+        every task, in the order of the tasks
+        """
+        assert len(cost_inputs) == len(self.tasks), 'cost inputs length does not match the number of pipelines!'
+        self.cost_inputs = [(int(n_points), float(area)) for n_points, area in cost_inputs]
+        return self
+
+    def estimate_costs(self, paths):
+        """
+        Set the cost inputs from the LAS/LAZ headers of the input of every
+        task (a file, or a folder as for the retiled tiles).
+
+        :param paths: input file or folder of every task, in the order of the tasks
+        """
+        return self.set_costs([header_cost_input(path) for path in paths])
+
+    def _worker_memory(self):
+        """ Largest MEMORY resource of the workers, None if they do not have it. """
+        memory = [worker.get('resources', {}).get(MEMORY_RESOURCE)
+                  for worker in self.client.scheduler_info()['workers'].values()]
+        memory = [m for m in memory if m]
+        return max(memory) if memory else None
+
+    def run(self):
+        """ Run the macro pipeline, largest tasks first. """
+        if self.cost_inputs is None:
+            self.set_costs([(0, 0.)] * len(self.tasks))
+        estimates = [self.cost_model.estimate(self.stage, *cost_input) for cost_input in self.cost_inputs]
+        worker_memory = self._worker_memory()
+        if worker_memory is None:
+            logger.warning('Workers have no {} resource: tasks are not placed by memory'.format(MEMORY_RESOURCE))
+
+        order = sorted(range(len(self.tasks)), key=lambda n: estimates[n][1], reverse=True)
+        futures = {}
+        for rank, idx in enumerate(order):
+            kwargs = {'priority': len(order) - rank, 'pure': False}
+            if worker_memory is not None:
+                # a task estimated larger than any worker runs alone on the largest one
+                kwargs['resources'] = {MEMORY_RESOURCE: min(estimates[idx][0], worker_memory)}
+            future = self.client.submit(_run_measured, self.tasks[idx].run, **kwargs)
+            futures[future.key] = (idx, future)
+
+        self.errors = [None] * len(self.tasks)
+        self.outcome = ['pending'] * len(self.tasks)
+        for future in as_completed([future for _, future in futures.values()]):
+            idx, _ = futures.pop(future.key)
+            self.outcome[idx] = future.status
+            exc = future.exception()
+            if exc is not None:
+                self.errors[idx] = (type(exc), exc)
+            actual = future.result() if future.status == 'finished' else {}
+            future.release()
+            self._log_cost(idx, estimates[idx], actual)
+
+    def _log_cost(self, idx, estimate, actual):
+        n_points, area = self.cost_inputs[idx]
+        record = {'stage': self.stage, 'label': self.tasks[idx].label, 'n_points': n_points, 'area': area,
+                  'predicted_memory': estimate[0], 'predicted_runtime': estimate[1],
+                  'memory': actual.get('memory'), 'runtime': actual.get('runtime'),
+                  'worker': actual.get('worker'), 'outcome': self.outcome[idx],
+                  'date': datetime.datetime.now().isoformat(timespec='seconds')}
+        if actual:
+            logger.info('{}: predicted {:.1f} GB, {:.0f} s - actual {:.1f} GB, {:.0f} s'.format(
+                record['label'], estimate[0] / 1e9, estimate[1], actual['memory'] / 1e9, actual['runtime']))
+        if self.cost_log is not None:
+            with open(self.cost_log, 'a') as f:
+                f.write(json.dumps(record) + '\n')
@@ -0,0 +1,343 @@
+#!/usr/bin/env python3
+
+
+"""
+Multi-epoch datacube of the features of the target cells.
+
+The products are single-band GeoTIFFs per epoch and feature, so reading a few
+pixels across AHN1-AHN4 (as the multi-temporal use case and the sensitivity
+analysis do) means opening and stacking dozens of national rasters. The
+datacube holds all the features of all the epochs in one chunked, compressed
+Zarr array 'features' with dimensions (epoch, metric, y, x), with the
+coordinates and the grid in the metadata, so it opens as an xarray Dataset
+(xarray.open_zarr) and can be converted to NetCDF from there.
+
+A chunk holds all the epochs and metrics of a square of cells, aligned to the
+tiles of the grid (a whole tile for the 10 m targets): the pixel stack of a
+cell, as well as a spatial window within a chunk, is one chunk read. Every
+tile is written by its own task, from the per-tile target grids of the
+feature extraction of each epoch - staging mosaics (see AHN_cog_mosaic) or
+folders of PLY targets per feature. The tiles never share a chunk, so the
+tasks write in parallel without locking.
+
+The metrics are named <feature set>:<feature>, e.g. non-ground:perc_95_normalized_height,
+as the same feature (e.g. point_density) is extracted for several sets.
+
+    sources = {'ahn3': {'all': '/path/AHN3/mosaic_all', 'non-ground': '/path/AHN3/mosaic_non-ground'},
+               'ahn4': {...}}
+    create_datacube('ahn_datacube.zarr', grid, 10., list(sources), source_metrics(sources, grid, 10.))
+    macro = MacroPipeline()
+    macro.tasks = datacube_tasks('ahn_datacube.zarr', sources)
+    ...
+    epochs, metrics, values = pixel_stack('ahn_datacube.zarr', x, y)
+
+or from the command line:
+
+    ./AHN_datacube.py ahn_datacube.zarr --scheduler tcp://10.0.1.12:43843 \
+        --source ahn3:all=/path/AHN3/mosaic_all --source ahn3:non-ground=/path/AHN3/mosaic_non-ground ...
+"""
+
+
+import argparse
+import json
+import logging
+import pathlib
+
+import numpy as np
+import plyfile
+import zarr
+from numcodecs import Blosc
+
+from laserfarm import MacroPipeline
+from laserfarm.pipeline import Pipeline
+
+from AHN_cog_mosaic import METADATA_FILE, NODATA, MosaicStaging, grid_block
+
+
+logger = logging.getLogger(__name__)
+
+DATACUBE_VERSION = 1
+FEATURES_ARRAY = 'features'
+DIMENSIONS = ('epoch', 'metric', 'y', 'x')
+COMPRESSOR = Blosc(cname='zstd', clevel=5, shuffle=Blosc.BITSHUFFLE)
+# largest uncompressed chunk, which holds all the epochs and metrics of a square of cells
+MAX_CHUNK_BYTES = 64 * 2 ** 20
+
+
+def metric_name(set_name, feature):
+    """ Name of a metric of the datacube. """
+    return '{}:{}'.format(set_name, feature)
+
+
+def _grid_key(grid):
+    return {key: grid[key] for key in ('min_x', 'max_x', 'min_y', 'max_y', 'n_tiles_side')}
+
+
+class TargetSource(object):
+    """
+    Per-tile target grids of a feature set of an epoch: a staging mosaic, or
+    a folder with a folder of PLY targets (tile_<x>_<y>.ply) per feature as
+    exported by the feature extraction with multi_band_files False.
+
+    :param path: staging mosaic or folder of the targets
+    :param grid: retiling schema of the datacube
+    :param resolution: side of the target cells of the datacube
+    """
+
+    def __init__(self, path, grid, resolution):
+        self.path = pathlib.Path(path)
+        self.grid = _grid_key(grid)
+        self.resolution = resolution
+        if (self.path / METADATA_FILE).exists():
+            self.staging = MosaicStaging(self.path)
+            if _grid_key(self.staging.grid) != self.grid or not np.isclose(self.staging.resolution, resolution):
+                raise ValueError('Staging mosaic {} has another grid or resolution than the datacube'.format(path))
+            self.features = list(self.staging.features)
+        else:
+            self.staging = None
+            self.features = sorted(el.name for el in self.path.iterdir() if el.is_dir())
+
+    def tiles(self):
+        """ Indices of the tiles with targets. """
+        if self.staging is not None:
+            return set(self.staging.written_tiles())
+        tiles = set()
+        for feature in self.features:
+            tiles.update(tuple(int(el) for el in f.stem.split('_')[1:3])
+                         for f in (self.path / feature).iterdir() if f.match('tile_*_*.ply'))
+        return tiles
+
+    def read_block(self, feature, tile_index):
+        """ Block of a tile (north up) of a feature, None if the tile has no targets. """
+        if self.staging is not None:
+            if not self.staging.is_written(tile_index):
+                return None
+            return self.staging.read_block(feature, tile_index)
+        path = self.path / feature / 'tile_{}_{}.ply'.format(*tile_index)
+        if not path.exists():
+            return None
+        data = plyfile.PlyData.read(path.as_posix()).elements[0].data
+        return grid_block(self.grid, self.resolution, tile_index, data['x'], data['y'], data[feature])
+
+
+def source_metrics(sources, grid, resolution):
+    """
+    Metrics of the target sources of all the epochs, in order of appearance.
+
+    :param sources: {epoch: {feature set name: staging mosaic or targets folder}}
+    :param grid: retiling schema
+    :param resolution: side of the target cells
+    """
+    metrics = []
+    for epoch_sources in sources.values():
+        for set_name, path in epoch_sources.items():
+            for feature in TargetSource(path, grid, resolution).features:
+                if metric_name(set_name, feature) not in metrics:
+                    metrics.append(metric_name(set_name, feature))
+    return metrics
+
+
+def chunk_side(cells_per_tile, n_layers, max_chunk_bytes=MAX_CHUNK_BYTES):
+    """ Largest side of the square chunks that divides the tiles and fits in max_chunk_bytes. """
+    sides = [side for side in range(1, cells_per_tile + 1) if cells_per_tile % side == 0
+             and n_layers * side ** 2 * np.dtype(np.float32).itemsize <= max_chunk_bytes]
+    return max(sides) if sides else 1
+
+
+def create_datacube(path, grid, resolution, epochs, metrics, EPSG=28992, max_chunk_bytes=MAX_CHUNK_BYTES):
+    """
+    Create the datacube of the grid, or open it if it exists with the same
+    grid, resolution, epochs and metrics. Run before the tile tasks.
+
+    :param path: Zarr store (folder), on a file system shared by the workers
+    :param grid: retiling schema (min_x, max_x, min_y, max_y, n_tiles_side)
+    :param resolution: side of the target cells
+    :param epochs: names of the epochs, e.g. ['ahn1', 'ahn2', 'ahn3', 'ahn4']
+    :param metrics: names of the metrics, see source_metrics
+    :param EPSG: (Optional) EPSG code of the spatial reference system. Default 28992.
+    :param max_chunk_bytes: (Optional) largest uncompressed chunk
+    :return: the Zarr group of the datacube
+    """
+    grid = _grid_key(grid)
+    tile_width = (grid['max_x'] - grid['min_x']) / grid['n_tiles_side']
+    cells_per_tile = int(round(tile_width / resolution))
+    if not np.isclose(cells_per_tile * resolution, tile_width):
+        raise ValueError('Tile width {} is not a multiple of the resolution {}'.format(tile_width, resolution))
+    n_cells = grid['n_tiles_side'] * cells_per_tile
+    max_y = grid['min_y'] + grid['n_tiles_side'] * tile_width
+    metadata = {'version': DATACUBE_VERSION, 'grid': grid, 'resolution': resolution,
+                'epochs': list(epochs), 'metrics': list(metrics), 'cells_per_tile': cells_per_tile,
+                'crs': 'EPSG:{}'.format(EPSG),
+                'geotransform': [grid['min_x'], resolution, 0, max_y, 0, -resolution]}
+
+    root = zarr.open_group(str(path), mode='a')
+    if FEATURES_ARRAY in root:
+        existing = {key: root.attrs.get(key) for key in metadata}
+        if json.loads(json.dumps(existing)) != json.loads(json.dumps(metadata)):
+            raise ValueError('Datacube {} exists with another grid, resolution, epochs or metrics'.format(path))
+        return root
+
+    root.attrs.update(metadata)
+    coordinates = {'epoch': np.array(epochs, dtype=str),
+                   'metric': np.array(metrics, dtype=str),
+                   'y': max_y - (np.arange(n_cells) + 0.5) * resolution,
+                   'x': grid['min_x'] + (np.arange(n_cells) + 0.5) * resolution}
+    for name, values in coordinates.items():
+        array = root.array(name, values, chunks=max(len(values), 1), overwrite=True)
+        array.attrs['_ARRAY_DIMENSIONS'] = [name]
+
+    side = chunk_side(cells_per_tile, len(epochs) * len(metrics), max_chunk_bytes)
+    logger.info('Datacube of {} x {} cells, chunks of {} x {} cells'.format(n_cells, n_cells, side, side))
+    # created last: a datacube with the features array is complete
+    features = root.create_dataset(FEATURES_ARRAY, shape=(len(epochs), len(metrics), n_cells, n_cells),
+                                   chunks=(len(epochs), len(metrics), side, side), dtype='f4',
+                                   fill_value=NODATA, compressor=COMPRESSOR)
+    features.attrs['_ARRAY_DIMENSIONS'] = list(DIMENSIONS)
+    return root
+
+
+class DatacubeTileWriter(Pipeline):
+    """ Write the features of all the epochs of a tile to the datacube. """
+
+    def __init__(self, tile_index=None, label=None):
+        self.pipeline = ('write_tile',)
+        self.tile_index = tile_index
+        if label is not None:
+            self.label = label
+
+    def write_tile(self, datacube, sources):
+        """
+        Read the block of the tile from the target sources of every epoch and
+        write its chunks. Metrics without targets in the tile are NaN.
+
+        :param datacube: Zarr store of the datacube, see create_datacube
+        :param sources: {epoch: {feature set name: staging mosaic or targets folder}}
+        """
+        root = zarr.open_group(str(datacube), mode='r+')
+        grid, resolution = root.attrs['grid'], root.attrs['resolution']
+        epochs, metrics = root.attrs['epochs'], root.attrs['metrics']
+        cells_per_tile = root.attrs['cells_per_tile']
+        block = np.full((len(epochs), len(metrics), cells_per_tile, cells_per_tile), NODATA, dtype=np.float32)
+        for epoch, epoch_sources in sources.items():
+            for set_name, path in epoch_sources.items():
+                source = TargetSource(path, grid, resolution)
+                for feature in source.features:
+                    metric = metric_name(set_name, feature)
+                    if metric not in metrics:
+                        continue
+                    values = source.read_block(feature, self.tile_index)
+                    if values is not None:
+                        block[epochs.index(epoch), metrics.index(metric)] = values
+
+        tile_x, tile_y = self.tile_index
+        row = (grid['n_tiles_side'] - 1 - tile_y) * cells_per_tile
+        column = tile_x * cells_per_tile
+        logger.info('Writing tile ({},{}) to the datacube ...'.format(tile_x, tile_y))
+        root[FEATURES_ARRAY][:, :, row:row + cells_per_tile, column:column + cells_per_tile] = block
+        logger.info('... writing completed.')
+        return self
+
+
+def datacube_tasks(datacube, sources, tiles=None):
+    """
+    Tile writers for the tiles with targets in any of the sources.
+
+    :param datacube: Zarr store of the datacube, see create_datacube
+    :param sources: {epoch: {feature set name: staging mosaic or targets folder}}
+    :param tiles: optional subset of the tiles, as names (tile_<x>_<y>)
+    """
+    root = zarr.open_group(str(datacube), mode='r')
+    grid, resolution = root.attrs['grid'], root.attrs['resolution']
+    if tiles is None:
+        tile_indices = set()
+        for epoch_sources in sources.values():
+            for path in epoch_sources.values():
+                tile_indices |= TargetSource(path, grid, resolution).tiles()
+    else:
+        tile_indices = [tuple(int(el) for el in tile.split('_')[1:3]) for tile in tiles]
+    tasks = []
+    for tile_index in sorted(tile_indices):
+        label = 'tile_{}_{}'.format(*tile_index)
+        tasks.append(DatacubeTileWriter(tile_index, label=label).config({'write_tile': {'datacube': str(datacube),
+                                                                                        'sources': sources}}))
+    return tasks
+
+
+def pixel_stack(datacube, x, y):
+    """
+    Values of all the metrics of all the epochs at a point: a single chunk read.
+
+    :param datacube: Zarr store of the datacube
+    :param x: x coordinate of the point
+    :param y: y coordinate of the point
+    :return: (epochs, metrics, values as an epochs x metrics array)
+    """
+    root = zarr.open_group(str(datacube), mode='r')
+    x_min, resolution, _, y_max, _, _ = root.attrs['geotransform']
+    row, column = int(np.floor((y_max - y) / resolution)), int(np.floor((x - x_min) / resolution))
+    features = root[FEATURES_ARRAY]
+    if not (0 <= row < features.shape[2] and 0 <= column < features.shape[3]):
+        raise ValueError('Point ({}, {}) is outside the datacube'.format(x, y))
+    return root.attrs['epochs'], root.attrs['metrics'], features[:, :, row, column]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Write the features of the AHN epochs to a datacube, one task per '
+                                                 'tile on a Dask cluster')
+    parser.add_argument('datacube', help='Zarr store of the datacube, created if it does not exist')
+    parser.add_argument('--source', action='append', required=True, metavar='EPOCH:SET=PATH',
+                        help='staging mosaic or targets folder of a feature set of an epoch, e.g. '
+                             'ahn3:non-ground=/path/AHN3/mosaic_non-ground; repeat for every set and epoch')
+    parser.add_argument('--grid', default=None,
+                        help='feature extraction input (JSON) with the grid and mesh size in generate_targets; '
+                             'default from the first staging mosaic')
+    parser.add_argument('--scheduler', required=True, help='address of the Dask scheduler, e.g. tcp://10.0.1.12:43843')
+    parser.add_argument('--from-file', default=None, help='JSON file with the tiles to write, e.g. datacube_failed.json')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    sources = {}
+    for source in args.source:
+        epoch_set, _, path = source.partition('=')
+        epoch, _, set_name = epoch_set.partition(':')
+        if not (epoch and set_name and path):
+            parser.error('--source must be EPOCH:SET=PATH, got {}'.format(source))
+        sources.setdefault(epoch, {})[set_name] = path
+
+    if args.grid is not None:
+        with open(args.grid, 'r') as f:
+            generate_targets = json.load(f)['generate_targets']
+        grid, resolution = _grid_key(generate_targets), generate_targets['tile_mesh_size']
+    else:
+        stagings = [MosaicStaging(path) for epoch_sources in sources.values() for path in epoch_sources.values()
+                    if (pathlib.Path(path) / METADATA_FILE).exists()]
+        if not stagings:
+            parser.error('--grid is required if none of the sources is a staging mosaic')
+        grid, resolution = stagings[0].grid, stagings[0].resolution
+
+    create_datacube(args.datacube, grid, resolution, list(sources), source_metrics(sources, grid, resolution))
+    tiles = None
+    if args.from_file is not None:
+        with open(args.from_file, 'r') as f:
+            tiles = json.load(f)
+
+    macro = MacroPipeline()
+    macro.tasks = datacube_tasks(args.datacube, sources, tiles)
+    macro.set_labels([task.label for task in macro.tasks])
+    print('Write {} tiles to the datacube'.format(len(macro.tasks)))
+    macro.setup_cluster(cluster=args.scheduler)
+    try:
+        macro.run()
+        # save outcome results and write name of failed pipelines to file
+        macro.print_outcome(to_file='datacube.out')
+        failed = macro.get_failed_pipelines()
+        if failed:
+            with open('datacube_failed.json', 'w') as f:
+                json.dump([pip.label for pip in failed], f)
+            raise RuntimeError('Some of the pipelines have failed')
+    finally:
+        macro.client.close()
+
+
+if __name__ == '__main__':
+    main()
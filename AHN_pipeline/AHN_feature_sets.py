@@ -0,0 +1,294 @@
+"""
+Extraction of several feature sets from one load of a tile.
+
+The feature extraction notebooks (all points, non-ground/vegetation) and the
+first-return pulse density extraction each load the same tile, generate the
+same 10 m targets and find the neighborhood of every target again.
+FeatureSetExtraction loads a tile once and evaluates a list (or dict, by name)
+of feature sets. Each set is a feature extraction input as written by the
+notebooks, with its own point filter and output folder.
+
+For cell volumes that match the target mesh, the points are assigned to the
+target cells once with numpy (CellAssignment). A filtered feature set takes
+the subset of each neighborhood given by the filter mask, so it needs no new
+KDTree and no per-point python loop. The features are then computed per cell
+by segmented reductions (AHN_cell_features). Other volumes fall back to
+laserchicken.
+
+Besides (or instead of) the PLY files of export_targets, the features of a
+set can be written to a staging mosaic with export_mosaic (AHN_cog_mosaic).
+
+    input = feature_sets_input(['feature_extraction_all.json',
+                                'feature_extraction_non-ground.json',
+                                'feature_extraction_first_return.json'])
+    FeatureSetExtraction('tile_123_456.laz').config(input).run()
+"""
+
+import copy
+import json
+import logging
+import pathlib
+
+import numpy as np
+from laserchicken import build_volume
+from laserchicken.keys import point
+from laserchicken.utils import copy_point_cloud, get_point, get_features
+
+from laserfarm.utils import check_dir_exists
+
+from AHN_cell_features import compute_cell_features
+from AHN_cog_mosaic import MosaicStaging
+from AHN_las_pushdown import PREDICATE_DIMENSIONS, PushdownDataProcessing, point_cloud_mask
+
+
+logger = logging.getLogger(__name__)
+
+def tile_index_from_name(name):
+    """ Tile index from a tile name such as tile_123_456 or tile_123_456.laz """
+    return tuple(int(el) for el in name.split('.')[0].split('_')[1:3])
+
+
+def read_feature_set(feature_set):
+    """ Feature extraction input as a dict, read from a JSON file if a path is given. """
+    if isinstance(feature_set, (str, pathlib.Path)):
+        with open(feature_set, 'r') as f:
+            return json.load(f)
+    return copy.deepcopy(feature_set)
+
+
+def named_feature_sets(feature_sets):
+    """ (name, input dict) of feature sets given as a dict by name or as a list. """
+    if isinstance(feature_sets, dict):
+        items = feature_sets.items()
+    else:
+        items = [(pathlib.Path(feature_set).stem if isinstance(feature_set, (str, pathlib.Path))
+                  else 'feature_set_{}'.format(n), feature_set)
+                 for n, feature_set in enumerate(feature_sets)]
+    return [(name, read_feature_set(feature_set)) for name, feature_set in items]
+
+
+def feature_sets_input(feature_sets, input_folder=None):
+    """
+    Input for FeatureSetExtraction running the given feature sets: the tile
+    is loaded once with the attributes of all sets, from input_folder or the
+    input folder of the first set. The load predicate of the sets (see
+    AHN_las_pushdown) is pushed down if they all have the same one.
+    """
+    named = named_feature_sets(feature_sets)
+    # a predicate shared by all sets is pushed down to the load, otherwise
+    # every set applies its own to the point cloud in memory
+    predicates = [feature_input.get('load', {}).get('predicate') for _, feature_input in named]
+    predicate = predicates[0] if all(p == predicates[0] for p in predicates) else None
+    attributes = []
+    for _, feature_input in named:
+        load_attributes = feature_input.get('load', {}).get('attributes', 'all')
+        if load_attributes == 'all':
+            attributes = 'all'
+            break
+        set_predicate = feature_input.get('load', {}).get('predicate')
+        if set_predicate and predicate is None:
+            load_attributes = load_attributes + [PREDICATE_DIMENSIONS[key] for key in set_predicate]
+        for attribute in load_attributes:
+            if attribute not in attributes:
+                attributes.append(attribute)
+    if input_folder is None:
+        input_folder = named[0][1]['setup_local_fs']['input_folder']
+    return {
+        'setup_local_fs': {'input_folder': pathlib.Path(input_folder).as_posix(),
+                           'output_folder': named[0][1]['setup_local_fs']['output_folder']},
+        'load': {'attributes': attributes, 'predicate': predicate},
+        'extract_feature_sets': {'feature_sets': dict(named)},
+        'clear_cache': {},
+    }
+
+
+class CellAssignment(object):
+    """
+    Points of an environment point cloud in the square cells around the
+    points of a regular target mesh, with the criterion of laserchicken's cell
+    neighborhood (|dx| and |dy| at most half the side): points on a cell edge
+    belong to both cells.
+    """
+
+    def __init__(self, point_cloud, targets, side_length):
+        x, y, _ = get_point(point_cloud, ...)
+        target_x, target_y, _ = get_point(targets, ...)
+        self.n_targets = len(target_x)
+        columns = np.unique(target_x)
+        rows = np.unique(target_y)
+        lookup = np.full((len(columns), len(rows)), -1, dtype=np.int64)
+        lookup[np.searchsorted(columns, target_x), np.searchsorted(rows, target_y)] = np.arange(self.n_targets)
+
+        half = 0.5 * side_length
+        point_indices = []
+        cells = []
+        if self.n_targets:
+            column = np.floor((x - columns[0]) / side_length + 0.5).astype(np.int64)
+            row = np.floor((y - rows[0]) / side_length + 0.5).astype(np.int64)
+            # nearest column/row and, for points on or near an edge, the neighbouring ones
+            candidates_x = [self._candidates(column + dx, columns, x, half) for dx in (-1, 0, 1)]
+            candidates_y = [self._candidates(row + dy, rows, y, half) for dy in (-1, 0, 1)]
+            for cx, valid_x in candidates_x:
+                for cy, valid_y in candidates_y:
+                    valid = valid_x & valid_y
+                    cell = lookup[cx[valid], cy[valid]]
+                    in_mesh = cell >= 0
+                    point_indices.append(np.flatnonzero(valid)[in_mesh])
+                    cells.append(cell[in_mesh])
+        point_indices = np.concatenate(point_indices) if point_indices else np.empty(0, dtype=np.int64)
+        cells = np.concatenate(cells) if cells else np.empty(0, dtype=np.int64)
+
+        order = np.lexsort((point_indices, cells))
+        self.points = point_indices[order]
+        self.cells = cells[order]
+
+    @staticmethod
+    def _candidates(index, centres, coordinate, half):
+        in_range = (index >= 0) & (index < len(centres))
+        index = np.clip(index, 0, len(centres) - 1)
+        return index, in_range & (np.abs(centres[index] - coordinate) <= half)
+
+    def members(self, mask=None):
+        """
+        Point indices and their target, sorted by target. With a mask of the
+        environment points, the indices refer to the filtered point cloud (the
+        points where mask is True).
+        """
+        points, cells = self.points, self.cells
+        if mask is not None:
+            keep = mask[points]
+            points = (np.cumsum(mask) - 1)[points[keep]]
+            cells = cells[keep]
+        return points, cells
+
+    def neighborhoods(self, mask=None):
+        """ Point indices per target, see members. """
+        points, cells = self.members(mask)
+        counts = np.bincount(cells, minlength=self.n_targets)
+        # lists, as the extractors of laserchicken test neighborhoods for truth
+        return [indices.tolist() for indices in np.split(points, np.cumsum(counts)[:-1])]
+
+
+class FeatureSetExtraction(PushdownDataProcessing):
+    """ Load a tile once and extract several feature sets, each with its own filter and output folder. """
+
+    def __init__(self, input=None, label=None, tile_index=None):
+        if tile_index is None:
+            name = label if label is not None else input
+            tile_index = tile_index_from_name(pathlib.Path(name).name) if name is not None else (None, None)
+        super(FeatureSetExtraction, self).__init__(input, label=label, tile_index=tile_index)
+        self.pipeline = self.pipeline[:-1] + ('export_mosaic', 'extract_feature_sets', 'clear_cache')
+
+    def extract_feature_sets(self, feature_sets):
+        """
+        Extract feature sets from the point cloud in memory.
+
+        :param feature_sets: list of feature extraction inputs, or dict of them
+        by name. Each input is a dict, or the path to its JSON file, as written
+        by the feature extraction notebooks (the predicate of load,
+        apply_filter, generate_targets, extract_features, export_targets
+        and/or export_mosaic, and setup_local_fs for the output folder).
+        """
+        point_cloud = self.point_cloud
+        output_folder = self.output_folder
+        assignments = {}
+        try:
+            for name, feature_input in named_feature_sets(feature_sets):
+                logger.info('Extracting feature set {}'.format(name))
+                set_output_folder = feature_input.get('setup_local_fs', {}).get('output_folder', output_folder)
+                check_dir_exists(set_output_folder, should_exist=True, mkdir=True)
+                if 'add_custom_feature' in feature_input:
+                    self.add_custom_feature(**feature_input['add_custom_feature'])
+                if 'add_custom_features' in feature_input:
+                    self.add_custom_features(**feature_input['add_custom_features'])
+
+                mask = None
+                self.point_cloud = point_cloud
+                predicate = feature_input.get('load', {}).get('predicate')
+                if predicate and predicate != self.predicate:
+                    mask = point_cloud_mask(point_cloud, predicate)
+                if 'apply_filter' in feature_input:
+                    filter_input = dict(feature_input['apply_filter'])
+                    filter = getattr(self.filter, filter_input.pop('filter_type'))
+                    filter_mask = filter(point_cloud, return_mask=True, **filter_input)
+                    mask = filter_mask if mask is None else mask & filter_mask
+                if mask is not None:
+                    self.point_cloud = copy_point_cloud(point_cloud, mask)
+
+                self.generate_targets(**feature_input['generate_targets'])
+                extract_input = feature_input['extract_features']
+                if self._in_target_cells(**extract_input):
+                    side_length = extract_input['volume_size']
+                    if side_length not in assignments:
+                        logger.info('Assigning points to {}m cells'.format(side_length))
+                        assignments[side_length] = CellAssignment(point_cloud, self.targets, side_length)
+                    self._extract_features_in_cells(assignments[side_length], mask, **extract_input)
+                else:
+                    self.extract_features(**extract_input)
+
+                if 'export_targets' in feature_input:
+                    self.output_folder = set_output_folder
+                    self.export_targets(**feature_input['export_targets'])
+                    self.output_folder = output_folder
+                if 'export_mosaic' in feature_input:
+                    self.export_mosaic(**feature_input['export_mosaic'])
+                # KDTrees of a filtered point cloud are not needed by the next set
+                self.clear_cache()
+        finally:
+            self.point_cloud = point_cloud
+            self.output_folder = output_folder
+        return self
+
+    def export_mosaic(self, staging_folder, attributes='all'):
+        """
+        Write the features of the targets to the staging mosaic of the grid,
+        created if it does not exist (see AHN_cog_mosaic).
+
+        :param staging_folder: staging folder, on a file system shared by the workers
+        :param attributes: list of the features to write, or 'all'
+        """
+        if attributes == 'all':
+            attributes = [name for name in self.targets[point] if name not in ('x', 'y', 'z')]
+        grid = {'min_x': self.grid.min_x, 'max_x': self.grid.max_x, 'min_y': self.grid.min_y,
+                'max_y': self.grid.max_y, 'n_tiles_side': self.grid.n_tiles_side}
+        logger.info('Writing targets to the staging mosaic ...')
+        staging = MosaicStaging.create(staging_folder, grid, self._tile_mesh_size, attributes)
+        x, y, _ = get_point(self.targets, ...)
+        staging.write_tile(self._tile_index, x, y, dict(zip(attributes, get_features(self.targets, attributes, ...))))
+        logger.info('... writing completed.')
+        return self
+
+    def generate_targets(self, min_x, min_y, max_x, max_y, n_tiles_side, tile_mesh_size, validate=True,
+                         validate_precision=None):
+        """ DataProcessing.generate_targets, keeping the mesh size to recognise cell volumes. """
+        self._tile_mesh_size = tile_mesh_size
+        return super(FeatureSetExtraction, self).generate_targets(min_x, min_y, max_x, max_y, n_tiles_side,
+                                                                  tile_mesh_size, validate, validate_precision)
+
+    def extract_features(self, volume_type, volume_size, feature_names, sample_size=None):
+        """
+        DataProcessing.extract_features. Features in cells of the target mesh
+        are computed by segmented reductions (AHN_cell_features) instead of a
+        neighborhood search per target.
+        """
+        if self._in_target_cells(volume_type, volume_size, feature_names, sample_size):
+            logger.info('Assigning points to {}m cells'.format(volume_size))
+            assignment = CellAssignment(self.point_cloud, self.targets, volume_size)
+            return self._extract_features_in_cells(assignment, None, volume_type, volume_size, feature_names)
+        return super(FeatureSetExtraction, self).extract_features(volume_type, volume_size, feature_names,
+                                                                  sample_size)
+
+    def _in_target_cells(self, volume_type, volume_size, feature_names, sample_size=None):
+        """ Whether the volumes are the cells around the targets, without sampling. """
+        return (volume_type == 'cell' and not sample_size
+                and np.isclose(volume_size, getattr(self, '_tile_mesh_size', np.nan)))
+
+    def _extract_features_in_cells(self, assignment, mask, volume_type, volume_size, feature_names,
+                                   sample_size=None):
+        """ extract_features with the points assigned to the target cells. """
+        logger.info('Starting feature extraction ...')
+        points, cells = assignment.members(mask)
+        compute_cell_features(self.point_cloud, points, cells, self.targets, feature_names,
+                              build_volume(volume_type, volume_size))
+        logger.info('... feature extraction completed.')
+        return self
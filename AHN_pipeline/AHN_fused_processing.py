@@ -0,0 +1,106 @@
+"""
+Fused execution of normalization and feature extraction for retiled tiles.
+
+The epoch workflows run retile -> normalize -> feature extraction (all) ->
+feature extraction (veg) as separate macro-pipelines: every stage writes the
+full point cloud to dCache and the next one pulls it again. In fused mode a
+FeatureSetExtraction (AHN_feature_sets) loads the retiled files of a tile once,
+normalizes them with the normalize step of DataProcessing and runs all feature
+sets on the point cloud in memory, sharing the cell assignment of the points.
+The normalized LAZ is only exported if 'export_point_cloud' is in the input.
+
+Feature sets are given in the format of the feature extraction notebooks (the
+dicts they write to feature_extraction_all.json and
+feature_extraction_non-ground.json), so the fused mode extracts exactly the
+same targets. They are read on the client and passed by name, as the workers
+may not run in the directory of the JSON files:
+
+    feature_sets = {pathlib.Path(f).stem: read_feature_set(f)
+                    for f in ['feature_extraction_all.json', 'feature_extraction_non-ground.json']}
+    fused_input = {
+        'setup_local_fs': {'input_folder': retiled, 'output_folder': normalized},
+        'load': {'attributes': 'all'},
+        'normalize': 1,
+        'apply_filter': {'filter_type': 'select_below', 'attribute': 'z', 'threshold': 10000.},
+        'extract_feature_sets': {'feature_sets': feature_sets},
+        'clear_cache': {},
+    }
+    FeatureSetExtraction(tile.name, label=tile.name).config(fused_input).run()
+
+complete_tiles lists the tiles whose retiling is complete, so that they can be
+processed while the retiling goes on.
+"""
+
+import json
+import logging
+import pathlib
+
+from laserfarm.grid import Grid
+
+
+logger = logging.getLogger(__name__)
+
+RETILE_RECORD_PATTERN = '*_retile_record.js'
+
+
+def read_retile_records(retiled_folder):
+    """ Retile records written by the Retiler (validate), by input file stem. """
+    records = {}
+    for path in pathlib.Path(retiled_folder).glob(RETILE_RECORD_PATTERN):
+        with open(path, 'r') as f:
+            record = json.load(f)
+        records[pathlib.Path(record['file']).stem] = record
+    return records
+
+
+def complete_tiles(retiled_folder, input_files, input_bounds=None, grid=None):
+    """
+    Names of the tiles in retiled_folder whose retiled input is complete, so
+    that they can be normalized and processed while retiling goes on.
+
+    Without input_bounds, tiles are complete once all input_files have been
+    retiled and validated. With input_bounds ({input file: (min_x, min_y,
+    max_x, max_y)}) and the retiling grid dict, a tile only waits for the
+    pending input files that overlap it.
+
+    :param retiled_folder: folder with the tile_<x>_<y> folders and the retile records
+    :param input_files: names of the input files of the retiling
+    :param input_bounds: optional bounds of the input files
+    :param grid: retiling grid (min_x, max_x, min_y, max_y, n_tiles_side)
+    """
+    records = read_retile_records(retiled_folder)
+    tiles = set(tile for record in records.values() if record['validated']
+                for tile in record['redistributed_to'])
+
+    blocked = set()
+    for input_file in input_files:
+        stem = pathlib.Path(input_file).stem
+        record = records.get(stem)
+        if record is not None and record['validated']:
+            continue
+        if record is not None:
+            blocked.update(record['redistributed_to'])
+        bounds = input_bounds.get(input_file) if input_bounds is not None else None
+        if bounds is None or grid is None:
+            logger.info('Retiling of {} not completed: no tile complete'.format(input_file))
+            return []
+        blocked.update(overlapping_tiles(bounds, grid))
+
+    return sorted(tiles - blocked)
+
+
+def overlapping_tiles(bounds, grid, margin=0.):
+    """
+    Names of the tiles of the retiling grid that an input file with the given
+    bounds can be retiled to.
+
+    :param bounds: (min_x, min_y, max_x, max_y) of the input file
+    :param grid: retiling grid (min_x, max_x, min_y, max_y, n_tiles_side)
+    :param margin: (Optional) grow the bounds by this distance, e.g. to
+    include the tiles whose normalization halo reaches the file
+    """
+    retile_grid = Grid()
+    retile_grid.setup(grid['min_x'], grid['min_y'], grid['max_x'], grid['max_y'], grid['n_tiles_side'])
+    (min_x, min_y), (max_x, max_y) = (retile_grid.get_tile_index(bounds[0] - margin, bounds[1] - margin),
+                                      retile_grid.get_tile_index(bounds[2] + margin, bounds[3] + margin))
+    return set('tile_{}_{}'.format(x, y) for x in range(min_x, max_x + 1) for y in range(min_y, max_y + 1))
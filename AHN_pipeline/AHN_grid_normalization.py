@@ -0,0 +1,239 @@
+"""
+Height normalization of retiled tiles against a ground-elevation grid, in
+bounded memory.
+
+The normalization of laserfarm (DataProcessing.normalize) loads the whole tile
+with all its attributes and subtracts from every point the lowest point of its
+1 m cell, with cells that stop at the edges of the points of the tile.
+GridNormalization runs in two streaming passes over the LAS/LAZ files of a
+tile instead:
+
+- build_ground_grid: the lowest ground point of every cell of a grid
+  (default 1 m) over the tile and a halo read from the neighbouring retiled
+  tiles, so the points on the edges of the tile have ground on both sides.
+  Only x, y, z and the classification are decoded. Cells without ground are
+  filled with the value of the nearest cell with ground;
+- normalize_points: the points are read in chunks, their ground elevation is
+  interpolated bilinearly from the grid and the normalized height is written
+  to the output LAZ file chunk by chunk.
+
+Memory is set by the grid (8 MB for a 1 km tile at 1 m) and the chunk size,
+not by the number of points in the tile.
+
+    normalization_input = {
+        'setup_local_fs': {'input_folder': retiled, 'output_folder': normalized},
+        'build_ground_grid': {'resolution': 1., 'halo': 10., 'ground_classes': [2], **grid},
+        'normalize_points': {'filename': 'tile_123_456.laz', 'max_z': 10000., 'overwrite': True},
+    }
+    GridNormalization('tile_123_456', label='tile_123_456').config(normalization_input).run()
+"""
+
+import logging
+import pathlib
+
+import laspy
+import numpy as np
+from laserchicken.keys import normalized_height
+from scipy import ndimage
+
+from laserfarm.pipeline_remote_data import PipelineRemoteData
+from laserfarm.utils import check_file_exists, check_path_exists
+
+from AHN_feature_sets import tile_index_from_name
+from AHN_las_pushdown import CHUNK_SIZE, LAS_SUFFIXES
+from AHN_laz_splitter import laz_backend
+
+
+logger = logging.getLogger(__name__)
+
+GROUND_RESOLUTION = 1.
+# width of the border read from the neighbouring tiles
+HALO = 10.
+# LAZ layers read to build the ground grid
+GROUND_LAYERS = (laspy.DecompressionSelection.XY_RETURNS_CHANNEL | laspy.DecompressionSelection.Z
+                 | laspy.DecompressionSelection.CLASSIFICATION)
+
+
+def las_files(path):
+    """ LAS/LAZ files of a tile: the file itself, or the files in the tile folder. """
+    path = pathlib.Path(path)
+    if path.is_file():
+        return [path]
+    return sorted(f for f in path.iterdir() if f.suffix.lower() in LAS_SUFFIXES)
+
+
+def ground_grid(files, bounds, resolution=GROUND_RESOLUTION, ground_classes=None, chunk_size=CHUNK_SIZE):
+    """
+    Elevation of the lowest ground point in the cells of a grid, NaN in cells
+    without ground.
+
+    :param files: LAS/LAZ files
+    :param bounds: (min_x, min_y, max_x, max_y) of the grid
+    :param resolution: side of the cells
+    :param ground_classes: (Optional) classes of the ground points, all points if not given
+    :param chunk_size: (Optional) points decoded at once
+    :return: 2D array of the cells, with rows along y and columns along x from (min_x, min_y)
+    """
+    min_x, min_y, max_x, max_y = bounds
+    shape = (int(np.ceil((max_y - min_y) / resolution)), int(np.ceil((max_x - min_x) / resolution)))
+    elevation = np.full(shape[0] * shape[1], np.inf)
+    for file in files:
+        with laspy.open(pathlib.Path(file).as_posix(), laz_backend=laz_backend() or None,
+                        decompression_selection=GROUND_LAYERS) as f:
+            header_min, header_max = f.header.mins, f.header.maxs
+            if (header_max[0] < min_x or header_min[0] >= max_x or header_max[1] < min_y or header_min[1] >= max_y
+                    or not f.header.point_count):
+                continue
+            for points in f.chunk_iterator(chunk_size):
+                x, y, z = np.asarray(points.x), np.asarray(points.y), np.asarray(points.z)
+                mask = (x >= min_x) & (x < max_x) & (y >= min_y) & (y < max_y)
+                if ground_classes is not None:
+                    mask &= np.isin(points['classification'], ground_classes)
+                ix = np.minimum(((x[mask] - min_x) / resolution).astype(int), shape[1] - 1)
+                iy = np.minimum(((y[mask] - min_y) / resolution).astype(int), shape[0] - 1)
+                np.minimum.at(elevation, iy * shape[1] + ix, z[mask])
+    elevation[np.isinf(elevation)] = np.nan
+    return elevation.reshape(shape)
+
+
+def fill_gaps(elevation):
+    """ Fill the cells without ground (NaN) with the value of the nearest cell with ground. """
+    gaps = np.isnan(elevation)
+    if gaps.all():
+        raise ValueError('No ground cells to fill the gaps from')
+    if gaps.any():
+        indices = ndimage.distance_transform_edt(gaps, return_distances=False, return_indices=True)
+        elevation = elevation[tuple(indices)]
+    return elevation
+
+
+def interpolate(elevation, origin, resolution, x, y):
+    """
+    Bilinear interpolation of a grid with values at the centers of the cells,
+    constant beyond the centers of the outer cells.
+
+    :param elevation: 2D array, rows along y and columns along x
+    :param origin: (min_x, min_y) of the grid
+    :param resolution: side of the cells
+    """
+    rows, columns = elevation.shape
+    fx = np.clip((x - origin[0]) / resolution - 0.5, 0, columns - 1)
+    fy = np.clip((y - origin[1]) / resolution - 0.5, 0, rows - 1)
+    ix = np.clip(np.floor(fx).astype(int), 0, max(columns - 2, 0))
+    iy = np.clip(np.floor(fy).astype(int), 0, max(rows - 2, 0))
+    ix1, iy1 = np.minimum(ix + 1, columns - 1), np.minimum(iy + 1, rows - 1)
+    wx, wy = fx - ix, fy - iy
+    return ((elevation[iy, ix] * (1 - wx) + elevation[iy, ix1] * wx) * (1 - wy)
+            + (elevation[iy1, ix] * (1 - wx) + elevation[iy1, ix1] * wx) * wy)
+
+
+class GridNormalization(PipelineRemoteData):
+    """ Normalize the heights of a retiled tile against a ground grid, streaming its points. """
+
+    def __init__(self, input=None, label=None):
+        self.pipeline = ('build_ground_grid', 'normalize_points')
+        self.elevation = None
+        self.origin = None
+        self.resolution = None
+        if input is not None:
+            self.input_path = input
+        if label is not None:
+            self.label = label
+
+    def build_ground_grid(self, min_x, max_x, min_y, max_y, n_tiles_side, resolution=GROUND_RESOLUTION,
+                          halo=HALO, ground_classes=None):
+        """
+        Build the ground grid of the tile and of a halo around it, read from
+        the neighbouring tiles in the input folder.
+
+        :param min_x: Min x value of the tiling schema
+        :param max_x: Max x value of the tiling schema
+        :param min_y: Min y value of the tiling schema
+        :param max_y: Max y value of the tiling schema
+        :param n_tiles_side: Number of tiles along X and Y (tiling MUST be square)
+        :param resolution: (Optional) side of the cells of the ground grid
+        :param halo: (Optional) width of the border read from the neighbouring tiles
+        :param ground_classes: (Optional) classes of the ground points (e.g. [2]), all points if not given
+        """
+        check_path_exists(self.input_path, should_exist=True)
+        tile_x, tile_y = tile_index_from_name(self.input_path.name)
+        tile_width = (max_x - min_x) / n_tiles_side
+        tile_min_x, tile_min_y = min_x + tile_x * tile_width, min_y + tile_y * tile_width
+        cells_halo = int(np.ceil(halo / resolution))
+        bounds = (tile_min_x - cells_halo * resolution, tile_min_y - cells_halo * resolution,
+                  tile_min_x + tile_width + cells_halo * resolution, tile_min_y + tile_width + cells_halo * resolution)
+
+        files = las_files(self.input_path)
+        if cells_halo:
+            for dx in (-1, 0, 1):
+                for dy in (-1, 0, 1):
+                    neighbour = self.input_path.parent / 'tile_{}_{}'.format(tile_x + dx, tile_y + dy)
+                    if (dx or dy) and neighbour.exists():
+                        files += las_files(neighbour)
+
+        logger.info('Building the ground grid from {} files ...'.format(len(files)))
+        elevation = ground_grid(files, bounds, resolution, ground_classes)
+        if np.isnan(elevation).all() and ground_classes is not None:
+            logger.warning('No ground points in classes {}: using the lowest points'.format(ground_classes))
+            elevation = ground_grid(files, bounds, resolution)
+        logger.info('... {:.1%} of the cells with ground.'.format(np.mean(~np.isnan(elevation))))
+        self.elevation = fill_gaps(elevation)
+        self.origin = bounds[:2]
+        self.resolution = resolution
+        return self
+
+    def normalize_points(self, filename='', max_z=None, overwrite=False, point_format=3, file_version='1.2',
+                         chunk_size=CHUNK_SIZE):
+        """
+        Write the points of the tile with their normalized height, chunk by
+        chunk.
+
+        :param filename: optional filename where to write point-cloud data, <tile name>.laz by default
+        :param max_z: (Optional) drop the points at or above this height (e.g. non-physical outliers)
+        :param overwrite: if file exists, overwrite
+        :param point_format: (Optional) point format of the output, default 3 as laserchicken's export
+        :param file_version: (Optional) LAS version of the output
+        :param chunk_size: (Optional) points read and written at once
+        """
+        if self.elevation is None:
+            raise ValueError('The ground grid must be built before normalizing the points')
+        output_path = self.output_folder / (filename or '{}.laz'.format(self.input_path.name))
+        if not overwrite:
+            check_file_exists(output_path, should_exist=False)
+        files = las_files(self.input_path)
+        headers = []
+        for file in files:
+            with laspy.open(file.as_posix()) as f:
+                headers.append(f.header)
+
+        header = laspy.LasHeader(point_format=point_format, version=file_version)
+        header.offsets = np.min([h.mins for h in headers], axis=0)
+        header.scales = np.full(3, 0.001)
+        extra_dimensions = {}
+        for h in headers:
+            for dimension in h.point_format.extra_dimensions:
+                extra_dimensions.setdefault(dimension.name, dimension.dtype)
+        extra_dimensions[normalized_height] = np.float64
+        header.add_extra_dims([laspy.ExtraBytesParams(name=name, type=dtype)
+                               for name, dtype in extra_dimensions.items()])
+        dimensions = set(header.point_format.dimension_names) - {'X', 'Y', 'Z', normalized_height}
+
+        logger.info('Normalizing {} files ...'.format(len(files)))
+        n_points = 0
+        with laspy.open(output_path.as_posix(), mode='w', header=header, laz_backend=laz_backend() or None) as out:
+            for file in files:
+                with laspy.open(file.as_posix(), laz_backend=laz_backend() or None) as f:
+                    file_dimensions = dimensions & set(f.header.point_format.dimension_names)
+                    for points in f.chunk_iterator(chunk_size):
+                        x, y, z = np.asarray(points.x), np.asarray(points.y), np.asarray(points.z)
+                        mask = z < max_z if max_z is not None else np.ones(len(points), dtype=bool)
+                        record = laspy.ScaleAwarePointRecord.zeros(int(mask.sum()), header=header)
+                        record.x, record.y, record.z = x[mask], y[mask], z[mask]
+                        for name in file_dimensions:
+                            record[name] = np.asarray(points[name])[mask]
+                        record[normalized_height] = z[mask] - interpolate(self.elevation, self.origin,
+                                                                          self.resolution, x[mask], y[mask])
+                        out.write_points(record)
+                        n_points += len(record)
+        logger.info('... {} points written to {}.'.format(n_points, output_path))
+        return self
@@ -0,0 +1,231 @@
+"""
+Loading of LAS/LAZ files with projection and predicate pushdown.
+
+laserchicken reads every point and every dimension of a file before the
+pipeline selects the attributes and filters the points (e.g. only the wire
+conductors, class 14, for the powerline mask). read_las streams the file
+in chunks instead, and:
+
+- decompresses only the LAZ layers of the needed dimensions: x, y and the
+  returns are always decoded, the other layers (z, classification,
+  intensity, gps_time, ...) only if an attribute or the predicate needs
+  them. Layers exist in the point formats 6-10 (LAZ 1.4); older formats are
+  decoded in full;
+- evaluates the predicate on every chunk, so only the selected points are
+  kept in memory.
+
+A predicate is a dict with any of:
+
+    'classes': [14]           # classification in the list
+    'return_number': [1]      # return number in the list
+    'z_range': [-10., 100.]   # min <= z <= max
+
+PushdownDataProcessing is a DataProcessing whose load step takes the
+predicate, so a pipeline input only changes in its load entry:
+
+    'load': {'attributes': ['raw_classification', 'normalized_height'],
+             'predicate': {'classes': [14]}},
+"""
+
+import logging
+import pathlib
+
+import laspy
+import numpy as np
+from laserchicken.io import io_handlers
+from laserchicken.io.las_handler import DEFAULT_LAS_ATTRIBUTES
+from laserchicken.io.load import load as laserchicken_load
+from laserchicken.io.utils import select_valid_attributes
+from laserchicken.keys import point
+from laserchicken.utils import add_to_point_cloud
+
+from laserfarm import DataProcessing
+from laserfarm.utils import check_path_exists
+
+from AHN_laz_splitter import laz_backend
+
+
+logger = logging.getLogger(__name__)
+
+LAS_SUFFIXES = ('.las', '.laz')
+# points decoded per chunk
+CHUNK_SIZE = 2 * 10**6
+PREDICATE_KEYS = ('classes', 'return_number', 'z_range')
+Selection = laspy.DecompressionSelection
+# LAZ layer of the dimensions of the point formats 6-10 (x, y and the returns are always decoded)
+DIMENSION_LAYERS = {
+    'z': Selection.Z,
+    'classification': Selection.CLASSIFICATION,
+    'raw_classification': Selection.CLASSIFICATION,
+    'synthetic': Selection.FLAGS,
+    'key_point': Selection.FLAGS,
+    'withheld': Selection.FLAGS,
+    'overlap': Selection.FLAGS,
+    'classification_flags': Selection.FLAGS,
+    'scan_direction_flag': Selection.FLAGS,
+    'edge_of_flight_line': Selection.FLAGS,
+    'intensity': Selection.INTENSITY,
+    'scan_angle': Selection.SCAN_ANGLE,
+    'user_data': Selection.USER_DATA,
+    'point_source_id': Selection.POINT_SOURCE_ID,
+    'gps_time': Selection.GPS_TIME,
+    'red': Selection.RGB,
+    'green': Selection.RGB,
+    'blue': Selection.RGB,
+    'nir': Selection.NIR,
+    'wavepacket_index': Selection.WAVEPACKET,
+    'wavepacket_offset': Selection.WAVEPACKET,
+    'wavepacket_size': Selection.WAVEPACKET,
+    'return_point_wave_location': Selection.WAVEPACKET,
+    'x_t': Selection.WAVEPACKET,
+    'y_t': Selection.WAVEPACKET,
+    'z_t': Selection.WAVEPACKET,
+}
+# dimensions of the first layer, always decoded
+ALWAYS_DECODED = {'x', 'y', 'bit_fields', 'return_number', 'number_of_returns', 'scanner_channel'}
+# dimensions read to evaluate each predicate
+PREDICATE_DIMENSIONS = {'classes': 'classification', 'return_number': 'return_number', 'z_range': 'z'}
+
+
+def check_predicate(predicate):
+    """ Raise a ValueError if the predicate has unknown keys or an invalid z range. """
+    invalid = [key for key in predicate if key not in PREDICATE_KEYS]
+    if invalid:
+        raise ValueError('Invalid predicate keys: {}. Valid keys: {}'.format(', '.join(invalid),
+                                                                             ', '.join(PREDICATE_KEYS)))
+    if 'z_range' in predicate and len(predicate['z_range']) != 2:
+        raise ValueError('z_range must be [min, max]! Got instead: {}'.format(predicate['z_range']))
+
+
+def decompression_selection(attributes, predicate=None):
+    """
+    LAZ layers to decompress to read the attributes and evaluate the predicate.
+
+    :param attributes: names of the attributes of the point cloud
+    :param predicate: (Optional) predicate dict
+    """
+    names = set(attributes) | set(PREDICATE_DIMENSIONS[key] for key in (predicate or {}))
+    selection = Selection.XY_RETURNS_CHANNEL
+    for name in names - ALWAYS_DECODED:
+        # dimensions that are not standard are extra bytes
+        selection |= DIMENSION_LAYERS.get(name, Selection.ALL_EXTRA_BYTES)
+    return selection
+
+
+def predicate_mask(points, predicate):
+    """ Mask of the points of a laspy point record that satisfy the predicate. """
+    mask = np.ones(len(points), dtype=bool)
+    if 'classes' in predicate:
+        mask &= np.isin(points['classification'], predicate['classes'])
+    if 'return_number' in predicate:
+        mask &= np.isin(points['return_number'], predicate['return_number'])
+    if 'z_range' in predicate:
+        z = np.asarray(points.z)
+        mask &= (z >= predicate['z_range'][0]) & (z <= predicate['z_range'][1])
+    return mask
+
+
+def point_cloud_mask(point_cloud, predicate):
+    """
+    Mask of the points of a point cloud in memory that satisfy the predicate,
+    for feature sets that share a load with other sets. The classification is
+    read from 'classification', or from the class bits of 'raw_classification'.
+    """
+    check_predicate(predicate)
+    points = point_cloud[point]
+    mask = np.ones(len(points['x']['data']), dtype=bool)
+    if 'classes' in predicate:
+        classification = points['classification']['data'] if 'classification' in points \
+            else points['raw_classification']['data'] & 0x1F
+        mask &= np.isin(classification, predicate['classes'])
+    if 'return_number' in predicate:
+        mask &= np.isin(points['return_number']['data'], predicate['return_number'])
+    if 'z_range' in predicate:
+        z = points['z']['data']
+        mask &= (z >= predicate['z_range'][0]) & (z <= predicate['z_range'][1])
+    return mask
+
+
+def available_attributes(point_format):
+    """ Attributes of a point format, named as by the laserchicken LAS reader. """
+    names = list(point_format.dimension_names) + list(point_format.dtype().fields.keys())
+    return list(set(el if el not in ['X', 'Y', 'Z'] else el.lower() for el in names))
+
+
+def read_las(path, attributes=DEFAULT_LAS_ATTRIBUTES, predicate=None, chunk_size=CHUNK_SIZE):
+    """
+    Read the points of a LAS/LAZ file that satisfy a predicate, decoding only
+    the dimensions that are needed.
+
+    :param path: LAS/LAZ file
+    :param attributes: list of attributes to read ('all' for all attributes in file)
+    :param predicate: (Optional) predicate dict (classes, return_number, z_range)
+    :param chunk_size: (Optional) points decoded at once
+    :return: point cloud data structure
+    """
+    predicate = predicate or {}
+    check_predicate(predicate)
+    with laspy.open(pathlib.Path(path).as_posix()) as f:
+        attributes = list(dict.fromkeys(select_valid_attributes(available_attributes(f.header.point_format),
+                                                                attributes)))
+    # the layers to decompress are set when the file is opened
+    with laspy.open(pathlib.Path(path).as_posix(), laz_backend=laz_backend() or None,
+                    decompression_selection=decompression_selection(attributes, predicate)) as f:
+        n_total = f.header.point_count
+        chunks = {name: [] for name in attributes}
+        for points in f.chunk_iterator(chunk_size):
+            mask = predicate_mask(points, predicate) if predicate else slice(None)
+            for name in attributes:
+                chunks[name].append(np.array(points[name])[mask])
+        if not n_total:
+            empty = laspy.ScaleAwarePointRecord.zeros(0, header=f.header)
+            for name in attributes:
+                chunks[name].append(np.array(empty[name]))
+
+    points = {}
+    for name, data in chunks.items():
+        data = np.concatenate(data)
+        points[name] = {'type': data.dtype.name, 'data': data}
+    logger.info('{}: {} of {} points'.format(pathlib.Path(path).name, len(points['x']['data']), n_total))
+    return {point: points}
+
+
+class PushdownDataProcessing(DataProcessing):
+    """ DataProcessing reading LAS/LAZ files with projection and predicate pushdown. """
+
+    def __init__(self, input=None, label=None, tile_index=(None, None)):
+        super(PushdownDataProcessing, self).__init__(input, label=label, tile_index=tile_index)
+        self.predicate = None
+
+    def load(self, attributes=DEFAULT_LAS_ATTRIBUTES, predicate=None, **load_opts):
+        """
+        Read point cloud from disk, keeping only the points that satisfy the
+        predicate.
+
+        :param attributes: list of attributes to read ('all' for all attributes in file)
+        :param predicate: (Optional) dict with any of 'classes', 'return_number'
+        (lists of values) and 'z_range' ([min, max])
+        :param load_opts: Arguments passed to the laserchicken load function
+        (files other than LAS/LAZ)
+        """
+        check_path_exists(self.input_path, should_exist=True)
+        input_path = pathlib.Path(self.input_path)
+        if input_path.is_dir():
+            input_file_list = sorted(f for f in input_path.iterdir() if f.suffix.lower() in io_handlers)
+            if not input_file_list:
+                raise FileNotFoundError('No point-cloud file in: {}'.format(input_path))
+        else:
+            input_file_list = [input_path]
+        logger.info('Loading point cloud data ...')
+        for file in input_file_list:
+            logger.info('... loading {}'.format(file))
+            if file.suffix.lower() in LAS_SUFFIXES:
+                point_cloud = read_las(file, attributes=attributes, predicate=predicate)
+            elif predicate:
+                raise ValueError('Predicate pushdown is only supported for LAS/LAZ files: {}'.format(file))
+            else:
+                point_cloud = laserchicken_load(file.as_posix(), attributes=attributes, **load_opts)
+            add_to_point_cloud(self.point_cloud, point_cloud)
+        self.predicate = predicate
+        logger.info('... loading completed.')
+        return self
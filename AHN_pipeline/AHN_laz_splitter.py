@@ -0,0 +1,209 @@
+#!/usr/bin/env python3
+
+
+"""
+Split large LAS/LAZ files (e.g. the AHN4 sheets) into files of at most about
+max_filesize bytes, reading every input file once.
+
+Points are streamed with a chunk iterator and written to a writer that is
+rotated as soon as it holds the number of points that fit in max_filesize.
+The number is derived from the bytes per point of the input itself, so it is
+not a fixed compression factor. LAZ is decompressed and compressed with the
+multi-threaded lazrs backend if it is installed.
+
+With spatial=True the points of a file are routed to the cells of a grid,
+optionally aligned to the retiling grid. Every output file then covers one
+compact cell instead of a stripe of the acquisition order, so a Retiler task
+on a split file writes to few target tiles. Output files are numbered along
+a Morton (Z-order) curve of the cells, so consecutive files are neighbours.
+
+    ./AHN_laz_splitter.py /project/lidarac/Data/AHN4/las/C_25DZ2.LAZ --max-filesize 250 --spatial
+"""
+
+
+import argparse
+import math
+import os
+
+import laspy
+import numpy as np
+
+
+DEFAULT_MAX_FILESIZE = 250 * 2**20
+# points read per chunk, ~100 MB of point records
+DEFAULT_CHUNK_SIZE = 2 * 10**6
+# output backends in order of preference: multi-threaded first
+LAZ_BACKENDS = (laspy.LazBackend.LazrsParallel, laspy.LazBackend.Lazrs, laspy.LazBackend.Laszip)
+# 16 bits per axis in the Morton code
+MAX_GRID_CELLS_SIDE = 2**16
+
+
+def laz_backend():
+    """ Available LAZ backends, multi-threaded ones first. """
+    return tuple(backend for backend in LAZ_BACKENDS if backend.is_available())
+
+
+def points_per_file(header, file_size, max_filesize):
+    """
+    Points per output file for files of at most max_filesize bytes, with the
+    same bytes per point on disk (after compression) as the input file.
+    """
+    if header.point_count == 0:
+        return 1
+    bytes_per_point = max(file_size - header.offset_to_point_data, 1) / header.point_count
+    return max(int((max_filesize - header.offset_to_point_data) / bytes_per_point), 1)
+
+
+def morton_code(ix, iy):
+    """ Interleave the bits of two arrays of cell indices (< 2**16). """
+    def spread(values):
+        values = values.astype(np.uint64) & np.uint64(0xFFFF)
+        values = (values | (values << np.uint64(8))) & np.uint64(0x00FF00FF)
+        values = (values | (values << np.uint64(4))) & np.uint64(0x0F0F0F0F)
+        values = (values | (values << np.uint64(2))) & np.uint64(0x33333333)
+        values = (values | (values << np.uint64(1))) & np.uint64(0x55555555)
+        return values
+    return spread(np.asarray(ix)) | (spread(np.asarray(iy)) << np.uint64(1))
+
+
+def split_grid(header, n_points_target, grid=None):
+    """
+    Grid of square cells expected to hold n_points_target points each, given
+    the point density over the bounds of header. If grid (the retiling grid
+    dict with min_x, max_x, min_y, n_tiles_side) is given, cells are aligned
+    to it and their side is a multiple of its tile length. Returns origin,
+    cell side and the number of cells along x and y.
+    """
+    min_x, min_y = header.mins[0], header.mins[1]
+    max_x, max_y = header.maxs[0], header.maxs[1]
+    area = max(max_x - min_x, 1.) * max(max_y - min_y, 1.)
+    side = math.sqrt(area * n_points_target / max(header.point_count, 1))
+
+    if grid is not None:
+        tile_length = (grid['max_x'] - grid['min_x']) / grid['n_tiles_side']
+        side = tile_length * max(1, round(side / tile_length))
+        origin_x = grid['min_x'] + math.floor((min_x - grid['min_x']) / side) * side
+        origin_y = grid['min_y'] + math.floor((min_y - grid['min_y']) / side) * side
+    else:
+        origin_x, origin_y = min_x, min_y
+
+    n_x = min(max(math.ceil((max_x - origin_x) / side), 1), MAX_GRID_CELLS_SIDE)
+    n_y = min(max(math.ceil((max_y - origin_y) / side), 1), MAX_GRID_CELLS_SIDE)
+    return (origin_x, origin_y), side, (n_x, n_y)
+
+
+class RotatingWriter:
+    """
+    Write points to a sequence of files of at most max_points points each,
+    opening the next file when the current one is full.
+    """
+
+    def __init__(self, header, filename_for, max_points, do_compress, backend=None):
+        self.header = header
+        self.filename_for = filename_for
+        self.max_points = max_points
+        self.do_compress = do_compress
+        self.backend = backend
+        self.writer = None
+        self.files = []
+
+    def _open(self):
+        filename = self.filename_for(len(self.files))
+        self.writer = laspy.open(filename, mode='w', header=self.header,
+                                 do_compress=self.do_compress, laz_backend=self.backend)
+        self.files.append([filename, 0])
+
+    def write(self, points):
+        start = 0
+        while start < len(points):
+            if self.writer is None:
+                self._open()
+            n_points = min(self.max_points - self.files[-1][1], len(points) - start)
+            self.writer.write_points(points[start:start + n_points])
+            self.files[-1][1] += n_points
+            start += n_points
+            if self.files[-1][1] == self.max_points:
+                self.close()
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+
+
+def split_laz(filename, max_filesize=DEFAULT_MAX_FILESIZE, out_dir=None, spatial=False, grid=None,
+              chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Split a LAS/LAZ file in a single pass into files of at most about
+    max_filesize bytes, named <stem>-<n><ext> in out_dir (default the
+    directory of the input file). With spatial=True points are grouped by the
+    cells of a (retiling) grid and files are numbered in Morton order of the
+    cells. Returns a list of (output filename, number of points).
+    """
+    stem, ext = os.path.splitext(os.path.basename(filename))
+    out_dir = out_dir if out_dir is not None else os.path.dirname(os.path.abspath(filename))
+    do_compress = ext.lower() == '.laz'
+    backend = laz_backend()
+
+    with laspy.open(filename, laz_backend=backend or None) as in_file:
+        header = in_file.header
+        n_points_target = points_per_file(header, os.path.getsize(filename), max_filesize)
+
+        if not spatial:
+            writer = RotatingWriter(header, lambda part: os.path.join(out_dir, f'{stem}-{part}{ext}'),
+                                    n_points_target, do_compress, backend)
+            try:
+                for points in in_file.chunk_iterator(chunk_size):
+                    writer.write(points)
+            finally:
+                writer.close()
+            return [tuple(item) for item in writer.files]
+
+        (origin_x, origin_y), side, (n_x, n_y) = split_grid(header, n_points_target, grid)
+        writers = {}
+        try:
+            for points in in_file.chunk_iterator(chunk_size):
+                ix = np.clip(np.floor((points.x - origin_x) / side), 0, n_x - 1)
+                iy = np.clip(np.floor((points.y - origin_y) / side), 0, n_y - 1)
+                codes = morton_code(ix, iy)
+                order = np.argsort(codes, kind='stable')
+                cell_codes, starts = np.unique(codes[order], return_index=True)
+                ends = np.append(starts[1:], len(order))
+                for code, start, end in zip(cell_codes.tolist(), starts, ends):
+                    if code not in writers:
+                        # temporary names, renamed in Morton order when all cells are known
+                        writers[code] = RotatingWriter(
+                            header, lambda part, code=code: os.path.join(out_dir, f'{stem}-z{code}_{part}{ext}.tmp'),
+                            n_points_target, do_compress, backend)
+                    writers[code].write(points[order[start:end]])
+        finally:
+            for writer in writers.values():
+                writer.close()
+
+    files = []
+    for code in sorted(writers):
+        for tmp_filename, n_points in writers[code].files:
+            out_filename = os.path.join(out_dir, f'{stem}-{len(files)}{ext}')
+            os.replace(tmp_filename, out_filename)
+            files.append((out_filename, n_points))
+    return files
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Split LAS/LAZ files in a single pass per file')
+    parser.add_argument('files', nargs='+', help='LAS/LAZ files to split')
+    parser.add_argument('--max-filesize', type=float, default=DEFAULT_MAX_FILESIZE / 2**20,
+                        help='maximum size of the output files in MB')
+    parser.add_argument('-o', '--out-dir', default=None, help='output directory, default that of each input file')
+    parser.add_argument('--spatial', action='store_true', help='split into compact grid cells instead of acquisition order')
+    parser.add_argument('--chunk-size', type=int, default=DEFAULT_CHUNK_SIZE, help='points read at once')
+    args = parser.parse_args()
+
+    for filename in args.files:
+        files = split_laz(filename, int(args.max_filesize * 2**20), args.out_dir, args.spatial,
+                          chunk_size=args.chunk_size)
+        print('{}: {} points in {} files'.format(filename, sum(n for _, n in files), len(files)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,262 @@
+"""
+Tile index of the TOP10NL polygons for the classification of the targets.
+
+The Classification pipeline of laserfarm checks the bounding box of every
+shapefile in the TOP10NL directory for every tile, and then tests the
+targets of the tile against all the polygons of the shapefiles it overlaps,
+polygon by polygon. PolygonIndex assigns the polygons to the tiles of the
+grid once: each shapefile is read once, its polygons are matched to the
+tiles with a bulk STRtree query, clipped to the tiles and stored per tile
+and shapefile as WKB. The index is kept on disk and only rebuilt if the
+shapefiles or the grid change.
+
+IndexedClassification then reads the polygons of its tile only, and marks
+the targets in any of them with a single bulk point-in-polygon query
+(shapely STRtree), the same criterion as laserchicken's select_polygon
+(points on the boundaries are outside). The mask can be exported as the
+PLY targets, as before, or straight to a staging mosaic (see
+AHN_cog_mosaic).
+
+    index = PolygonIndex.build(shp_dir, index_dir, grid)
+    classification_input = {'setup_local_fs': {...},
+                            'locate_polygons': {'index_dir': index_dir},
+                            'classification': {'ground_type': 1},
+                            'export_point_cloud': {}}
+    IndexedClassification('tile_123_456.ply').config(classification_input).run()
+"""
+
+import concurrent.futures
+import hashlib
+import json
+import logging
+import os
+import pathlib
+import shutil
+
+import numpy as np
+import shapefile
+import shapely
+from laserchicken.keys import point
+from laserchicken.io.load import load
+from laserchicken.utils import get_point, update_feature
+
+from laserfarm import Classification
+from laserfarm.utils import check_dir_exists, check_file_exists
+
+from AHN_cog_mosaic import MosaicStaging
+from AHN_feature_sets import tile_index_from_name
+
+
+logger = logging.getLogger(__name__)
+
+INDEX_FILE = 'index.json'
+TILES_FOLDER = 'tiles'
+INDEX_VERSION = 1
+# shapely type ids of Polygon and MultiPolygon
+POLYGON_TYPES = (3, 6)
+# the polygons are clipped to the tiles grown by this margin, so that points on
+# the edges of a tile are not on the edges of the clipped polygons
+CLIP_MARGIN = 1.
+
+
+def _fingerprint(shp_files):
+    """ Fingerprint of the shapefiles (with their .dbf/.shx), from names, sizes and modification times. """
+    entries = []
+    for shp in shp_files:
+        for path in sorted(shp.parent.glob(shp.stem + '.*')):
+            stat = path.stat()
+            entries.append((path.name, stat.st_size, stat.st_mtime_ns))
+    return hashlib.sha256(json.dumps(entries).encode('utf-8')).hexdigest()
+
+
+def read_polygons(shp):
+    """ Polygons (and multipolygons) of a shapefile, as a shapely geometry array. """
+    with shapefile.Reader(pathlib.Path(shp).as_posix()) as sf:
+        geometries = shapely.from_geojson([json.dumps(s.__geo_interface__) for s in sf.iterShapes()
+                                           if s.shapeType != shapefile.NULL])
+    geometries = geometries[np.isin(shapely.get_type_id(geometries), POLYGON_TYPES)]
+    return geometries
+
+
+def _write_geometries(path, geometries):
+    """ Write a geometry array as concatenated WKB with offsets. """
+    wkb = shapely.to_wkb(geometries)
+    offsets = np.cumsum([0] + [len(el) for el in wkb])
+    np.savez(path, wkb=np.frombuffer(b''.join(wkb), dtype=np.uint8), offsets=offsets)
+
+
+def _read_geometries(path):
+    data = np.load(path)
+    wkb, offsets = data['wkb'].tobytes(), data['offsets']
+    return shapely.from_wkb([wkb[start:end] for start, end in zip(offsets[:-1], offsets[1:])])
+
+
+def _index_shapefile(shp, index_dir, grid):
+    """
+    Assign the polygons of a shapefile to the tiles of the grid, writing the
+    polygons clipped to each tile to tiles/<tile>/<shapefile>.npz.
+
+    :return: names of the tiles with polygons
+    """
+    geometries = read_polygons(shp)
+    if not len(geometries):
+        return []
+    tile_width = (grid['max_x'] - grid['min_x']) / grid['n_tiles_side']
+    min_x, min_y, max_x, max_y = shapely.total_bounds(geometries)
+    tiles_x = np.arange(max(int((min_x - grid['min_x']) // tile_width), 0),
+                        min(int((max_x - grid['min_x']) // tile_width), grid['n_tiles_side'] - 1) + 1)
+    tiles_y = np.arange(max(int((min_y - grid['min_y']) // tile_width), 0),
+                        min(int((max_y - grid['min_y']) // tile_width), grid['n_tiles_side'] - 1) + 1)
+    tiles_x, tiles_y = [el.ravel() for el in np.meshgrid(tiles_x, tiles_y)]
+    boxes = shapely.box(grid['min_x'] + tiles_x * tile_width, grid['min_y'] + tiles_y * tile_width,
+                        grid['min_x'] + (tiles_x + 1) * tile_width, grid['min_y'] + (tiles_y + 1) * tile_width)
+
+    # all (tile, polygon) pairs at once, grouped by tile
+    tile_indices, polygon_indices = shapely.STRtree(geometries).query(boxes, predicate='intersects')
+    order = np.argsort(tile_indices, kind='stable')
+    tile_indices, polygon_indices = tile_indices[order], polygon_indices[order]
+    tile_numbers, starts = np.unique(tile_indices, return_index=True)
+    tiles = []
+    for n, start, end in zip(tile_numbers, starts, np.append(starts[1:], len(tile_indices))):
+        min_x, min_y, max_x, max_y = shapely.bounds(boxes[n])
+        clipped = shapely.clip_by_rect(geometries[polygon_indices[start:end]], min_x - CLIP_MARGIN,
+                                       min_y - CLIP_MARGIN, max_x + CLIP_MARGIN, max_y + CLIP_MARGIN)
+        clipped = clipped[~shapely.is_empty(clipped)]
+        if not len(clipped):
+            continue
+        name = 'tile_{}_{}'.format(tiles_x[n], tiles_y[n])
+        tile_dir = pathlib.Path(index_dir) / TILES_FOLDER / name
+        tile_dir.mkdir(parents=True, exist_ok=True)
+        _write_geometries(tile_dir / '{}.npz'.format(pathlib.Path(shp).stem), clipped)
+        tiles.append(name)
+    logger.info('{}: {} polygons in {} tiles'.format(pathlib.Path(shp).name, len(geometries), len(tiles)))
+    return tiles
+
+
+class PolygonIndex(object):
+    """
+    Polygons of a set of shapefiles by tile of the grid, stored in index_dir.
+
+    :param index_dir: folder of the index, as built by PolygonIndex.build
+    """
+
+    def __init__(self, index_dir):
+        self.index_dir = pathlib.Path(index_dir)
+        with open(self.index_dir / INDEX_FILE, 'r') as f:
+            metadata = json.load(f)
+        self.grid = metadata['grid']
+        self.tiles = set(metadata['tiles'])
+
+    @classmethod
+    def build(cls, shp_dir, index_dir, grid, n_processes=None, rebuild=False):
+        """
+        Build the index of the polygons in the shapefiles of shp_dir, in
+        parallel over the shapefiles. An index built from the same shapefiles
+        and grid is reused.
+
+        :param shp_dir: directory with the shapefiles (e.g. of the TOP10NL buildings, roads and water)
+        :param index_dir: folder of the index, on a file system shared by the workers
+        :param grid: retiling schema (min_x, max_x, min_y, max_y, n_tiles_side)
+        :param n_processes: (Optional) number of processes, default the number of cores
+        :param rebuild: (Optional) rebuild the index even if it is up to date
+        """
+        shp_dir, index_dir = pathlib.Path(shp_dir), pathlib.Path(index_dir)
+        check_dir_exists(shp_dir, should_exist=True)
+        shp_files = sorted(f.absolute() for f in shp_dir.iterdir() if f.suffix == '.shp')
+        grid = {key: grid[key] for key in ('min_x', 'max_x', 'min_y', 'max_y', 'n_tiles_side')}
+        metadata = {'version': INDEX_VERSION, 'grid': grid, 'sources': _fingerprint(shp_files)}
+
+        if (index_dir / INDEX_FILE).exists() and not rebuild:
+            with open(index_dir / INDEX_FILE, 'r') as f:
+                existing = json.load(f)
+            if all(existing.get(key) == value for key, value in metadata.items()):
+                logger.info('Polygon index {} is up to date'.format(index_dir))
+                return cls(index_dir)
+        if (index_dir / TILES_FOLDER).exists():
+            shutil.rmtree(index_dir / TILES_FOLDER)
+        check_dir_exists(index_dir / TILES_FOLDER, should_exist=True, mkdir=True)
+
+        logger.info('Indexing the polygons of {} shapefiles ...'.format(len(shp_files)))
+        tiles = set()
+        with concurrent.futures.ProcessPoolExecutor(n_processes) as executor:
+            futures = [executor.submit(_index_shapefile, shp, index_dir, grid) for shp in shp_files]
+            for future in concurrent.futures.as_completed(futures):
+                tiles.update(future.result())
+        metadata['tiles'] = sorted(tiles)
+        tmp_path = index_dir / (INDEX_FILE + '.tmp')
+        with open(tmp_path, 'w') as f:
+            json.dump(metadata, f)
+        os.replace(tmp_path, index_dir / INDEX_FILE)
+        logger.info('... {} tiles with polygons.'.format(len(tiles)))
+        return cls(index_dir)
+
+    def tile_polygons(self, tile_index):
+        """ Polygons of a tile, clipped to the tile (grown by CLIP_MARGIN). """
+        tile_dir = self.index_dir / TILES_FOLDER / 'tile_{}_{}'.format(*tile_index)
+        if not tile_dir.exists():
+            return np.empty(0, dtype=object)
+        return np.concatenate([_read_geometries(path) for path in sorted(tile_dir.glob('*.npz'))])
+
+
+def polygons_mask(polygons, x, y):
+    """ Mask of the points within any of the polygons (points on the boundaries are outside). """
+    mask = np.zeros(len(x), dtype=bool)
+    if len(polygons) and len(x):
+        points, _ = shapely.STRtree(polygons).query(shapely.points(x, y), predicate='within')
+        mask[points] = True
+    return mask
+
+
+class IndexedClassification(Classification):
+    """ Classify the targets of a tile using the polygons of the tile in a PolygonIndex. """
+
+    def __init__(self, input_file=None, label=None, tile_index=None):
+        super(IndexedClassification, self).__init__(input_file, label=label)
+        if tile_index is None and input_file is not None:
+            tile_index = tile_index_from_name(pathlib.Path(input_file).name)
+        self.tile_index = tile_index
+        self.grid = None
+        self.polygons = None
+        self.pipeline = ('locate_polygons',
+                         'classification',
+                         'export_point_cloud',
+                         'export_mosaic')
+
+    def locate_polygons(self, index_dir):
+        """
+        Load the targets and the polygons of their tile from the index.
+
+        :param index_dir: folder of the PolygonIndex
+        """
+        check_file_exists(self.input_path, should_exist=True)
+        self.point_cloud = load(self.input_path.as_posix())
+        index = PolygonIndex(index_dir)
+        self.grid = index.grid
+        self.polygons = index.tile_polygons(self.tile_index)
+        logger.info('{} polygons in tile ({},{})'.format(len(self.polygons), *self.tile_index))
+        return self
+
+    def classification(self, ground_type):
+        """
+        Classify the targets within the polygons of the tile. A new feature
+        "ground_type" will be added to the point cloud.
+
+        :param ground_type: identifier of the groud type. 0 is not identified.
+        """
+        x, y, _ = get_point(self.point_cloud, ...)
+        mask = polygons_mask(self.polygons, x, y)
+        update_feature(self.point_cloud, feature_name='ground_type', value=ground_type, array_mask=mask)
+        return self
+
+    def export_mosaic(self, staging_folder, tile_mesh_size):
+        """
+        Write the ground type of the targets to a staging mosaic on the grid
+        of the index (see AHN_cog_mosaic).
+
+        :param staging_folder: staging folder, on a file system shared by the workers
+        :param tile_mesh_size: side of the target cells
+        """
+        staging = MosaicStaging.create(staging_folder, self.grid, tile_mesh_size, ['ground_type'])
+        x, y, _ = get_point(self.point_cloud, ...)
+        staging.write_tile(self.tile_index, x, y, {'ground_type': self.point_cloud[point]['ground_type']['data']})
+        return self
@@ -0,0 +1,173 @@
+"""
+Manifest of the completed tasks of a pipeline stage, for incremental re-runs.
+
+For every input of a stage (a raw LAZ file for the retiling, a tile for the
+normalization and the feature extraction) the manifest records a fingerprint
+of the input files and a hash of the stage configuration (e.g. the
+feature_extraction_input_non_ground dict) with which it was completed. On
+the next run only the dirty inputs are run: new ones, failed ones and those
+whose files or configuration changed.
+
+The fingerprints of all inputs come from a single listing of the input
+directory (one PROPFIND for WebDAV), instead of a get_info_remote call per
+file. As the inputs of a stage are the outputs of the previous one, a file
+that is retiled again makes its tiles dirty for the normalization, and so on
+down the pipeline, while a changed feature list only makes the tiles dirty
+for the feature extraction.
+
+    manifest = StageManifest('feature_extraction_non-ground_manifest.json')
+    fingerprints = local_fingerprints(path_input, 'tile_*_*.laz')
+    tiles = manifest.dirty(fingerprints, feature_extraction_input_non_ground)
+    ... run the macro-pipeline on tiles ...
+    manifest.update(tiles, fingerprints, feature_extraction_input_non_ground, macro.outcome)
+"""
+
+import datetime
+import fnmatch
+import hashlib
+import json
+import logging
+import os
+import pathlib
+
+from laserfarm.remote_utils import get_wdclient
+from webdav3.exceptions import WebDavException
+
+
+logger = logging.getLogger(__name__)
+
+MANIFEST_VERSION = 1
+
+
+def _hash(data):
+    return hashlib.sha256(json.dumps(data, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+
+def config_hash(config):
+    """ Hash of a stage configuration (a JSON-serializable dict). """
+    return _hash(config)
+
+
+def local_fingerprints(path, pattern='*'):
+    """
+    Fingerprints of the entries of a local directory that match pattern.
+    A file is identified by its size and modification time, a directory (e.g.
+    a retiled tile) by those of all the files it contains.
+
+    :param path: directory with the inputs of a stage
+    :param pattern: glob pattern of the input names, e.g. 'tile_*_*.laz'
+    :return: {name: fingerprint}
+    """
+    fingerprints = {}
+    with os.scandir(path) as entries:
+        for entry in entries:
+            if not fnmatch.fnmatch(entry.name, pattern):
+                continue
+            if entry.is_dir():
+                files = []
+                for root, _, names in os.walk(entry.path):
+                    for name in names:
+                        stat = os.stat(os.path.join(root, name))
+                        files.append((os.path.relpath(os.path.join(root, name), entry.path),
+                                      stat.st_size, stat.st_mtime_ns))
+                fingerprints[entry.name] = _hash(sorted(files))
+            else:
+                stat = entry.stat()
+                fingerprints[entry.name] = _hash((stat.st_size, stat.st_mtime_ns))
+    return fingerprints
+
+
+def remote_fingerprints(wd_opts, remote_path, pattern='*', recursive=True):
+    """
+    Fingerprints of the entries of a remote (WebDAV) directory that match
+    pattern, from one listing. Files are identified by size, modification
+    time and etag, directories by the files they contain.
+
+    :param wd_opts: WebDAV options, as for get_wdclient
+    :param remote_path: remote directory with the inputs of a stage
+    :param pattern: glob pattern of the input names
+    :param recursive: list the content of directories as well (Depth:
+    infinity). If the server does not allow it, directories are identified by
+    their own modification time and etag.
+    :return: {name: fingerprint}
+    """
+    remote_path = pathlib.PurePosixPath(remote_path).as_posix().rstrip('/') + '/'
+    client = get_wdclient(wd_opts)
+    try:
+        infos = client.list(remote_path, get_info=True, recursive=recursive)
+    except WebDavException as e:
+        if not recursive:
+            raise
+        logger.warning('Recursive listing of {} refused ({}), listing its entries only'.format(remote_path, e))
+        recursive = False
+        infos = client.list(remote_path, get_info=True, recursive=False)
+    files = {}
+    for info in infos:
+        # paths are absolute on the server, possibly with a prefix
+        relative = info['path'].split(remote_path, 1)[-1].strip('/')
+        name = relative.split('/')[0]
+        if (info['isdir'] and recursive) or not fnmatch.fnmatch(name, pattern):
+            continue
+        files.setdefault(name, []).append((relative, info.get('size'), info.get('modified'), info.get('etag')))
+    return {name: _hash(sorted(entries, key=str)) for name, entries in files.items()}
+
+
+class StageManifest(object):
+    """
+    Inputs of a stage completed with a given configuration, stored in a JSON
+    file: {name: {'inputs': fingerprint, 'config': config hash, 'completed': date}}.
+    """
+
+    def __init__(self, path):
+        self.path = pathlib.Path(path)
+        self.records = {}
+        if self.path.exists():
+            with open(self.path, 'r') as f:
+                self.records = json.load(f)['records']
+
+    def dirty(self, fingerprints, config, names=None):
+        """
+        Inputs that have to be (re)run: not completed before, or completed with
+        other input files or another configuration.
+
+        :param fingerprints: {name: fingerprint} of the inputs
+        :param config: configuration of the stage
+        :param names: optional subset of the inputs (e.g. a file list); Path
+        objects are matched by their name and returned as given
+        """
+        names = list(fingerprints) if names is None else names
+        config_id = config_hash(config)
+        dirty = []
+        for name in names:
+            record = self.records.get(pathlib.PurePath(name).name)
+            if (record is None or record['config'] != config_id
+                    or record['inputs'] != fingerprints.get(pathlib.PurePath(name).name)):
+                dirty.append(name)
+        logger.info('{} of {} inputs to run'.format(len(dirty), len(names)))
+        return dirty
+
+    def update(self, names, fingerprints, config, outcome=None):
+        """
+        Record inputs as completed with config and save the manifest.
+
+        :param names: inputs that were run
+        :param fingerprints: {name: fingerprint} of the inputs, taken before the run
+        :param config: configuration of the stage
+        :param outcome: optional outcome per input (MacroPipeline.outcome);
+        only inputs with outcome 'finished' are recorded, failed ones are dirty
+        """
+        config_id = config_hash(config)
+        completed = datetime.datetime.now().isoformat(timespec='seconds')
+        for n, name in enumerate(names):
+            name = pathlib.PurePath(name).name
+            if outcome is not None and outcome[n] != 'finished':
+                self.records.pop(name, None)
+            elif name in fingerprints:
+                self.records[name] = {'inputs': fingerprints[name], 'config': config_id, 'completed': completed}
+        self.save()
+
+    def save(self):
+        tmp_path = self.path.with_name(self.path.name + '.tmp')
+        with open(tmp_path, 'w') as f:
+            json.dump({'version': MANIFEST_VERSION, 'records': self.records}, f, indent=1, sort_keys=True)
+        os.replace(tmp_path, self.path)
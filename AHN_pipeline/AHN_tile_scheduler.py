@@ -0,0 +1,522 @@
+#!/usr/bin/env python3
+
+
+"""
+Streaming driver for the processing stages of an AHN epoch.
+
+The notebooks run retile -> normalize -> feature extraction -> GeoTIFF export
+as separate macro-pipelines. Each notebook waits for its slowest task, so a
+tile cannot be normalized before the last input file of the country has been
+retiled. TileScheduler runs all stages on one long-lived Dask cluster as a
+graph of per-tile tasks. A tile is normalized as soon as the input files that
+overlap it are retiled, and its features are extracted as soon as it is
+normalized. Only the GeoTIFF export, which writes one raster per feature for
+all tiles (from the PLY targets or from a staging mosaic, see AHN_cog_mosaic),
+waits for the extraction of all tiles.
+
+The tiles an input file is retiled to are known from its retile record once
+it is done. Without input_bounds a tile therefore waits for all input files.
+With the bounds of the input files (e.g. from the tile catalogue) it only
+waits for the input files that overlap it.
+
+The stages are configured with the inputs of the notebooks (the JSON files
+written by their configuration cells), so the same driver runs AHN1-AHN4. The
+outcome of every stage is written to the .out and _failed.json files of the
+notebooks, which can be re-run from file as before:
+
+    stages = stage_inputs('../AHN3_processing')
+    scheduler = TileScheduler(stages, wd_opts=wd_opts, input_bounds={f: catalogue.get(f) for f in laz_files})
+    scheduler.setup_cluster(cluster=cluster)
+    scheduler.run(laz_files)
+    scheduler.print_outcome(to_dir='../AHN3_processing')
+    scheduler.shutdown()
+
+or from the command line, with the cluster of the notebooks:
+
+    ./AHN_tile_scheduler.py ../AHN3_processing --scheduler tcp://145.100.59.123:8786 --catalogue tileCatalogue.json
+"""
+
+
+import argparse
+import collections
+import copy
+import getpass
+import json
+import logging
+import math
+import os
+import pathlib
+import sys
+
+from dask.distributed import as_completed
+from laserfarm import Retiler, DataProcessing, GeotiffWriter, MacroPipeline
+from laserfarm.remote_utils import get_wdclient, list_remote
+
+from AHN_cog_mosaic import MosaicGeotiffWriter, MosaicStaging
+from AHN_feature_sets import FeatureSetExtraction, feature_sets_input, named_feature_sets, tile_index_from_name
+from AHN_fused_processing import overlapping_tiles
+from AHN_grid_normalization import GROUND_RESOLUTION, HALO, GridNormalization
+
+
+logger = logging.getLogger(__name__)
+
+WEBDAV_HOSTNAME = 'https://webdav.grid.surfsara.nl:2880'
+# stages of the graph, in order
+STAGES = ('retile', 'normalize', 'extract', 'geotiff')
+# stages that are run per tile
+TILE_STAGES = ('normalize', 'extract')
+# downstream tasks first, so that tiles move through the stages instead of queueing behind the retiling
+STAGE_PRIORITY = {'retile': 0, 'normalize': 1, 'extract': 2, 'geotiff': 3}
+# feature sets of the feature extraction and GeoTIFF export notebooks
+FEATURE_SETS = ('all', 'non-ground')
+# retiling inputs of the epochs retiled in two parts (AHN1, AHN2)
+RETILE_INPUTS = ('terrain', 'objects')
+
+
+def stage_inputs(directory):
+    """
+    Stage inputs from the JSON files written by the configuration cells of
+    the notebooks of an epoch (retile.json, or retile_terrain.json and
+    retile_objects.json for AHN1/AHN2, normalize.json,
+    feature_extraction_<set>.json and geotiff_export_input_<set>.json).
+    Stages whose files are missing are left out.
+
+    :param directory: processing directory of an epoch, e.g. ../AHN3_processing
+    """
+    directory = pathlib.Path(directory)
+
+    def read(filename):
+        path = directory / filename
+        if not path.exists():
+            return None
+        with open(path, 'r') as f:
+            return json.load(f)
+
+    retile = {name: read('retile_{}.json'.format(name)) for name in RETILE_INPUTS}
+    retile = {name: retiling_input for name, retiling_input in retile.items() if retiling_input is not None}
+    stages = {'retile': retile or read('retile.json'), 'normalize': read('normalize.json')}
+    stages['extract'] = {name: read('feature_extraction_{}.json'.format(name)) for name in FEATURE_SETS}
+    stages['geotiff'] = {name: read('geotiff_export_input_{}.json'.format(name)) for name in FEATURE_SETS}
+    for stage in ('extract', 'geotiff'):
+        stages[stage] = {name: stage_input for name, stage_input in stages[stage].items() if stage_input is not None}
+    return {stage: stage_input for stage, stage_input in stages.items() if stage_input}
+
+
+def retiling_inputs(retile):
+    """ Retiling inputs by name, from a retiling input or a dict of them by name. """
+    if not retile:
+        return {}
+    return {'retile': retile} if 'set_grid' in retile else dict(retile)
+
+
+def retile_outcome_name(name):
+    """ Name of the outcome files of a retiling input: retile.out, or retile_<name>.out for a named one. """
+    return 'retile' if name == 'retile' else 'retile_{}'.format(name)
+
+
+class RecordedRetiler(Retiler):
+    """ Retiler keeping its retile record, which lists the tiles the input file was retiled to. """
+
+    retile_record = None
+
+    def validate(self, write_record_to_file=True):
+        super(RecordedRetiler, self).validate(write_record_to_file=True)
+        record_file = self.output_folder / '{}_retile_record.js'.format(os.path.splitext(self.input_path.stem)[0])
+        with open(record_file, 'r') as f:
+            self.retile_record = json.load(f)
+        if not write_record_to_file:
+            record_file.unlink()
+        return self
+
+
+def _run_task(task):
+    """ Run a pipeline on a worker, returning its retile record if it has one. """
+    MacroPipeline._run_task(task.run)
+    return getattr(task, 'retile_record', None)
+
+
+class StageOutcome(MacroPipeline):
+    """
+    Tasks of a stage and their outcome, written like the notebooks do:
+    <name>.out, and the names of the inputs that did not finish to
+    <name>_failed.json.
+    """
+
+    def __init__(self, name):
+        super(StageOutcome, self).__init__()
+        self.name = name
+        self.inputs = list()
+
+    def add(self, task, input_name, outcome='pending'):
+        """ Add a task with the input name to list if it fails; return its index. """
+        self.tasks.append(task)
+        self.inputs.append(input_name)
+        self.outcome.append(outcome)
+        self.errors.append(None)
+        return len(self.tasks) - 1
+
+    def get_failed_inputs(self):
+        return [name for name, out in zip(self.inputs, self.outcome) if out != 'finished']
+
+    def write(self, directory='.'):
+        directory = pathlib.Path(directory)
+        self.print_outcome(to_file=(directory / '{}.out'.format(self.name)).as_posix())
+        failed = self.get_failed_inputs()
+        if failed:
+            with open(directory / '{}_failed.json'.format(self.name), 'w') as f:
+                json.dump(failed, f)
+        return failed
+
+
+class TileScheduler(MacroPipeline):
+    """
+    Run the retile, normalize, feature extraction and GeoTIFF export stages
+    as a per-tile dependency graph on one Dask cluster (see setup_cluster).
+
+    :param stages: stage inputs as written by the notebooks, see stage_inputs:
+    'retile' (a retiling input, or a dict of them by name, e.g. terrain and
+    objects for AHN1/AHN2), 'normalize', 'extract' (feature extraction inputs
+    by feature set name) and 'geotiff' (GeoTIFF export inputs by feature set
+    name, optionally with the output folder in 'setup_local_fs'). Stages can be
+    left out, e.g. to start from normalized tiles. A grid normalization input
+    (see AHN_grid_normalization) reads a halo from the neighbouring tiles:
+    with input_bounds, a tile then also waits for the input files that reach
+    into its halo.
+    :param wd_opts: WebDAV options, for retiling inputs that pull from remote
+    :param input_bounds: optional bounds (min_x, min_y, max_x, max_y) of the
+    input files to retile, by file name, which must contain all their points
+    """
+
+    def __init__(self, stages, wd_opts=None, input_bounds=None):
+        super(TileScheduler, self).__init__()
+        self.stages = stages
+        self.wd_opts = wd_opts
+        self.input_bounds = input_bounds if input_bounds is not None else {}
+        self.retile_inputs = retiling_inputs(stages.get('retile'))
+        self.feature_sets = named_feature_sets(stages['extract']) if stages.get('extract') else []
+        self.outcomes = collections.OrderedDict()
+
+    def _stage_outcome(self, name):
+        if name not in self.outcomes:
+            self.outcomes[name] = StageOutcome(name)
+        return self.outcomes[name]
+
+    def run(self, files=None, tiles=()):
+        """
+        Run the stages.
+
+        :param files: names of the input files to retile, or a dict of them by
+        retiling input name
+        :param tiles: names of tiles to process without retiling them first
+        (e.g. tile_123_456), which enter at the first per-tile stage
+        """
+        files = files if files is not None else []
+        files = files if isinstance(files, dict) else {name: files for name in self.retile_inputs}
+        self._futures = as_completed()
+        self._submitted = {}
+        self._pending = collections.Counter()
+        # input files that may still add points to tiles, with their tiles (None if unknown)
+        self._blocking = {}
+        self._blockers = collections.Counter()
+        self._unbounded = 0
+        self._retiled = set(tiles)
+        self._released = set()
+        self._geotiff_submitted = False
+
+        halo = self._normalization_halo()
+        for name, retiling_input in self.retile_inputs.items():
+            retiling_input = dict(retiling_input)
+            retiling_input.setdefault('validate', {})
+            for file in files.get(name, []):
+                bounds = self.input_bounds.get(file)
+                file_tiles = (overlapping_tiles(bounds, retiling_input['set_grid'], margin=halo)
+                              if bounds is not None else None)
+                self._blocking[file] = file_tiles
+                if file_tiles is None:
+                    self._unbounded += 1
+                else:
+                    self._blockers.update(file_tiles)
+                task = RecordedRetiler(file, label=os.path.splitext(file)[0]).config(retiling_input)
+                if 'pullremote' in retiling_input:
+                    task.setup_webdav_client(self.wd_opts)
+                self._submit('retile', [self._stage_outcome(retile_outcome_name(name))], task, file)
+
+        self._release_ready(self._retiled)
+        self._submit_geotiff_if_ready()
+        for future in self._futures:
+            stage, entries, input_name = self._submitted.pop(future.key)
+            self._pending[stage] -= 1
+            status = future.status
+            exc = future.exception() if status == 'error' else None
+            result = future.result() if status == 'finished' else None
+            future.release()
+            if stage == 'retile' and result is not None and not result['validated']:
+                logger.error('Retiled points of {} do not match the input'.format(input_name))
+                status = 'not validated'
+            for outcome, index in entries:
+                outcome.outcome[index] = status
+                if exc is not None:
+                    outcome.errors[index] = (type(exc), exc)
+
+            if stage == 'retile':
+                self._retiled_file(input_name, result)
+            elif stage in TILE_STAGES and status == 'finished':
+                self._submit_tile(input_name, after=stage)
+            self._submit_geotiff_if_ready()
+
+        # tiles still waiting for input files that failed
+        blocked = sorted(self._retiled - self._released)
+        if blocked:
+            logger.error('{} tiles not processed: their retiling has failed'.format(len(blocked)))
+        stage = self._next_tile_stage()
+        for tile in blocked if stage is not None else []:
+            task, name = self._tile_task(stage, tile)
+            for outcome in self._tile_outcomes(stage):
+                outcome.add(task, name, outcome='blocked')
+        return self
+
+    def _normalization_halo(self):
+        """ Width of the border that the normalization reads from the neighbouring tiles, in whole ground cells. """
+        grid_options = (self.stages.get('normalize') or {}).get('build_ground_grid')
+        if grid_options is None:
+            return 0.
+        resolution = grid_options.get('resolution', GROUND_RESOLUTION)
+        return math.ceil(grid_options.get('halo', HALO) / resolution) * resolution
+
+    def _submit(self, stage, outcomes, task, input_name):
+        """ Submit a task, listed in the given stage outcomes. """
+        entries = [(outcome, outcome.add(task, input_name)) for outcome in outcomes]
+        future = self.client.submit(_run_task, task, key='{}-{}'.format(outcomes[0].name, task.label),
+                                    priority=STAGE_PRIORITY[stage])
+        self._submitted[future.key] = (stage, entries, input_name)
+        self._pending[stage] += 1
+        self._futures.add(future)
+
+    def _retiled_file(self, file, record):
+        """ Release the tiles that no pending or failed input file can add points to anymore. """
+        if record is not None:
+            self._retiled.update(record['redistributed_to'])
+        if record is None or not record['validated']:
+            # the file keeps blocking its tiles
+            return
+        file_tiles = self._blocking.pop(file)
+        if file_tiles is None:
+            self._unbounded -= 1
+            self._release_ready(self._retiled)
+        else:
+            self._blockers.subtract(file_tiles)
+            self._release_ready(file_tiles | set(record['redistributed_to']))
+
+    def _release_ready(self, tiles):
+        if self._unbounded:
+            return
+        for tile in sorted(tiles):
+            if tile in self._retiled and tile not in self._released and self._blockers[tile] <= 0:
+                self._released.add(tile)
+                self._submit_tile(tile)
+
+    def _next_tile_stage(self, after=None):
+        stages = TILE_STAGES if after is None else TILE_STAGES[TILE_STAGES.index(after) + 1:]
+        for stage in stages:
+            if self.stages.get(stage):
+                return stage
+        return None
+
+    def _tile_outcomes(self, stage):
+        """ Outcomes of a per-tile stage: one per feature set for the extraction, which runs them in one task. """
+        if stage == 'normalize':
+            return [self._stage_outcome('normalize')]
+        return [self._stage_outcome('feature_extraction_{}'.format(name)) for name, _ in self.feature_sets]
+
+    def _tile_task(self, stage, tile):
+        """ Task of a per-tile stage and the input name listed if it fails, as in the notebooks. """
+        if stage == 'normalize':
+            normalization_input = copy.deepcopy(self.stages['normalize'])
+            if 'normalize_points' in normalization_input:
+                normalization_input['normalize_points'].update({'filename': '{}.laz'.format(tile), 'overwrite': True})
+                return GridNormalization(tile, label=tile).config(normalization_input), tile
+            normalization_input['export_point_cloud'] = {'filename': '{}.laz'.format(tile), 'overwrite': True}
+            return DataProcessing(tile, label=tile).config(normalization_input), tile
+        # all feature sets from one load of the tile
+        extraction_input = feature_sets_input(dict(self.feature_sets))
+        task = FeatureSetExtraction('{}.laz'.format(tile), label=tile, tile_index=tile_index_from_name(tile))
+        return task.config(extraction_input), '{}.laz'.format(tile)
+
+    def _submit_tile(self, tile, after=None):
+        stage = self._next_tile_stage(after)
+        if stage is None:
+            return
+        task, name = self._tile_task(stage, tile)
+        self._submit(stage, self._tile_outcomes(stage), task, name)
+
+    def _submit_geotiff_if_ready(self):
+        """ GeoTIFF export of every feature set, once no tile is pending. """
+        # tiles are only released when a task completes, so nothing is left to run once no task is pending
+        if (self._geotiff_submitted or not self.stages.get('geotiff')
+                or any(self._pending[stage] for stage in ('retile',) + TILE_STAGES)):
+            return
+        self._geotiff_submitted = True
+        upstream_failed = (any(outcome.get_failed_inputs() for outcome in self.outcomes.values())
+                           or bool(self._retiled - self._released))
+        extract_inputs = dict(self.feature_sets)
+        for set_name, geotiff_input in named_feature_sets(self.stages['geotiff']):
+            local_fs = geotiff_input.pop('setup_local_fs', {})
+            outcome = self._stage_outcome('geotiff_export_{}'.format(set_name))
+            for task, name in self._geotiff_tasks(set_name, geotiff_input, local_fs, extract_inputs.get(set_name)):
+                if upstream_failed:
+                    # the rasters would miss the failed tiles
+                    outcome.add(task, name, outcome='blocked')
+                else:
+                    self._submit('geotiff', [outcome], task, name)
+        if upstream_failed:
+            logger.error('GeoTIFF export not run: some tiles have failed')
+
+    @staticmethod
+    def _geotiff_tasks(set_name, geotiff_input, local_fs, extract_input=None):
+        """
+        GeoTIFF export task of every feature: from the folder of its PLY
+        targets, or from the staging mosaic written by the feature extraction
+        if the export input is a create_cog one (see AHN_cog_mosaic).
+        """
+        if 'create_cog' in geotiff_input:
+            staging = pathlib.Path(local_fs.get('input_folder') or extract_input['export_mosaic']['staging_folder'])
+            output_folder = local_fs.get('output_folder', (staging.parent / 'geotiff_{}'.format(set_name)).as_posix())
+            for feature in MosaicStaging(staging).features:
+                geotiff_input_ = copy.deepcopy(geotiff_input)
+                geotiff_input_['setup_local_fs'] = {'input_folder': staging.as_posix(),
+                                                    'output_folder': output_folder}
+                yield MosaicGeotiffWriter(band=feature, label=feature).config(geotiff_input_), feature
+            return
+        targets = pathlib.Path(local_fs.get('input_folder') or extract_input['setup_local_fs']['output_folder'])
+        output_folder = local_fs.get('output_folder', (targets.parent / 'geotiff_{}'.format(set_name)).as_posix())
+        for feature in sorted(el for el in targets.iterdir() if not el.match('tile_*_*.log')):
+            geotiff_input_ = copy.deepcopy(geotiff_input)
+            geotiff_input_['setup_local_fs'] = {'input_folder': feature.as_posix(),
+                                                'output_folder': output_folder}
+            yield GeotiffWriter(bands=feature.name, label=feature.name).config(geotiff_input_), feature.name
+
+    def print_outcome(self, to_dir=None):
+        """
+        Write the outcome of the tasks of every stage. If a directory is not
+        specified, the outcome is printed to the standard output; otherwise it
+        is written to <stage>.out and the failed inputs to <stage>_failed.json,
+        as done by the notebooks.
+
+        :param to_dir: directory path
+        """
+        for name, outcome in self.outcomes.items():
+            if to_dir is None:
+                print(name)
+                outcome.print_outcome()
+            else:
+                outcome.write(to_dir)
+
+    def get_failed_pipelines(self):
+        """ Failed (or blocked) tasks by stage outcome name. """
+        return {name: outcome.get_failed_pipelines() for name, outcome in self.outcomes.items()
+                if outcome.get_failed_pipelines()}
+
+
+def first_stage_inputs(stages, stage, wd_opts=None):
+    """
+    All inputs of the first stage run, as listed by the notebooks: the files
+    to retile by retiling input name, or the tiles.
+    """
+    if stage == 'retile':
+        files = {}
+        for name, retiling_input in retiling_inputs(stages['retile']).items():
+            if 'pullremote' in retiling_input:
+                names = list_remote(get_wdclient(wd_opts), retiling_input['pullremote'])
+            else:
+                names = os.listdir(retiling_input['setup_local_fs']['input_folder'])
+            files[name] = [el for el in names if el.lower().endswith('.laz')]
+        return files
+    if stage == 'normalize':
+        path_input = pathlib.Path(stages['normalize']['setup_local_fs']['input_folder'])
+        return [el.name for el in path_input.iterdir() if el.match('tile_*_*/')]
+    if stage == 'extract':
+        feature_set = named_feature_sets(stages['extract'])[0][1]
+        path_input = pathlib.Path(feature_set['setup_local_fs']['input_folder'])
+        return [el.stem for el in path_input.iterdir() if el.match('tile_*_*.laz')]
+    return []
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run the processing stages of an AHN epoch as a per-tile graph '
+                                                 'on one Dask cluster')
+    parser.add_argument('directory', help='processing directory of the epoch, with the JSON inputs of the notebooks; '
+                                          'the .out and _failed.json files are written there')
+    parser.add_argument('--scheduler', required=True, help='address of the Dask scheduler, e.g. tcp://10.0.1.12:43843')
+    parser.add_argument('--start', choices=STAGES, default='retile', help='first stage to run')
+    parser.add_argument('--from-file', default=None,
+                        help='JSON file with the inputs of the first stage, e.g. retile_failed.json '
+                             '(retile_terrain_failed.json for AHN1/AHN2); default all inputs')
+    parser.add_argument('--catalogue', default=None, help='tile catalogue with the bounds of the files to retile')
+    parser.add_argument('--webdav-login', default=None, help='WebDAV username, if the retiling pulls from remote')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    stages = stage_inputs(args.directory)
+    for name, geotiff_input in stages.get('geotiff', {}).items():
+        # GeoTIFFs of the targets (or of the staging mosaic) written by the feature extraction
+        if name in stages.get('extract', {}):
+            extract_input = stages['extract'][name]
+            local_fs = geotiff_input.setdefault('setup_local_fs', {})
+            local_fs.setdefault('input_folder', extract_input['export_mosaic']['staging_folder']
+                                if 'create_cog' in geotiff_input else extract_input['setup_local_fs']['output_folder'])
+    stages = {stage: stage_input for stage, stage_input in stages.items()
+              if STAGES.index(stage) >= STAGES.index(args.start)}
+    if args.start not in stages:
+        parser.error('no input for stage {} in {}'.format(args.start, args.directory))
+
+    wd_opts = None
+    if any('pullremote' in retiling_input for retiling_input in retiling_inputs(stages.get('retile')).values()):
+        login = args.webdav_login if args.webdav_login is not None else input('WebDAV username: ')
+        wd_opts = {'webdav_hostname': WEBDAV_HOSTNAME,
+                   'webdav_login': login,
+                   'webdav_password': getpass.getpass('WebDAV password: '),
+                   'webdav_timeout': 200}
+
+    if args.from_file is not None:
+        with open(args.from_file, 'r') as f:
+            inputs = json.load(f)
+        if args.start == 'extract':
+            inputs = [pathlib.Path(name).stem for name in inputs]
+        if args.start == 'retile' and not isinstance(inputs, dict):
+            # a retile_<name>_failed.json lists the files of one retiling input
+            retile_names = list(retiling_inputs(stages['retile']))
+            names = [name for name in retile_names
+                     if pathlib.Path(args.from_file).name == '{}_failed.json'.format(retile_outcome_name(name))]
+            if len(retile_names) > 1 and not names:
+                parser.error('{} is not the failed list of a retiling input: use retile_<name>_failed.json'
+                             .format(args.from_file))
+            inputs = {name: inputs for name in names or retile_names}
+    else:
+        inputs = first_stage_inputs(stages, args.start, wd_opts)
+    files, tiles = (inputs, []) if args.start == 'retile' else ({}, inputs)
+
+    input_bounds = None
+    if args.catalogue is not None:
+        sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'AHN_downloading'))
+        from AHN_tile_catalogue import open_catalogue
+        catalogue = open_catalogue(args.catalogue)
+        all_files = set(name for names in files.values() for name in names)
+        input_bounds = {name: catalogue.get(name) for name in all_files if catalogue.get(name) is not None}
+        print('Bounds of {} of {} input files from the catalogue'.format(len(input_bounds), len(all_files)))
+
+    scheduler = TileScheduler(stages, wd_opts=wd_opts, input_bounds=input_bounds)
+    # the cluster is long-lived: only the client is closed at the end
+    scheduler.setup_cluster(cluster=args.scheduler)
+    try:
+        scheduler.run(files, tiles)
+    finally:
+        scheduler.print_outcome(to_dir=args.directory)
+        scheduler.client.close()
+    failed = scheduler.get_failed_pipelines()
+    for name, tasks in failed.items():
+        print('{}: {} failed'.format(name, len(tasks)))
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,191 @@
+#!/usr/bin/env python3
+
+
+"""
+Aggregate a set of rasters (e.g. the 5 m AHN DTM/DSM sheets) to a coarser
+resolution by an integer factor, into one tiled, compressed GeoTIFF.
+
+The input files are read as one virtual mosaic (a VRT), so sheets are merged
+before they are aggregated and nothing is written but the output. The output
+is split in windows of blocks; every window is read from the mosaic and
+reduced in a pool of processes, each output pixel over factor x factor input
+pixels aligned to the origin of the mosaic, ignoring nodata. The main
+process writes the windows to the output as they come in, and skips windows
+without data.
+
+    aggregate_rasters(glob.glob('/path/AHN2/DSM/*.tif'), 'AHN2_DSM_10m_merged.tif', factor=2)
+
+or from the command line:
+
+    python AHN_raster_aggregate.py /path/AHN2/DSM AHN2_DSM_10m_merged.tif --factor 2 --reduction mean
+"""
+
+
+import argparse
+import concurrent.futures
+import glob
+import logging
+import os
+
+import numpy as np
+from osgeo import gdal
+
+
+logger = logging.getLogger(__name__)
+
+REDUCTIONS = {'mean': np.nanmean, 'min': np.nanmin, 'max': np.nanmax}
+# output pixels along the side of a window, a multiple of the output blocks
+WINDOW_SIZE = 1024
+# largest number of input pixels read at once
+MAX_READ_PIXELS = 2 ** 24
+CREATION_OPTIONS = ['TILED=YES', 'BLOCKXSIZE=512', 'BLOCKYSIZE=512', 'COMPRESS=DEFLATE', 'PREDICTOR=3',
+                    'BIGTIFF=IF_SAFER', 'SPARSE_OK=TRUE', 'NUM_THREADS=ALL_CPUS']
+
+# virtual mosaic opened once in every process of the pool
+_mosaic = None
+
+
+def _open_mosaic(vrt_xml):
+    global _mosaic
+    _mosaic = gdal.Open(vrt_xml)
+
+
+def reduce_blocks(data, factor, reduction='mean'):
+    """
+    Reduce an array over blocks of factor x factor pixels, ignoring NaN. The
+    array is padded with NaN to a multiple of factor; blocks without valid
+    pixels are NaN.
+
+    :param data: 2D float array
+    :param factor: integer aggregation factor
+    :param reduction: 'mean', 'min' or 'max'
+    """
+    rows, columns = -(-data.shape[0] // factor), -(-data.shape[1] // factor)
+    padded = np.full((rows * factor, columns * factor), np.nan, dtype=data.dtype)
+    padded[:data.shape[0], :data.shape[1]] = data
+    blocks = padded.reshape(rows, factor, columns, factor).swapaxes(1, 2).reshape(rows, columns, factor ** 2)
+    valid = ~np.isnan(blocks).all(axis=-1)
+    reduced = np.full((rows, columns), np.nan, dtype=data.dtype)
+    reduced[valid] = REDUCTIONS[reduction](blocks[valid], axis=-1)
+    return reduced
+
+
+def _aggregate_window(window, factor, reduction):
+    """
+    Read a window of output pixels (x, y, columns, rows) from the mosaic and
+    reduce it, in strips of rows of at most MAX_READ_PIXELS input pixels.
+    """
+    x, y, columns, rows = window
+    band = _mosaic.GetRasterBand(1)
+    nodata = band.GetNoDataValue()
+    x_size = min(columns * factor, _mosaic.RasterXSize - x * factor)
+    strip_rows = max(1, MAX_READ_PIXELS // (x_size * factor))
+    reduced = np.full((rows, columns), np.nan)
+    for row in range(0, rows, strip_rows):
+        y_offset = (y + row) * factor
+        y_size = min(min(strip_rows, rows - row) * factor, _mosaic.RasterYSize - y_offset)
+        data = band.ReadAsArray(x * factor, y_offset, x_size, y_size).astype(np.float64)
+        if nodata is not None:
+            data[data == nodata] = np.nan
+        if not np.isnan(data).all():
+            strip = reduce_blocks(data, factor, reduction)
+            reduced[row:row + strip.shape[0], :strip.shape[1]] = strip
+    if np.isnan(reduced).all():
+        return window, None
+    return window, reduced
+
+
+def aggregate_rasters(input_files, output_file, factor, reduction='mean', n_processes=None,
+                      window_size=WINDOW_SIZE, creation_options=None):
+    """
+    Aggregate rasters with the same pixel size into one GeoTIFF.
+
+    :param input_files: list of the input rasters (single band)
+    :param output_file: output GeoTIFF
+    :param factor: integer aggregation factor, e.g. 2 from 5 m to 10 m
+    :param reduction: 'mean', 'min' or 'max' of the valid input pixels
+    :param n_processes: (Optional) number of processes, default the number of cores
+    :param window_size: (Optional) output pixels along the side of a window
+    :param creation_options: (Optional) creation options of the GTiff driver, CREATION_OPTIONS if not given
+    :return: path of the output
+    """
+    if not isinstance(factor, int) or factor < 1:
+        raise ValueError('factor must be int > 0! Got instead: {}'.format(factor))
+    if reduction not in REDUCTIONS:
+        raise ValueError('reduction must be one of {}! Got instead: {}'.format(list(REDUCTIONS), reduction))
+    if not input_files:
+        raise IOError('No input raster')
+
+    mosaic = gdal.BuildVRT('', list(input_files))
+    if mosaic is None:
+        raise IOError('Failed to build the mosaic of the input rasters')
+    vrt_xml = mosaic.GetMetadata('xml:VRT')[0]
+    geotransform = mosaic.GetGeoTransform()
+    nodata = mosaic.GetRasterBand(1).GetNoDataValue()
+    columns, rows = -(-mosaic.RasterXSize // factor), -(-mosaic.RasterYSize // factor)
+    logger.info('Aggregating {} rasters ({} x {} pixels) by {} into {} x {} pixels'.format(
+        len(input_files), mosaic.RasterXSize, mosaic.RasterYSize, factor, columns, rows))
+
+    output = gdal.GetDriverByName('GTiff').Create(
+        output_file, columns, rows, 1, gdal.GDT_Float32,
+        creation_options if creation_options is not None else CREATION_OPTIONS)
+    output.SetGeoTransform((geotransform[0], geotransform[1] * factor, geotransform[2],
+                            geotransform[3], geotransform[4], geotransform[5] * factor))
+    output.SetProjection(mosaic.GetProjection())
+    band = output.GetRasterBand(1)
+    output_nodata = nodata if nodata is not None else np.nan
+    band.SetNoDataValue(output_nodata)
+    mosaic = None
+
+    windows = [(x, y, min(window_size, columns - x), min(window_size, rows - y))
+               for y in range(0, rows, window_size) for x in range(0, columns, window_size)]
+    n_processes = n_processes if n_processes is not None else os.cpu_count()
+    written = 0
+    with concurrent.futures.ProcessPoolExecutor(n_processes, initializer=_open_mosaic,
+                                                initargs=(vrt_xml,)) as executor:
+        # a bounded number of windows in flight, so the memory does not grow with the output
+        pending = set()
+        for window in windows:
+            pending.add(executor.submit(_aggregate_window, window, factor, reduction))
+            if len(pending) < 2 * n_processes:
+                continue
+            done, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+            written += _write_windows(band, done, output_nodata)
+        written += _write_windows(band, concurrent.futures.as_completed(pending), output_nodata)
+    output.FlushCache()
+    output = band = None
+    logger.info('{} windows with data written to {}'.format(written, output_file))
+    return output_file
+
+
+def _write_windows(band, futures, nodata):
+    written = 0
+    for future in futures:
+        (x, y, _, _), data = future.result()
+        if data is None:
+            continue
+        data[np.isnan(data)] = nodata
+        band.WriteArray(data.astype(np.float32), x, y)
+        written += 1
+    return written
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Aggregate rasters to a coarser resolution by an integer factor '
+                                                 'into one tiled, compressed GeoTIFF')
+    parser.add_argument('input', help='folder with the input rasters (*.tif)')
+    parser.add_argument('output', help='output GeoTIFF')
+    parser.add_argument('--factor', type=int, required=True, help='aggregation factor, e.g. 2 from 5 m to 10 m')
+    parser.add_argument('--reduction', choices=list(REDUCTIONS), default='mean', help='reduction of the input pixels')
+    parser.add_argument('--processes', type=int, default=None, help='number of processes, default all cores')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    gdal.UseExceptions()
+    input_files = sorted(glob.glob(os.path.join(args.input, '*.tif')))
+    aggregate_rasters(input_files, args.output, args.factor, args.reduction, args.processes)
+    print('Aggregated raster saved as: {}'.format(args.output))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,212 @@
+"""
+Box plot statistics of the sensitivity-analysis metrics, computed in one pass.
+
+Axes.boxplot needs every value in memory and draws one artist per outlier;
+with whis=[5, 95] that is a tenth of all sampled pixels. Here the statistics
+(median, quartiles, 5/95 whiskers and a capped set of fliers) are computed
+while the metric files are streamed, and drawn with Axes.bxp.
+
+Up to exact_limit values per metric the statistics are exact and equal to
+those of Axes.boxplot. Beyond that the values go into a mergeable quantile
+sketch of bounded size, and fliers are drawn from a uniform sample.
+"""
+
+import numpy as np
+
+from metrics_loader import NUM_COLUMNS, iter_metrics
+
+DEFAULT_WHIS = (5, 95)
+# values per metric kept for exact statistics; beyond this the sketch is used
+DEFAULT_EXACT_LIMIT = 2**20
+DEFAULT_SKETCH_CAPACITY = 4096
+# uniform sample per metric the fliers are taken from in sketch mode
+DEFAULT_SAMPLE_SIZE = 20000
+DEFAULT_MAX_FLIERS = 500
+DEFAULT_SEED = 0
+
+
+class QuantileSketch:
+    """
+    Mergeable quantile sketch: a stack of compactors of equal capacity, items
+    at level h stand for 2**h values. A full level is sorted and every other
+    item, starting at a random offset, moves one level up. The rank error is
+    about log2(n / capacity) / capacity.
+    """
+
+    def __init__(self, capacity=DEFAULT_SKETCH_CAPACITY, rng=None):
+        self.capacity = capacity
+        self.rng = rng if rng is not None else np.random.default_rng(DEFAULT_SEED)
+        self.levels = [np.empty(0)]
+
+    def update(self, values):
+        self.levels[0] = np.concatenate([self.levels[0], np.asarray(values, dtype=np.float64)])
+        self._compress()
+
+    def merge(self, other):
+        for level, items in enumerate(other.levels):
+            if level == len(self.levels):
+                self.levels.append(np.empty(0))
+            self.levels[level] = np.concatenate([self.levels[level], items])
+        self._compress()
+
+    def _compress(self):
+        level = 0
+        while level < len(self.levels):
+            items = self.levels[level]
+            if len(items) > self.capacity:
+                items = np.sort(items)
+                paired = len(items) - len(items) % 2
+                if level + 1 == len(self.levels):
+                    self.levels.append(np.empty(0))
+                offset = self.rng.integers(2)
+                self.levels[level + 1] = np.concatenate([self.levels[level + 1], items[offset:paired:2]])
+                self.levels[level] = items[paired:]
+            level += 1
+
+    def count(self):
+        return sum(len(items) << level for level, items in enumerate(self.levels))
+
+    def quantiles(self, fractions):
+        """ Values at the given fractions (0-1) of the ranks. """
+        items = np.concatenate(self.levels)
+        weights = np.concatenate([np.full(len(items), 1 << level) for level, items in enumerate(self.levels)])
+        order = np.argsort(items, kind='stable')
+        ranks = np.cumsum(weights[order])
+        indices = np.searchsorted(ranks, np.asarray(fractions) * ranks[-1], side='left')
+        return items[order][np.clip(indices, 0, len(items) - 1)]
+
+
+class BoxStatistics:
+    """ Streaming box plot statistics of one metric at one pulse density. """
+
+    def __init__(self, whis=DEFAULT_WHIS, exact_limit=DEFAULT_EXACT_LIMIT, max_fliers=DEFAULT_MAX_FLIERS,
+                 sketch_capacity=DEFAULT_SKETCH_CAPACITY, sample_size=DEFAULT_SAMPLE_SIZE, seed=DEFAULT_SEED):
+        self.whis = whis
+        self.exact_limit = exact_limit
+        self.max_fliers = max_fliers
+        self.sketch_capacity = sketch_capacity
+        self.sample_size = sample_size
+        self.rng = np.random.default_rng(seed)
+
+        self.count = 0
+        self.total = 0.
+        self.minimum = np.inf
+        self.maximum = -np.inf
+        self.exact = []
+        self.sketch = None
+        # uniform sample: the values with the smallest random keys
+        self.sample = np.empty(0)
+        self.sample_keys = np.empty(0)
+
+    def update(self, values):
+        # copy, a column of a chunk would keep the whole chunk alive
+        values = np.array(values, dtype=np.float64).ravel()
+        if len(values) == 0:
+            return
+        self.count += len(values)
+        self.total += values.sum()
+        self.minimum = min(self.minimum, values.min())
+        self.maximum = max(self.maximum, values.max())
+        self._update_sample(values, self.rng.random(len(values)))
+
+        if self.sketch is not None:
+            self.sketch.update(values)
+            return
+        self.exact.append(values)
+        if self.count > self.exact_limit:
+            self._switch_to_sketch()
+
+    def merge(self, other):
+        """ Add the statistics of another BoxStatistics, e.g. of another part of the input. """
+        if other.count == 0:
+            return
+        self.count += other.count
+        self.total += other.total
+        self.minimum = min(self.minimum, other.minimum)
+        self.maximum = max(self.maximum, other.maximum)
+        self._update_sample(other.sample, other.sample_keys)
+
+        if other.sketch is not None:
+            if self.sketch is None:
+                self._switch_to_sketch()
+            self.sketch.merge(other.sketch)
+        elif self.sketch is not None:
+            self.sketch.update(np.concatenate(other.exact))
+        else:
+            self.exact.extend(other.exact)
+            if self.count > self.exact_limit:
+                self._switch_to_sketch()
+
+    def _update_sample(self, values, keys):
+        if len(self.sample_keys) >= self.sample_size:
+            # only values that can displace a sampled one
+            threshold = self.sample_keys.max()
+            values, keys = values[keys < threshold], keys[keys < threshold]
+        self.sample = np.concatenate([self.sample, values])
+        self.sample_keys = np.concatenate([self.sample_keys, keys])
+        if len(self.sample_keys) > self.sample_size:
+            keep = np.argpartition(self.sample_keys, self.sample_size - 1)[:self.sample_size]
+            self.sample, self.sample_keys = self.sample[keep], self.sample_keys[keep]
+
+    def _switch_to_sketch(self):
+        self.sketch = QuantileSketch(self.sketch_capacity, self.rng)
+        if self.exact:
+            self.sketch.update(np.concatenate(self.exact))
+        self.exact = []
+
+    def _cap_fliers(self, fliers):
+        """ At most max_fliers fliers, each extreme included once. """
+        if len(fliers) <= self.max_fliers:
+            return fliers
+        extremes = np.unique([np.argmin(fliers), np.argmax(fliers)])
+        interior = np.delete(fliers, extremes)
+        chosen = self.rng.choice(len(interior), max(self.max_fliers - len(extremes), 0), replace=False)
+        return np.concatenate([fliers[extremes], interior[chosen]])[:self.max_fliers]
+
+    def summary(self, label=None):
+        """ Statistics as the dict Axes.bxp expects. """
+        stats = {'label': label, 'count': self.count, 'fliers': np.empty(0)}
+        if self.count == 0:
+            stats.update(dict.fromkeys(['mean', 'med', 'q1', 'q3', 'iqr', 'cilo', 'cihi', 'whislo', 'whishi'], np.nan))
+            return stats
+
+        if self.sketch is None:
+            values = np.concatenate(self.exact)
+            q1, median, q3, low, high = np.percentile(values, [25, 50, 75, self.whis[0], self.whis[1]])
+            # whiskers end at data points, as in matplotlib.cbook.boxplot_stats
+            inside = values[(values >= low) & (values <= high)]
+            whislo = min(inside.min(), q1) if len(inside) else q1
+            whishi = max(inside.max(), q3) if len(inside) else q3
+            fliers = values[(values < whislo) | (values > whishi)]
+        else:
+            q1, median, q3, low, high = self.sketch.quantiles([.25, .5, .75, self.whis[0] / 100., self.whis[1] / 100.])
+            whislo, whishi = min(low, q1), max(high, q3)
+            fliers = self.sample[(self.sample < whislo) | (self.sample > whishi)]
+            # the sample may already hold the extremes
+            extremes = [value for value in {self.minimum, self.maximum}
+                        if (value < whislo or value > whishi) and value not in fliers]
+            fliers = np.concatenate([fliers, extremes])
+
+        iqr = q3 - q1
+        notch = 1.57 * iqr / np.sqrt(self.count)
+        stats.update({'mean': self.total / self.count, 'med': median, 'q1': q1, 'q3': q3, 'iqr': iqr,
+                      'cilo': median - notch, 'cihi': median + notch,
+                      'whislo': whislo, 'whishi': whishi, 'fliers': self._cap_fliers(fliers)})
+        return stats
+
+
+def file_box_statistics(file_path, num_columns=NUM_COLUMNS, cache_dir=None, **options):
+    """
+    BoxStatistics of every metric (column) of a metric file, in one streaming
+    pass. options are passed to BoxStatistics.
+    """
+    statistics = [BoxStatistics(**options) for _ in range(num_columns)]
+    for chunk in iter_metrics(file_path, num_columns, cache_dir=cache_dir):
+        for column, column_statistics in enumerate(statistics):
+            column_statistics.update(chunk[:, column])
+    return statistics
+
+
+def file_box_summaries(file_path, num_columns=NUM_COLUMNS, cache_dir=None, **options):
+    """ Axes.bxp statistics of every metric of a metric file. """
+    return [statistics.summary() for statistics in file_box_statistics(file_path, num_columns, cache_dir, **options)]
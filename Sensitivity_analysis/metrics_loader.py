@@ -0,0 +1,163 @@
+"""
+Loader for the sensitivity-analysis metric files.
+
+Each file holds one row per sampled pixel with 25 whitespace-delimited metric
+values. Rows with an undefined value (written as '-nan(ind)' by the Windows C
+runtime, or 'nan') are dropped. Parsed arrays are cached as .npy files keyed by
+the size and modification time of the text file, so re-plotting does not parse
+the text again.
+"""
+
+import glob
+import io
+import os
+
+import numpy as np
+
+NUM_COLUMNS = 25
+# text read per chunk by iter_metrics
+CHUNK_BYTES = 2**26
+
+# NaN spellings of the Windows C runtime (-nan(ind), nan(snan), ...) mapped to one numpy can read;
+# plain replacements, a regular expression is several times slower on files of millions of rows
+NAN_TOKENS = [(b'nan(ind)', b'nan'), (b'nan(snan)', b'nan'), (b'nan(qnan)', b'nan')]
+
+
+def parse_metrics(text, num_columns=NUM_COLUMNS):
+    """ Parse the bytes of a metric file into a (rows, num_columns) float array, NaN rows included. """
+    for token, replacement in NAN_TOKENS:
+        text = text.replace(token, replacement)
+    return np.loadtxt(io.BytesIO(text), dtype=np.float64, usecols=range(num_columns), ndmin=2)
+
+
+def drop_nan_rows(data):
+    """ Rows without any NaN value. """
+    return data[~np.isnan(data).any(axis=1)]
+
+
+def cache_path(file_path, cache_dir=None):
+    """ Cache file name, keyed by size and modification time of the metric file. """
+    stat = os.stat(file_path)
+    directory = cache_dir if cache_dir is not None else os.path.dirname(os.path.abspath(file_path))
+    name = '.{}.{}_{}.npy'.format(os.path.basename(file_path), stat.st_size, stat.st_mtime_ns)
+    return os.path.join(directory, name)
+
+
+def load_metrics(file_path, num_columns=NUM_COLUMNS, cache_dir=None, use_cache=True):
+    """
+    Metric values of a file as a (rows, num_columns) float array, with rows
+    containing NaN dropped. The array is read from the .npy cache if the file
+    did not change since it was cached.
+    """
+    cached = cache_path(file_path, cache_dir) if use_cache else None
+    if cached is not None and os.path.isfile(cached):
+        data = np.load(cached)
+        if data.ndim == 2 and data.shape[1] == num_columns:
+            return data
+
+    with open(file_path, 'rb') as file:
+        data = drop_nan_rows(parse_metrics(file.read(), num_columns))
+
+    if cached is not None:
+        try:
+            os.makedirs(os.path.dirname(cached), exist_ok=True)
+            temporary = cached[:-len('.npy')] + '.tmp.npy'
+            np.save(temporary, data)
+            _replace_cache(temporary, cached, file_path)
+        except OSError as error:
+            print('could not cache {}: {}'.format(file_path, error))
+    return data
+
+
+def _replace_cache(temporary, cached, file_path):
+    """ Move a complete cache file into place and remove the caches of earlier versions of the metric file. """
+    os.replace(temporary, cached)
+    for path in glob.glob(os.path.join(os.path.dirname(cached), '.{}.*_*.npy'.format(glob.escape(os.path.basename(file_path))))):
+        if path != cached:
+            os.remove(path)
+
+
+def load_metric_files(file_paths, num_columns=NUM_COLUMNS, cache_dir=None, use_cache=True):
+    """ load_metrics for a list of files, e.g. one per pulse density. """
+    return [load_metrics(file_path, num_columns, cache_dir, use_cache) for file_path in file_paths]
+
+
+def iter_metrics(file_path, num_columns=NUM_COLUMNS, chunk_bytes=CHUNK_BYTES, cache_dir=None, use_cache=True):
+    """
+    Metric values of a file as a sequence of (rows, num_columns) float arrays,
+    rows containing NaN dropped, holding about chunk_bytes of text each. A valid
+    .npy cache is memory mapped instead of parsing the text. Otherwise the
+    parsed rows are appended to a raw file while they are yielded, and turned
+    into the .npy cache once the whole file has been read; the whole array is
+    never in memory.
+    """
+    cached = cache_path(file_path, cache_dir) if use_cache else None
+    if cached is not None and os.path.isfile(cached):
+        data = np.load(cached, mmap_mode='r')
+        if data.ndim == 2 and data.shape[1] == num_columns:
+            yield from _iter_rows(data, chunk_bytes)
+            return
+
+    raw_file, raw_path = None, None
+    if cached is not None:
+        raw_path = cached[:-len('.npy')] + '.tmp.raw'
+        try:
+            os.makedirs(os.path.dirname(cached), exist_ok=True)
+            raw_file = open(raw_path, 'wb')
+        except OSError as error:
+            print('could not cache {}: {}'.format(file_path, error))
+
+    n_rows = 0
+    try:
+        with open(file_path, 'rb') as file:
+            while True:
+                lines = file.readlines(chunk_bytes)
+                if not lines:
+                    break
+                data = drop_nan_rows(parse_metrics(b''.join(lines), num_columns))
+                if raw_file is not None:
+                    try:
+                        raw_file.write(data.tobytes())
+                        n_rows += len(data)
+                    except OSError as error:
+                        print('could not cache {}: {}'.format(file_path, error))
+                        raw_file.close()
+                        raw_file = None
+                yield data
+        if raw_file is not None:
+            raw_file.close()
+            try:
+                _write_cache(raw_path, cached, file_path, n_rows, num_columns, chunk_bytes)
+            except OSError as error:
+                print('could not cache {}: {}'.format(file_path, error))
+    finally:
+        # also reached when the consumer stops early: the rows read so far are not cached
+        if raw_file is not None:
+            raw_file.close()
+        if raw_path is not None and os.path.isfile(raw_path):
+            os.remove(raw_path)
+
+
+def _iter_rows(data, chunk_bytes):
+    """ Copies of consecutive rows of a (memory mapped) array, about chunk_bytes each. """
+    rows = max(1, chunk_bytes // (data.shape[1] * data.itemsize))
+    for start in range(0, data.shape[0], rows):
+        yield np.asarray(data[start:start + rows])
+
+
+def _write_cache(raw_path, cached, file_path, n_rows, num_columns, chunk_bytes):
+    """ Copy the float64 rows of a raw file into a temporary .npy, chunk by chunk, and move it into place. """
+    temporary = cached[:-len('.npy')] + '.tmp.npy'
+    if n_rows == 0:
+        # an empty array cannot be memory mapped
+        np.save(temporary, np.empty((0, num_columns)))
+    else:
+        array = np.lib.format.open_memmap(temporary, mode='w+', dtype=np.float64, shape=(n_rows, num_columns))
+        raw = np.memmap(raw_path, dtype=np.float64, mode='r', shape=(n_rows, num_columns))
+        start = 0
+        for rows in _iter_rows(raw, chunk_bytes):
+            array[start:start + len(rows)] = rows
+            start += len(rows)
+        array.flush()
+        del array, raw
+    _replace_cache(temporary, cached, file_path)
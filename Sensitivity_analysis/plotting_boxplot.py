@@ -1,559 +1,172 @@
-file_paths = [
-    r'G:\Data\20250401_Yifang\metrics_new\dunes\downsample_to_ahn2_1_metrics_dunes.txt',
-    r'G:\Data\20250401_Yifang\metrics_new\dunes\downsample_to_ahn2_metrics_dunes.txt',
-    r'G:\Data\20250401_Yifang\metrics_new\dunes\downsample_to_ahn3_metrics_dunes.txt',
-    r'G:\Data\20250401_Yifang\metrics_new\dunes\first_return_ahn4_metrics_dunes.txt',
-]
-
-
-# Initialize a list to store data from all files
-all_files_data = []
-
-# Loop over each file
-for file_path in file_paths:
-    # Initialize lists for each column for the current file
-    columns = [[] for _ in range(25)]
-
-    # Open and read the file
-    with open(file_path, 'r') as file:
-        for line in file:
-            data = line.strip().split()
-            for i in range(25):
-                columns[i].append(data[i])
-
-    # Add the columns data to the overall data list
-    all_files_data.append(columns)
-
-
-def transpose(matrix):
-    """ Transpose a 2D list (matrix) """
-    return list(map(list, zip(*matrix)))
-
-
-
-cleaned_data = []
-
-for file_data in all_files_data:
-    # Transpose to work with rows
-    transposed_data = transpose(file_data)
-
-    # Filter out rows that contain '-nan(ind)'
-    filtered_data = [row for row in transposed_data if '-nan(ind)' not in row]
-
-    # Transpose back and add to cleaned data
-    cleaned_data.append(transpose(filtered_data))
+"""
+Box plots of the LiDAR-derived vegetation metrics at different pulse densities,
+one panel per metric and one box per pulse density (metric file).
 
-# Now, cleaned_data contains data from all files with '-nan(ind)' rows removed
-all_files_data = cleaned_data
+The panels are generated from the METRICS table and the figures from FIGURES,
+or from a JSON file with the same structure as FIGURES:
 
+    python plotting_boxplot.py                         # all FIGURES, in parallel, saved as png
+    python plotting_boxplot.py --config figures.json   # figures of a config file
+    python plotting_boxplot.py --figure Dunes_10m --show
 
+Every metric file is parsed once, even if it is used in several figures, and
+figures are rendered in a process pool with the headless Agg backend.
+"""
 
+import argparse
+import json
+import math
 import os
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+
+import matplotlib
+
+from box_statistics import DEFAULT_WHIS, file_box_summaries
+
+# (column in the metric files, panel title, unit, box colour)
+METRICS = [
+    (0, 'Hmax', 'Meter', 'skyblue'),
+    (1, 'Hmean', 'Meter', 'skyblue'),
+    (2, 'Hmedian', 'Meter', 'skyblue'),
+    (3, 'Hp25', 'Meter', 'skyblue'),
+    (4, 'Hp50', 'Meter', 'skyblue'),
+    (5, 'Hp75', 'Meter', 'skyblue'),
+    (6, 'Hp95', 'Meter', 'skyblue'),
+    (7, 'PPR', 'Ratio', 'lightgreen'),
+    (8, 'Density_above_mean_z', 'Number of points', 'lightgreen'),
+    (9, 'BR_below_1', 'Ratio', 'lightgreen'),
+    (10, 'BR_1_2', 'Ratio', 'lightgreen'),
+    (11, 'BR_2_3', 'Ratio', 'lightgreen'),
+    (12, 'BR_above_3', 'Ratio', 'lightgreen'),
+    (13, 'BR_3_4', 'Ratio', 'lightgreen'),
+    (14, 'BR_4_5', 'Ratio', 'lightgreen'),
+    (15, 'BR_below_5', 'Ratio', 'lightgreen'),
+    (16, 'BR_5_20', 'Ratio', 'lightgreen'),
+    (17, 'BR_above_20', 'Ratio', 'lightgreen'),
+    (18, 'Coeff_var', 'Values', 'orange'),
+    (19, 'Entropy_z', 'Nat', 'orange'),
+    (20, 'Hkurt', 'Values', 'orange'),
+    (21, 'Sigma_z', 'Meter', 'orange'),
+    (22, 'Hskew', 'Values', 'orange'),
+    (23, 'Hstd', 'Meter', 'orange'),
+    (24, 'Hvar', 'Meter^2', 'orange'),
+]
 
-import matplotlib.pyplot as plt
-
-save_directory = r'G:\Data\20250401_Yifang\metrics_new'
-file_name = 'Dunes_10m.png'
-
-if not os.path.exists(save_directory):
-    os.makedirs(save_directory)
-
-# Save the figure
-save_path = os.path.join(save_directory, file_name)
-
-# Convert data to float or the appropriate type if necessary
-numeric_data = [[[float(value) for value in col] for col in file] for file in all_files_data]
-
-# Number of columns and files
-num_columns = 25
-num_files = 4
-
-# Create a figure and a set of subplots
-fig, axes = plt.subplots(5, 5, figsize=(15, 15))
-axes = axes.flatten()
-
-tick_labels = ['4','8', '16', '26']
-#tick_labels = ['2','5', '10', '21']
-#tick_labels = ['2','4', '9', '18']
-#tick_labels = ['3','6', '12', '22']
-#tick_labels = ['4','7', '14', '25']
-
-# Set the overall figure title
-fig.suptitle('LiDAR-derived vegetation metrics of dunes at different pulse densities', fontsize=16)
-
-
-# Penetration ratio
-
-H_max = [file[0] for file in numeric_data]
-#axes[0].boxplot(H_max, showfliers=True)
-#axes[0].boxplot(H_max)
-axes[0].boxplot(H_max,
-                patch_artist=True,
-                whis=[5, 95],
-                #whis=1.5,
-                showfliers=True,
-                medianprops=dict(color="red"),
-                boxprops=dict(color="black", facecolor="skyblue"),
-                whiskerprops=dict(color="green"),
-                capprops=dict(color="gray"),
-                flierprops=dict(marker='.', markerfacecolor='black', markersize=5)
-                )
-
-axes[0].set_title('Hmax')
-axes[0].set_xlabel('Pulse density (pulses/m$^2$)')
-axes[0].set_xticklabels(tick_labels)
-axes[0].set_ylabel('Meter')
-
-# Max vegetation height
-H_mean = [file[1] for file in numeric_data]
-#axes[1].boxplot(H_mean, showfliers=False)
-axes[1].boxplot(H_mean,
-                patch_artist=True,
-                whis=[5, 95],
-                #whis=1.5,
-                showfliers=True,
-                medianprops=dict(color="red"),
-                boxprops=dict(color="black", facecolor="skyblue"),
-                whiskerprops=dict(color="green"),
-                capprops=dict(color="gray"),
-                flierprops=dict(marker='.', markerfacecolor='black', markersize=5))
-
-axes[1].set_title('Hmean')
-axes[1].set_xlabel('Pulse density (pulses/m$^2$)')
-axes[1].set_xticklabels(tick_labels)
-axes[1].set_ylabel('Meter')
-
-
-# Median vegetation height
-H_median = [file[2] for file in numeric_data]
-#axes[2].boxplot(H_median, showfliers=False)
-axes[2].boxplot(H_median,
-                patch_artist=True,
-                whis=[5, 95],
-                #whis=1.5,
-                showfliers=True,
-                medianprops=dict(color="red"),
-                boxprops=dict(color="black", facecolor="skyblue"),
-                whiskerprops=dict(color="green"),
-                capprops=dict(color="gray"),
-                flierprops=dict(marker='.', markerfacecolor='black', markersize=5))
-
-axes[2].set_title('Hmedian')
-axes[2].set_xlabel('Pulse density (pulses/m$^2$)')
-axes[2].set_xticklabels(tick_labels)
-axes[2].set_ylabel('Meter')
-
-# Shannon index of vegetation
-Hp_25 = [file[3] for file in numeric_data]
-#axes[3].boxplot(Hp_25, showfliers=False)
-axes[3].boxplot(Hp_25,
-                patch_artist=True,
-                whis=[5, 95],
-                #whis=1.5,
-                showfliers=True,
-                medianprops=dict(color="red"),
-                boxprops=dict(color="black", facecolor="skyblue"),
-                whiskerprops=dict(color="green"),
-                capprops=dict(color="gray"),
-                flierprops=dict(marker='.', markerfacecolor='black', markersize=5))
-axes[3].set_title('Hp25')
-axes[3].set_xlabel('Pulse density (pulses/m$^2$)')
-axes[3].set_xticklabels(tick_labels)
-axes[3].set_ylabel('Meter')
-
-# Shannon index of vegetation
-Hp_50 = [file[4] for file in numeric_data]
-#axes[4].boxplot(Hp_50, showfliers=False)
-axes[4].boxplot(Hp_50,
-                patch_artist=True,
-                whis=[5, 95],
-                #whis=1.5,
-                showfliers=True,
-                medianprops=dict(color="red"),
-                boxprops=dict(color="black", facecolor="skyblue"),
-                whiskerprops=dict(color="green"),
-                capprops=dict(color="gray"),
-                flierprops=dict(marker='.', markerfacecolor='black', markersize=5)
-                )
-axes[4].set_title('Hp50')
-axes[4].set_xlabel('Pulse density (pulses/m$^2$)')
-axes[4].set_xticklabels(tick_labels)
-axes[4].set_ylabel('Meter')
-
-# Shannon index of vegetation
-Hp_75 = [file[5] for file in numeric_data]
-#axes[5].boxplot(Hp_75, showfliers=False)
-axes[5].boxplot(Hp_75, patch_artist=True,
-                whis=[5, 95],
-                #whis=1.5,
-                showfliers=True,
-                medianprops=dict(color="red"),
-                boxprops=dict(color="black", facecolor="skyblue"),
-                whiskerprops=dict(color="green"),
-                capprops=dict(color="gray"),
-                flierprops=dict(marker='.', markerfacecolor='black', markersize=5))
-
-axes[5].set_title('Hp75')
-axes[5].set_xlabel('Pulse density (pulses/m$^2$)')
-axes[5].set_xticklabels(tick_labels)
-axes[5].set_ylabel('Meter')
-
-Hp_95 = [file[6] for file in numeric_data]
-#axes[6].boxplot(Hp_95, showfliers=False)
-axes[6].boxplot(Hp_95, patch_artist=True,
-                whis=[5, 95],
-                #whis=1.5,
-                showfliers=True,
-                medianprops=dict(color="red"),
-                boxprops=dict(color="black", facecolor="skyblue"),
-                whiskerprops=dict(color="green"),
-                capprops=dict(color="gray"),
-                flierprops=dict(marker='.', markerfacecolor='black', markersize=5))
-axes[6].set_title('Hp95')
-axes[6].set_xlabel('Pulse density (pulses/m$^2$)')
-axes[6].set_xticklabels(tick_labels)
-axes[6].set_ylabel('Meter')
-
-PPR = [file[7] for file in numeric_data]
-#axes[7].boxplot(PPR, showfliers=False)
-axes[7].boxplot(PPR,
-                patch_artist=True,
-                whis=[5, 95],
-                #whis=1.5,
-                showfliers=True,
-                medianprops=dict(color="red"),
-                boxprops=dict(color="black", facecolor="lightgreen"),
-                whiskerprops=dict(color="green"),
-                capprops=dict(color="gray"),
-                flierprops=dict(marker='.', markerfacecolor='black', markersize=5)
-                )
-axes[7].set_title('PPR')
-axes[7].set_xlabel('Pulse density (pulses/m$^2$)')
-axes[7].set_xticklabels(tick_labels)
-axes[7].set_ylabel('Ratio')
-
-Density_above_mean = [file[8] for file in numeric_data]
-#axes[8].boxplot(Density_above_mean, showfliers=False)
-axes[8].boxplot(Density_above_mean,
-                patch_artist=True,
-                #whis=1.5,
-                whis=[5, 95],
-                showfliers=True,
-                medianprops=dict(color="red"),
-                boxprops=dict(color="black", facecolor="lightgreen"),
-                whiskerprops=dict(color="green"),
-                capprops=dict(color="gray"),
-                flierprops=dict(marker='.', markerfacecolor='black', markersize=5)
-                )
-axes[8].set_title('Density_above_mean_z')
-axes[8].set_xlabel('Pulse density (pulses/m$^2$)')
-axes[8].set_xticklabels(tick_labels)
-axes[8].set_ylabel('Number of points')
-
-
-BR_1 = [file[9] for file in numeric_data]
-#axes[9].boxplot(BR_1, showfliers=False)
-axes[9].boxplot(BR_1,
-                patch_artist=True,
-                #whis=1.5,
-                whis=[5, 95],
-                showfliers=True,
-                medianprops=dict(color="red"),
-                boxprops=dict(color="black", facecolor="lightgreen"),
-                whiskerprops=dict(color="green"),
-                capprops=dict(color="gray"),
-                flierprops=dict(marker='.', markerfacecolor='black', markersize=5)
-                )
-axes[9].set_title('BR_below_1')
-axes[9].set_xlabel('Pulse density (pulses/m$^2$)')
-axes[9].set_xticklabels(tick_labels)
-axes[9].set_ylabel('Ratio')
-
-BR_1_2 = [file[10] for file in numeric_data]
-#axes[10].boxplot(BR_1_2, showfliers=False)
-axes[10].boxplot(BR_1_2,
-                 patch_artist=True,
-                 # whis=1.5,
-                 whis=[5, 95],
-                 showfliers=True,
-                 medianprops=dict(color="red"),
-                 boxprops=dict(color="black", facecolor="lightgreen"),
-                 whiskerprops=dict(color="green"),
-                 capprops=dict(color="gray"),
-                 flierprops=dict(marker='.', markerfacecolor='black', markersize=5)
-                 )
-axes[10].set_title('BR_1_2')
-axes[10].set_xlabel('Pulse density (pulses/m$^2$)')
-axes[10].set_xticklabels(tick_labels)
-axes[10].set_ylabel('Ratio')
-
-BR_2_3 = [file[11] for file in numeric_data]
-#axes[11].boxplot(BR_2_3, showfliers=False)
-axes[11].boxplot(BR_2_3,
-                 patch_artist=True,
-                 # whis=1.5,
-                 whis=[5, 95],
-                 showfliers=True,
-                 medianprops=dict(color="red"),
-                 boxprops=dict(color="black", facecolor="lightgreen"),
-                 whiskerprops=dict(color="green"),
-                 capprops=dict(color="gray"),
-                 flierprops=dict(marker='.', markerfacecolor='black', markersize=5)
-                 )
-axes[11].set_title('BR_2_3')
-axes[11].set_xlabel('Pulse density (pulses/m$^2$)')
-axes[11].set_xticklabels(tick_labels)
-axes[11].set_ylabel('Ratio')
-
-BR_3 = [file[12] for file in numeric_data]
-#axes[12].boxplot(BR_3, showfliers=False)
-axes[12].boxplot(BR_3, patch_artist=True,
-                 # whis=1.5,
-                 whis=[5, 95],
-                 showfliers=True,
-                 medianprops=dict(color="red"),
-                 boxprops=dict(color="black", facecolor="lightgreen"),
-                 whiskerprops=dict(color="green"),
-                 capprops=dict(color="gray"),
-                 flierprops=dict(marker='.', markerfacecolor='black', markersize=5)
-                 )
-axes[12].set_title('BR_above_3')
-axes[12].set_xlabel('Pulse density (pulses/m$^2$)')
-axes[12].set_xticklabels(tick_labels)
-axes[12].set_ylabel('Ratio')
-
-BR_3_4 = [file[13] for file in numeric_data]
-#axes[13].boxplot(BR_3_4, showfliers=False)
-axes[13].boxplot(BR_3_4,
-                 patch_artist=True,
-                 # whis=1.5,
-                 whis=[5, 95],
-                 showfliers=True,
-                 medianprops=dict(color="red"),
-                 boxprops=dict(color="black", facecolor="lightgreen"),
-                 whiskerprops=dict(color="green"),
-                 capprops=dict(color="gray"),
-                 flierprops=dict(marker='.', markerfacecolor='black', markersize=5)
-                 )
-axes[13].set_title('BR_3_4')
-axes[13].set_xlabel('Pulse density (pulses/m$^2$)')
-axes[13].set_xticklabels(tick_labels)
-axes[13].set_ylabel('Ratio')
-
-BR_4_5 = [file[14] for file in numeric_data]
-#axes[14].boxplot(BR_4_5, showfliers=False)
-axes[14].boxplot(BR_4_5,
-                 patch_artist=True,
-                 # whis=1.5,
-                 whis=[5, 95],
-                 showfliers=True,
-                 medianprops=dict(color="red"),
-                 boxprops=dict(color="black", facecolor="lightgreen"),
-                 whiskerprops=dict(color="green"),
-                 capprops=dict(color="gray"),
-                 flierprops=dict(marker='.', markerfacecolor='black', markersize=5)
-                 )
-axes[14].set_title('BR_4_5')
-axes[14].set_xlabel('Pulse density (pulses/m$^2$)')
-axes[14].set_xticklabels(tick_labels)
-axes[14].set_ylabel('Ratio')
-
-BR_5 = [file[15] for file in numeric_data]
-#axes[15].boxplot(BR_5, showfliers=False)
-axes[15].boxplot(BR_5,
-                 patch_artist=True,
-                 # whis=1.5,
-                 whis=[5, 95],
-                 showfliers=True,
-                 medianprops=dict(color="red"),
-                 boxprops=dict(color="black", facecolor="lightgreen"),
-                 whiskerprops=dict(color="green"),
-                 capprops=dict(color="gray"),
-                 flierprops=dict(marker='.', markerfacecolor='black', markersize=5)
-                 )
-axes[15].set_title('BR_below_5')
-axes[15].set_xlabel('Pulse density (pulses/m$^2$)')
-axes[15].set_xticklabels(tick_labels)
-axes[15].set_ylabel('Ratio')
-
-BR_5_20 = [file[16] for file in numeric_data]
-#axes[16].boxplot(BR_5_20, showfliers=False)
-axes[16].boxplot(BR_5_20,
-                 patch_artist=True,
-                 # whis=1.5,
-                 whis=[5, 95],
-                 showfliers=True,
-                 medianprops=dict(color="red"),
-                 boxprops=dict(color="black", facecolor="lightgreen"),
-                 whiskerprops=dict(color="green"),
-                 capprops=dict(color="gray"),
-                 flierprops=dict(marker='.', markerfacecolor='black', markersize=5)
-                 )
-axes[16].set_title('BR_5_20')
-axes[16].set_xlabel('Pulse density (pulses/m$^2$)')
-axes[16].set_xticklabels(tick_labels)
-axes[16].set_ylabel('Ratio')
-
-BR_20 = [file[17] for file in numeric_data]
-#axes[17].boxplot(BR_20, showfliers=False)
-axes[17].boxplot(BR_20,
-                 patch_artist=True,
-                 # whis=1.5,
-                whis=[5, 95],
-                showfliers=True,
-                medianprops=dict(color="red"),
-                boxprops=dict(color="black", facecolor="lightgreen"),
-                whiskerprops=dict(color="green"),
-                capprops=dict(color="gray"),
-                flierprops=dict(marker='.', markerfacecolor='black', markersize=5)
-                 )
-axes[17].set_title('BR_above_20')
-axes[17].set_xlabel('Pulse density (pulses/m$^2$)')
-axes[17].set_xticklabels(tick_labels)
-axes[17].set_ylabel('Ratio')
-
-coeff_var_z = [file[18] for file in numeric_data]
-#axes[18].boxplot(coeff_var_z, showfliers=False)
-axes[18].boxplot(coeff_var_z,
-                 patch_artist=True,
-                 # whis=1.5,
-                 whis=[5, 95],
-                 showfliers=True,
-                 medianprops=dict(color="red"),
-                 boxprops=dict(color="black", facecolor="orange"),
-                 whiskerprops=dict(color="green"),
-                 capprops=dict(color="gray"),
-                 flierprops=dict(marker='.', markerfacecolor='black', markersize=5)
-                 )
-axes[18].set_title('Coeff_var')
-axes[18].set_xlabel('Pulse density (pulses/m$^2$)')
-axes[18].set_xticklabels(tick_labels)
-axes[18].set_ylabel('Values')
+NUM_COLUMNS = 25
+PANELS_PER_ROW = 5
+PANEL_SIZE = 3
+X_LABEL = 'Pulse density (pulses/m$^2$)'
 
-entropy_z = [file[19] for file in numeric_data]
-#axes[19].boxplot(entropy_z, showfliers=False)
-axes[19].boxplot(entropy_z, patch_artist=True,
-                 # whis=1.5,
-                 whis=[5, 95],
+BOX_STYLE = dict(patch_artist=True,
                  showfliers=True,
                  medianprops=dict(color="red"),
-                 boxprops=dict(color="black", facecolor="orange"),
                  whiskerprops=dict(color="green"),
                  capprops=dict(color="gray"),
                  flierprops=dict(marker='.', markerfacecolor='black', markersize=5))
-axes[19].set_title('Entropy_z')
-axes[19].set_xlabel('Pulse density (pulses/m$^2$)')
-axes[19].set_xticklabels(tick_labels)
-axes[19].set_ylabel('Nat')
 
-H_kurt = [file[20] for file in numeric_data]
-#axes[20].boxplot(H_kurt, showfliers=False)
-axes[20].boxplot(H_kurt,
-                 patch_artist=True,
-                 # whis=1.5,
-                 whis=[5, 95],
-                 showfliers=True,
-                 medianprops=dict(color="red"),
-                 boxprops=dict(color="black", facecolor="orange"),
-                 whiskerprops=dict(color="green"),
-                 capprops=dict(color="gray"),
-                 flierprops=dict(marker='.', markerfacecolor='black', markersize=5)
-                 )
-axes[20].set_title('Hkurt')
-axes[20].set_xlabel('Pulse density (pulses/m$^2$)')
-axes[20].set_xticklabels(tick_labels)
-axes[20].set_ylabel('Values')
-
-sigma_z = [file[21] for file in numeric_data]
-#axes[21].boxplot(sigma_z, showfliers=False)
-axes[21].boxplot(sigma_z,  patch_artist=True,
-                 # whis=1.5,
-                 whis=[5, 95],
-                 showfliers=True,
-                 medianprops=dict(color="red"),
-                 boxprops=dict(color="black", facecolor="orange"),
-                 whiskerprops=dict(color="green"),
-                 capprops=dict(color="gray"),
-                 flierprops=dict(marker='.', markerfacecolor='black', markersize=5)
-                 )
-axes[21].set_title('Sigma_z')
-axes[21].set_xlabel('Pulse density (pulses/m$^2$)')
-axes[21].set_xticklabels(tick_labels)
-axes[21].set_ylabel('Meter')
-
-H_skew = [file[22] for file in numeric_data]
-#axes[22].boxplot(H_skew, showfliers=False)
-axes[22].boxplot(H_skew,
-                 patch_artist=True,
-                 # whis=1.5,
-                 whis=[5, 95],
-                 showfliers=True,
-                 medianprops=dict(color="red"),
-                 boxprops=dict(color="black", facecolor="orange"),
-                 whiskerprops=dict(color="green"),
-                 capprops=dict(color="gray"),
-                 flierprops=dict(marker='.', markerfacecolor='black', markersize=5)
-                 )
-axes[22].set_title('Hskew')
-axes[22].set_xlabel('Pulse density (pulses/m$^2$)')
-axes[22].set_xticklabels(tick_labels)
-axes[22].set_ylabel('Values')
-
-H_std = [file[23] for file in numeric_data]
-#axes[23].boxplot(H_std, showfliers=False)
-axes[23].boxplot(H_std,
-                 patch_artist=True,
-                 # whis=1.5,
-                 whis=[5, 95],
-                 showfliers=True,
-                 medianprops=dict(color="red"),
-                 boxprops=dict(color="black", facecolor="orange"),
-                 whiskerprops=dict(color="green"),
-                 capprops=dict(color="gray"),
-                 flierprops=dict(marker='.', markerfacecolor='black', markersize=5)
-                 )
-axes[23].set_title('Hstd')
-axes[23].set_xlabel('Pulse density (pulses/m$^2$)')
-axes[23].set_xticklabels(tick_labels)
-axes[23].set_ylabel('Meter')
-
-H_var = [file[24] for file in numeric_data]
-#axes[24].boxplot(H_var, showfliers=False)
-axes[24].boxplot(H_var,
-                 patch_artist=True,
-                 # whis=1.5,
-                 whis=[5, 95],
-                 showfliers=True,
-                 medianprops=dict(color="red"),
-                 boxprops=dict(color="black", facecolor="orange"),
-                 whiskerprops=dict(color="green"),
-                 capprops=dict(color="gray"),
-                 flierprops=dict(marker='.', markerfacecolor='black', markersize=5)
-                 )
-axes[24].set_title('Hvar')
-axes[24].set_xlabel('Pulse density (pulses/m$^2$)')
-axes[24].set_xticklabels(tick_labels)
-axes[24].set_ylabel('Meter^2')
-
-
-plt.tight_layout()
-plt.subplots_adjust(top=0.92)
-plt.savefig(save_path)
-plt.show()
-
-# Plot each column's data from each file in a group
-for i in range(num_columns):
-    # Extract the i-th column data from each file
-    column_data = [file[i] for file in numeric_data]
-
-    # Plot boxplot for the i-th column with data from all files
-    axes[i].boxplot(column_data, showfliers=False)
-    axes[i].set_title(f'Column {i + 1}')
-    axes[i].set_xlabel('File Number')
-    axes[i].set_ylabel('Values')
+OUTPUT_DIRECTORY = r'G:\Data\20250401_Yifang\metrics_new'
+
+# tick labels are the pulse densities (pulses/m2) of the files of a figure, e.g.
+# ['2','5', '10', '21'], ['2','4', '9', '18'], ['3','6', '12', '22'] or ['4','7', '14', '25']
+FIGURES = [
+    {'name': 'Dunes_10m',
+     'title': 'LiDAR-derived vegetation metrics of dunes at different pulse densities',
+     'files': [r'G:\Data\20250401_Yifang\metrics_new\dunes\downsample_to_ahn2_1_metrics_dunes.txt',
+               r'G:\Data\20250401_Yifang\metrics_new\dunes\downsample_to_ahn2_metrics_dunes.txt',
+               r'G:\Data\20250401_Yifang\metrics_new\dunes\downsample_to_ahn3_metrics_dunes.txt',
+               r'G:\Data\20250401_Yifang\metrics_new\dunes\first_return_ahn4_metrics_dunes.txt'],
+     'tick_labels': ['4', '8', '16', '26']},
+]
 
-# Adjust layout to prevent overlap
-plt.tight_layout()
 
-# Show the plot
-#plt.show()
\ No newline at end of file
+def set_headless_backend():
+    matplotlib.use('Agg')
+
+
+def plot_figure(figure, summaries, output_directory=OUTPUT_DIRECTORY, show=False):
+    """
+    Draw one figure. summaries maps each metric file of the figure to the
+    Axes.bxp statistics of its columns (box_statistics.file_box_summaries).
+    Returns the path of the saved png.
+    """
+    import matplotlib.pyplot as plt
+
+    rows = math.ceil(len(METRICS) / PANELS_PER_ROW)
+    fig, axes = plt.subplots(rows, PANELS_PER_ROW, figsize=(PANEL_SIZE * PANELS_PER_ROW, PANEL_SIZE * rows))
+    axes = axes.flatten()
+    fig.suptitle(figure['title'], fontsize=16)
+
+    for ax, (column, title, unit, colour) in zip(axes, METRICS):
+        ax.bxp([summaries[file_path][column] for file_path in figure['files']],
+               boxprops=dict(color="black", facecolor=colour),
+               **BOX_STYLE)
+        ax.set_title(title)
+        ax.set_xlabel(X_LABEL)
+        ax.set_xticklabels(figure['tick_labels'])
+        ax.set_ylabel(unit)
+    for ax in axes[len(METRICS):]:
+        ax.set_axis_off()
+
+    fig.tight_layout()
+    fig.subplots_adjust(top=0.92)
+    os.makedirs(output_directory, exist_ok=True)
+    save_path = os.path.join(output_directory, figure['name'] + '.png')
+    fig.savefig(save_path)
+    if show:
+        plt.show()
+    plt.close(fig)
+    return save_path
+
+
+def plot_figures(figures, output_directory=OUTPUT_DIRECTORY, processes=None, whis=DEFAULT_WHIS):
+    """
+    Draw all figures in a process pool. Statistics of every distinct metric
+    file are computed once, in parallel, and shared by all figures using it.
+    """
+    file_paths = list(dict.fromkeys(file_path for figure in figures for file_path in figure['files']))
+    with ProcessPoolExecutor(max_workers=processes, initializer=set_headless_backend) as pool:
+        file_summaries = pool.map(partial(file_box_summaries, num_columns=NUM_COLUMNS, whis=whis), file_paths)
+        summaries = dict(zip(file_paths, file_summaries))
+        print('statistics of {} metric files computed'.format(len(file_paths)))
+
+        jobs = [pool.submit(plot_figure, figure, {file_path: summaries[file_path] for file_path in figure['files']},
+                            output_directory)
+                for figure in figures]
+        for job in jobs:
+            print('saved {}'.format(job.result()))
+
+
+def read_figures(config_path):
+    with open(config_path) as config_file:
+        config = json.load(config_file)
+    return config['figures'] if isinstance(config, dict) else config
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Box plots of vegetation metrics at different pulse densities')
+    parser.add_argument('--config', help='JSON file with a list of figures (name, title, files, tick_labels), default FIGURES')
+    parser.add_argument('--figure', action='append', help='only the figure(s) with this name')
+    parser.add_argument('-o', '--output', default=OUTPUT_DIRECTORY, help='directory the png files are saved in')
+    parser.add_argument('-p', '--processes', type=int, default=None, help='worker processes, default number of CPUs')
+    parser.add_argument('--show', action='store_true', help='draw in this process and show the figure(s)')
+    args = parser.parse_args()
+
+    figures = read_figures(args.config) if args.config else FIGURES
+    if args.figure:
+        figures = [figure for figure in figures if figure['name'] in args.figure]
+
+    if args.show:
+        summaries = {}
+        for figure in figures:
+            for file_path in figure['files']:
+                if file_path not in summaries:
+                    summaries[file_path] = file_box_summaries(file_path, NUM_COLUMNS, whis=DEFAULT_WHIS)
+            print('saved {}'.format(plot_figure(figure, summaries, args.output, show=True)))
+    else:
+        set_headless_backend()
+        plot_figures(figures, args.output, args.processes)
+
+
+if __name__ == '__main__':
+    main()